@@ -0,0 +1,310 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       benchmark/generate_data.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+# Generates synthetic Tasty Bytes data, so the pipeline can be measured without the
+# S3 stage or the Weather Source share. The layout matches the raw stage that
+# 02_load_raw.py reads (snappy parquet, with year= partitions for the order tables):
+#
+#   pos/<table>/*.snappy.parquet                 (POS_TABLES)
+#   pos/order_header/year=YYYY/*.snappy.parquet  (and order_detail)
+#   customer/customer_loyalty/*.snappy.parquet   (CUSTOMER_TABLES)
+#   weather/history_day/*.snappy.parquet         (FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.HISTORY_DAY)
+#   weather/postal_codes/*.snappy.parquet        (FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.POSTAL_CODES)
+#
+# The data is referentially consistent: every order line points at an order, every
+# order at a truck and a location in the truck's city, every truck at a franchise and
+# a menu type, and every truck city has a COUNTRY row and weather for each order date.
+# Orders are generated CHUNK_ORDER_LINES at a time, so memory stays flat up to 100M lines.
+
+import datetime
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+
+SCALE_FACTORS = {'1k': 1000, '10k': 10000, '100k': 100000, '1m': 1000000, '10m': 10000000, '100m': 100000000}
+CHUNK_ORDER_LINES = 1000000
+MANIFEST_FILE = 'manifest.json'
+START_DATE = datetime.date(2021, 1, 1)
+MAX_DAYS = 3 * 365
+TRUCKS_PER_CITY = 15
+LOCATIONS_PER_CITY = 50
+POSTAL_CODES_PER_CITY = 5
+ITEMS_PER_MENU = 7
+FRANCHISES = 50
+
+# (city, country, iso country, region, currency, population)
+CITIES = [('San Mateo', 'United States', 'US', 'California', 'USD', 105661),
+          ('Denver', 'United States', 'US', 'Colorado', 'USD', 727211),
+          ('Seattle', 'United States', 'US', 'Washington', 'USD', 755078),
+          ('Boston', 'United States', 'US', 'Massachusetts', 'USD', 695506),
+          ('New York City', 'United States', 'US', 'New York', 'USD', 8804190),
+          ('Toronto', 'Canada', 'CA', 'Ontario', 'CAD', 2794356),
+          ('Vancouver', 'Canada', 'CA', 'British Columbia', 'CAD', 662248),
+          ('Montreal', 'Canada', 'CA', 'Quebec', 'CAD', 1762949),
+          ('London', 'England', 'GB', 'England', 'GBP', 8799800),
+          ('Manchester', 'England', 'GB', 'England', 'GBP', 552858),
+          ('Paris', 'France', 'FR', 'Ile-de-France', 'EUR', 2165423),
+          ('Nice', 'France', 'FR', 'Provence-Alpes-Cote d Azur', 'EUR', 342669),
+          ('Berlin', 'Germany', 'DE', 'Berlin', 'EUR', 3677472),
+          ('Hamburg', 'Germany', 'DE', 'Hamburg', 'EUR', 1853935),
+          ('Madrid', 'Spain', 'ES', 'Madrid', 'EUR', 3223334),
+          ('Barcelona', 'Spain', 'ES', 'Catalonia', 'EUR', 1620343),
+          ('Krakow', 'Poland', 'PL', 'Lesser Poland', 'PLN', 779115),
+          ('Warsaw', 'Poland', 'PL', 'Masovia', 'PLN', 1793579),
+          ('Stockholm', 'Sweden', 'SE', 'Stockholm', 'SEK', 975551),
+          ('Sydney', 'Australia', 'AU', 'New South Wales', 'AUD', 5312163)]
+
+# (truck brand, menu type, item category)
+MENU_TYPES = [('Freezing Point', 'Ice Cream', 'Dessert'), ('Kitakata Ramen Bar', 'Ramen', 'Main'),
+              ('Smoky BBQ', 'BBQ', 'Main'), ("Guac n' Roll", 'Tacos', 'Main'),
+              ('Better Off Bread', 'Sandwiches', 'Main'), ('Cheeky Greek', 'Gyros', 'Main'),
+              ("Peking Truck", 'Chinese', 'Main'), ('Nani\'s Kitchen', 'Indian', 'Main'),
+              ('Plant Palace', 'Vegetarian', 'Main'), ('Le Coin des Crepes', 'Crepes', 'Main'),
+              ('Tasty Tibs', 'Ethiopian', 'Main'), ('The Mac Shack', 'Mac & Cheese', 'Main'),
+              ('Amped Up Franks', 'Hot Dogs', 'Main'), ('Revenge of the Curds', 'Poutine', 'Main'),
+              ('The Mega Melt', 'Grilled Cheese', 'Main')]
+
+
+def scale_rows(scale):
+    if isinstance(scale, int):
+        return scale
+    return SCALE_FACTORS[scale.lower()] if scale.lower() in SCALE_FACTORS else int(scale)
+
+def order_days(order_lines):
+    # Small scales cover a few weeks, 1M+ lines cover all three years (and partitions)
+    return int(min(MAX_DAYS, max(14, order_lines // 1000)))
+
+def empty_column(rows, dtype):
+    # All-NULL columns still get a type, so the parquet schema (and INFER_SCHEMA) has one
+    return pd.Series(pd.NA if dtype == 'string' else None, index=range(rows), dtype=dtype)
+
+def write_parquet(df, directory, name='part-00000'):
+    os.makedirs(directory, exist_ok=True)
+    df.to_parquet(os.path.join(directory, name + '.snappy.parquet'), compression='snappy', index=False)
+    return len(df)
+
+def country_table():
+    return pd.DataFrame({"COUNTRY_ID": np.arange(1, len(CITIES) + 1),
+                         "COUNTRY": [c[1] for c in CITIES],
+                         "ISO_CURRENCY": [c[4] for c in CITIES],
+                         "ISO_COUNTRY": [c[2] for c in CITIES],
+                         "CITY_ID": np.arange(1, len(CITIES) + 1),
+                         "CITY": [c[0] for c in CITIES],
+                         "CITY_POPULATION": [c[5] for c in CITIES]})
+
+def franchise_table(rng):
+    city_idx = rng.integers(0, len(CITIES), FRANCHISES)
+    ids = np.arange(1, FRANCHISES + 1)
+    return pd.DataFrame({"FRANCHISE_ID": ids,
+                         "FIRST_NAME": ["First{}".format(i) for i in ids],
+                         "LAST_NAME": ["Last{}".format(i) for i in ids],
+                         "CITY": [CITIES[i][0] for i in city_idx],
+                         "COUNTRY": [CITIES[i][1] for i in city_idx],
+                         "E_MAIL": ["franchise{}@example.com".format(i) for i in ids],
+                         "PHONE_NUMBER": ["555-{:04d}".format(i) for i in ids]})
+
+def menu_table(rng):
+    rows = []
+    for t, (brand, menu_type, category) in enumerate(MENU_TYPES):
+        for i in range(ITEMS_PER_MENU):
+            cost = round(float(rng.uniform(0.5, 6.0)), 2)
+            rows.append({"MENU_ID": t * ITEMS_PER_MENU + i + 10000, "MENU_TYPE_ID": t + 1, "MENU_TYPE": menu_type, \
+                         "TRUCK_BRAND_NAME": brand, "MENU_ITEM_ID": t * ITEMS_PER_MENU + i + 1, \
+                         "MENU_ITEM_NAME": "{} {}".format(menu_type, i + 1), \
+                         "ITEM_CATEGORY": category if i < ITEMS_PER_MENU - 2 else 'Beverage', "ITEM_SUBCATEGORY": 'Hot Option', \
+                         "COST_OF_GOODS_USD": cost, "SALE_PRICE_USD": round(cost * 3, 0) + 0.0})
+    return pd.DataFrame(rows)
+
+def truck_table(rng):
+    n = len(CITIES) * TRUCKS_PER_CITY
+    city_idx = np.arange(n) // TRUCKS_PER_CITY
+    franchise_flag = rng.integers(0, 2, n)
+    return pd.DataFrame({"TRUCK_ID": np.arange(1, n + 1),
+                         "MENU_TYPE_ID": rng.integers(1, len(MENU_TYPES) + 1, n),
+                         "PRIMARY_CITY": [CITIES[i][0] for i in city_idx],
+                         "REGION": [CITIES[i][3] for i in city_idx],
+                         "ISO_REGION": [CITIES[i][3][:2].upper() for i in city_idx],
+                         "COUNTRY": [CITIES[i][1] for i in city_idx],
+                         "ISO_COUNTRY_CODE": [CITIES[i][2] for i in city_idx],
+                         "FRANCHISE_FLAG": franchise_flag,
+                         "YEAR": rng.integers(2005, 2023, n),
+                         "MAKE": 'Ford', "MODEL": 'Step Van',
+                         "EV_FLAG": rng.integers(0, 2, n),
+                         # Company-owned trucks belong to franchise 1, like in the real data
+                         "FRANCHISE_ID": np.where(franchise_flag == 1, rng.integers(2, FRANCHISES + 1, n), 1),
+                         "TRUCK_OPENING_DATE": START_DATE - datetime.timedelta(days=365)})
+
+def location_table():
+    n = len(CITIES) * LOCATIONS_PER_CITY
+    city_idx = np.arange(n) // LOCATIONS_PER_CITY
+    ids = np.arange(1, n + 1)
+    return pd.DataFrame({"LOCATION_ID": ids,
+                         "PLACEKEY": ["zz@{:06d}".format(i) for i in ids],
+                         "LOCATION": ["Location {}".format(i) for i in ids],
+                         "CITY": [CITIES[i][0] for i in city_idx],
+                         "REGION": [CITIES[i][3] for i in city_idx],
+                         "ISO_COUNTRY_CODE": [CITIES[i][2] for i in city_idx],
+                         "COUNTRY": [CITIES[i][1] for i in city_idx]})
+
+def customer_count(order_lines):
+    return int(min(5000000, max(100, order_lines // 20)))
+
+def customer_loyalty_table(rng, n):
+    city_idx = rng.integers(0, len(CITIES), n)
+    ids = np.arange(1, n + 1)
+    return pd.DataFrame({"CUSTOMER_ID": ids,
+                         "FIRST_NAME": pd.Series(ids).map("First{}".format),
+                         "LAST_NAME": pd.Series(ids).map("Last{}".format),
+                         "CITY": np.array([c[0] for c in CITIES])[city_idx],
+                         "COUNTRY": np.array([c[1] for c in CITIES])[city_idx],
+                         "POSTAL_CODE": pd.Series(rng.integers(10000, 99999, n)).astype(str),
+                         "PREFERRED_LANGUAGE": 'English',
+                         "GENDER": np.array(['Male', 'Female', 'Undisclosed'])[rng.integers(0, 3, n)],
+                         "FAVOURITE_BRAND": empty_column(n, 'string'),
+                         "MARITAL_STATUS": np.array(['Single', 'Married', 'Undisclosed'])[rng.integers(0, 3, n)],
+                         "CHILDREN_COUNT": pd.Series(rng.integers(0, 4, n)).astype(str),
+                         "SIGN_UP_DATE": pd.Timestamp(START_DATE) - pd.to_timedelta(rng.integers(0, 1000, n), unit='D'),
+                         "BIRTHDAY_DATE": pd.Timestamp('1990-01-01') - pd.to_timedelta(rng.integers(0, 15000, n), unit='D'),
+                         "E_MAIL": pd.Series(ids).map("customer{}@example.com".format),
+                         "PHONE_NUMBER": pd.Series(ids).map("555-{:07d}".format)})
+
+def weather_tables(rng, days):
+    postal_codes = pd.DataFrame({"POSTAL_CODE": ["{}{:03d}".format(c[2], i * POSTAL_CODES_PER_CITY + j) \
+                                                 for i, c in enumerate(CITIES) for j in range(POSTAL_CODES_PER_CITY)],
+                                 "CITY_NAME": [c[0] for c in CITIES for _ in range(POSTAL_CODES_PER_CITY)],
+                                 "COUNTRY": [c[2] for c in CITIES for _ in range(POSTAL_CODES_PER_CITY)]})
+    dates = pd.date_range(START_DATE, periods=days, freq='D').date
+    history = postal_codes[["POSTAL_CODE", "COUNTRY"]].merge(pd.DataFrame({"DATE_VALID_STD": dates}), how='cross')
+    n = len(history)
+    seasonal = 20 * np.sin(2 * np.pi * (pd.to_datetime(history["DATE_VALID_STD"]).dt.dayofyear.to_numpy() - 100) / 365)
+    avg_temp = np.round(55 + seasonal + rng.normal(0, 6, n), 1)
+    history["MIN_TEMPERATURE_AIR_2M_F"] = avg_temp - np.round(rng.uniform(3, 12, n), 1)
+    history["AVG_TEMPERATURE_AIR_2M_F"] = avg_temp
+    history["MAX_TEMPERATURE_AIR_2M_F"] = avg_temp + np.round(rng.uniform(3, 12, n), 1)
+    history["TOT_PRECIPITATION_IN"] = np.round(np.where(rng.random(n) < 0.3, rng.exponential(0.3, n), 0.0), 2)
+    history["AVG_WIND_SPEED_100M_MPH"] = np.round(rng.gamma(2.0, 5.0, n), 1)
+    history["MAX_WIND_SPEED_100M_MPH"] = np.round(history["AVG_WIND_SPEED_100M_MPH"] * rng.uniform(1.2, 2.0, n), 1)
+    return postal_codes, history
+
+def order_chunk(rng, lines, first_order_id, first_detail_id, trucks, menu, days):
+    # Orders have 1-5 lines; the last order is cut short so the chunk has exactly `lines` lines
+    counts = rng.integers(1, 6, lines)
+    ends = np.cumsum(counts)
+    orders = int(np.searchsorted(ends, lines)) + 1
+    counts = counts[:orders]
+    counts[-1] -= ends[orders - 1] - lines
+    order_ids = np.arange(first_order_id, first_order_id + orders)
+
+    truck_idx = rng.integers(0, len(trucks), orders)
+    city_idx = truck_idx // TRUCKS_PER_CITY
+    order_ts = pd.Timestamp(START_DATE) + pd.to_timedelta(rng.integers(0, days, orders), unit='D') \
+                                        + pd.to_timedelta(rng.integers(8 * 3600, 22 * 3600, orders), unit='s')
+
+    order_of_line = np.repeat(np.arange(orders), counts)
+    line_number = np.arange(lines) - np.repeat(ends[:orders] - counts, counts)
+    menu_type = trucks["MENU_TYPE_ID"].to_numpy()[truck_idx][order_of_line]
+    menu_item_id = (menu_type - 1) * ITEMS_PER_MENU + rng.integers(0, ITEMS_PER_MENU, lines) + 1
+    unit_price = menu.set_index("MENU_ITEM_ID")["SALE_PRICE_USD"].reindex(menu_item_id).to_numpy()
+    quantity = rng.integers(1, 5, lines)
+    price = quantity * unit_price
+    order_amount = np.bincount(order_of_line, weights=price, minlength=orders)
+
+    header = pd.DataFrame({"ORDER_ID": order_ids,
+                           "TRUCK_ID": truck_idx + 1,
+                           "LOCATION_ID": city_idx * LOCATIONS_PER_CITY + rng.integers(0, LOCATIONS_PER_CITY, orders) + 1,
+                           "CUSTOMER_ID": None, "DISCOUNT_ID": empty_column(orders, 'string'),
+                           "SHIFT_ID": rng.integers(1, 100000, orders),
+                           "SHIFT_START_TIME": '08:00:00', "SHIFT_END_TIME": '22:00:00',
+                           "ORDER_CHANNEL": empty_column(orders, 'string'),
+                           "ORDER_TS": order_ts, "SERVED_TS": empty_column(orders, 'datetime64[ns]'),
+                           "ORDER_CURRENCY": 'USD',
+                           "ORDER_AMOUNT": order_amount,
+                           "ORDER_TAX_AMOUNT": 0.0, "ORDER_DISCOUNT_AMOUNT": 0.0,
+                           "ORDER_TOTAL": order_amount})
+    detail = pd.DataFrame({"ORDER_DETAIL_ID": np.arange(first_detail_id, first_detail_id + lines),
+                           "ORDER_ID": order_ids[order_of_line],
+                           "MENU_ITEM_ID": menu_item_id,
+                           "DISCOUNT_ID": empty_column(lines, 'string'),
+                           "LINE_NUMBER": line_number,
+                           "QUANTITY": quantity,
+                           "UNIT_PRICE": unit_price,
+                           "PRICE": price,
+                           "ORDER_ITEM_DISCOUNT_AMOUNT": empty_column(lines, 'float64')})
+    return header, detail, order_ts.year.to_numpy()[order_of_line], order_ts.year.to_numpy()
+
+def assign_customers(rng, header, customers):
+    # About a third of the orders are from loyalty customers
+    loyal = rng.random(len(header)) < 0.3
+    header["CUSTOMER_ID"] = pd.array(np.where(loyal, rng.integers(1, customers + 1, len(header)), 0), dtype='Int64')
+    header.loc[~loyal, "CUSTOMER_ID"] = pd.NA
+    return header
+
+def read_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def generate(output_dir, scale, seed=42, chunk_lines=CHUNK_ORDER_LINES):
+    # Writes the data set for scale order lines and returns its manifest; an existing data set for
+    # the same scale and seed is reused
+    order_lines = scale_rows(scale)
+    manifest = read_manifest(output_dir)
+    if manifest and manifest['order_lines'] == order_lines and manifest['seed'] == seed:
+        return manifest
+
+    start = time.time()
+    rng = np.random.default_rng(seed)
+    days = order_days(order_lines)
+    rows = {}
+    menu = menu_table(rng)
+    trucks = truck_table(rng)
+    rows['country'] = write_parquet(country_table(), os.path.join(output_dir, 'pos', 'country'))
+    rows['franchise'] = write_parquet(franchise_table(rng), os.path.join(output_dir, 'pos', 'franchise'))
+    rows['location'] = write_parquet(location_table(), os.path.join(output_dir, 'pos', 'location'))
+    rows['menu'] = write_parquet(menu, os.path.join(output_dir, 'pos', 'menu'))
+    rows['truck'] = write_parquet(trucks, os.path.join(output_dir, 'pos', 'truck'))
+    customers = customer_count(order_lines)
+    rows['customer_loyalty'] = write_parquet(customer_loyalty_table(rng, customers), os.path.join(output_dir, 'customer', 'customer_loyalty'))
+    postal_codes, history = weather_tables(rng, days)
+    rows['postal_codes'] = write_parquet(postal_codes, os.path.join(output_dir, 'weather', 'postal_codes'))
+    rows['history_day'] = write_parquet(history, os.path.join(output_dir, 'weather', 'history_day'))
+
+    rows['order_header'] = rows['order_detail'] = 0
+    next_order_id, next_detail_id = 1, 1
+    for chunk, chunk_start in enumerate(range(0, order_lines, chunk_lines)):
+        lines = min(chunk_lines, order_lines - chunk_start)
+        header, detail, detail_years, header_years = order_chunk(rng, lines, next_order_id, next_detail_id, trucks, menu, days)
+        header = assign_customers(rng, header, customers)
+        next_order_id += len(header)
+        next_detail_id += len(detail)
+        for year in np.unique(header_years):
+            name = 'part-{:05d}'.format(chunk)
+            rows['order_header'] += write_parquet(header[header_years == year], os.path.join(output_dir, 'pos', 'order_header', 'year={}'.format(year)), name)
+            rows['order_detail'] += write_parquet(detail[detail_years == year], os.path.join(output_dir, 'pos', 'order_detail', 'year={}'.format(year)), name)
+
+    manifest = {"order_lines": order_lines, "seed": seed, "days": days, "rows": rows, \
+                "generate_seconds": round(time.time() - start, 3)}
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+# For local debugging
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate synthetic Tasty Bytes data as snappy parquet")
+    parser.add_argument('scale', help="Order lines to generate: one of {} or a number".format(", ".join(SCALE_FACTORS)))
+    parser.add_argument('--output', default=None, help="Output directory (default: benchmark_data/<scale>)")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    output = args.output or os.path.join('benchmark_data', args.scale)
+    print(json.dumps(generate(output, args.scale, seed=args.seed), indent=2))
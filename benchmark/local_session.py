@@ -0,0 +1,309 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       benchmark/local_session.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+# A Snowpark local testing session that can run the pipeline steps unchanged.
+#
+# Local testing evaluates DataFrames with pandas, but has no SQL, no streams and no
+# warehouse. The few statements the steps issue through session.sql() are emulated
+# here (see LocalSql), the functions local testing doesn't have are patched, and the
+# UDFs are registered from their Python handlers. Streams are plain tables that this
+# module keeps up to date (see LocalStreams); they only track appended rows, which
+# is all a benchmark run does. Dynamic tables are plain tables too, recomputed from
+# their query when they are refreshed (see LocalDynamicTables), and async writes run
+# right away (see LocalAsyncJob).
+
+import datetime
+import os
+import re
+import numpy as np
+import pandas as pd
+from snowflake.snowpark import Session, Row, DataFrame, DataFrameWriter
+import snowflake.snowpark.types as T
+import snowflake.snowpark.functions as F
+from snowflake.snowpark.mock import patch, ColumnEmulator, ColumnType
+
+STEPS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'steps')
+UDF_DIRECTORY = os.path.join(STEPS_DIRECTORY, '05_fahrenheit_to_celsius_udf', 'fahrenheit_to_celsius_udf')
+STREAM_METADATA_COLUMNS = ["METADATA$ACTION", "METADATA$ISUPDATE", "METADATA$ROW_ID"]
+COLUMN_TYPES = {'TIMESTAMP': T.TimestampType(), 'NUMBER': T.LongType()}
+
+
+@patch(F.hash)
+def mock_hash(*columns):
+    # Not Snowflake's HASH, but just as stable, which is all the change-aware merge needs
+    # Keep the rows' index, after a filter it no longer runs 0..n-1
+    values = pd.util.hash_pandas_object(pd.concat(columns, axis=1), index=False).astype('int64')
+    return ColumnEmulator(data=values.values, index=columns[0].index, sf_type=ColumnType(T.LongType(), False))
+
+@patch("avg")
+def mock_avg(column):
+    # UDFs called by name (F.call_udf) have no return type in local testing, and the built-in
+    # avg refuses untyped columns. The pipeline only averages floats, so this returns a double.
+    values = pd.to_numeric(pd.Series(column, dtype=object), errors='coerce').dropna()
+    return ColumnEmulator(data=[float(values.mean()) if len(values) else None], sf_type=ColumnType(T.DoubleType(), True))
+
+@patch("round")
+def mock_round(column, scale=0):
+    # Snowflake rounds half away from zero
+    if isinstance(scale, pd.Series):
+        scale = scale.iloc[0] if len(scale) else 0
+    scale = int(scale)
+    values = pd.to_numeric(pd.Series(column, dtype=object), errors='coerce')
+    factor = 10.0 ** scale
+    rounded = np.sign(values) * np.floor(np.abs(values) * factor + 0.5) / factor
+    return ColumnEmulator(data=rounded.astype(object).where(values.notna(), None).values, sf_type=ColumnType(T.DoubleType(), True))
+
+@patch("zeroifnull")
+def mock_zeroifnull(column):
+    result = column.fillna(0)
+    result.sf_type = ColumnType(column.sf_type.datatype, False)
+    return result
+
+@patch("date_trunc")
+def mock_date_trunc(part, column):
+    # The built-in one fails on an empty column (the rollups start out empty). The pipeline only
+    # truncates dates to weeks (starting Monday, Snowflake's default) and months
+    part = part.lower()
+    if part not in ('week', 'month'):
+        raise NotImplementedError("date_trunc is only emulated for weeks and months, not {}".format(part))
+    def truncate(value):
+        if value is None or pd.isna(value):
+            return None
+        return value - datetime.timedelta(days=value.weekday()) if part == 'week' else value.replace(day=1)
+    return ColumnEmulator(data=pd.Series(column, dtype=object).map(truncate).values, sf_type=column.sf_type)
+
+
+def unquote(name):
+    return name.replace('"', '')
+
+def qualified_name(session, name):
+    # Schema-qualified name, resolved against the current schema like Snowflake does
+    return name if '.' in name else "{}.{}".format(unquote(session.get_current_schema()), name)
+
+
+class LocalStreams:
+    def __init__(self, session):
+        self.session = session
+        self.streams = {}
+
+    def create(self, name, source, show_initial_rows=False):
+        offset = 0 if show_initial_rows else self.session.table(source).count()
+        self.streams[name] = {"source": source, "offset": offset}
+        self.refresh(name)
+
+    def refresh(self, name=None):
+        # Puts the rows added to the source since the stream was last consumed in the stream
+        for stream_name in ([name] if name else list(self.streams)):
+            stream = self.streams[stream_name]
+            source = self.session.table(stream['source'])
+            rows = source.to_pandas().iloc[stream['offset']:].reset_index(drop=True)
+            rows["METADATA$ACTION"] = 'INSERT'
+            rows["METADATA$ISUPDATE"] = False
+            rows["METADATA$ROW_ID"] = (rows.index + stream['offset']).astype(str)
+            schema = T.StructType([*source.schema.fields, T.StructField("METADATA$ACTION", T.StringType()), \
+                                   T.StructField("METADATA$ISUPDATE", T.BooleanType()), T.StructField("METADATA$ROW_ID", T.StringType())])
+            data = rows if len(rows) else [[None] * len(schema.names)]
+            df = self.session.create_dataframe(data, schema=schema)
+            if not len(rows):
+                df = df.filter(F.lit(False))
+            df.write.mode('overwrite').save_as_table(stream_name)
+
+    def consume(self, name):
+        # What a DML statement reading the stream does: move its offset to the current end of the source
+        stream = self.streams[name]
+        stream['offset'] = self.session.table(stream['source']).count()
+        self.refresh(name)
+
+    def rows(self, name):
+        return self.session.table(name).count()
+
+
+def is_local_session(session):
+    # A session from create_local_session()
+    return isinstance(session.sql, LocalSql)
+
+
+class LocalDynamicTables:
+    def __init__(self, session):
+        self.session = session
+        self.queries = {}
+
+    def create(self, df, name):
+        # Like initialize='ON_CREATE': the table is filled right away. The warehouse, lag,
+        # refresh mode and clustering don't exist locally
+        self.queries[name] = df
+        self.refresh(name)
+
+    def refresh(self, name):
+        self.queries[name].write.mode('overwrite').save_as_table(name)
+
+_create_or_replace_dynamic_table = DataFrame.create_or_replace_dynamic_table
+
+def create_or_replace_dynamic_table(df, name, *args, **kwargs):
+    # Local testing doesn't have dynamic tables; on a local session they are emulated
+    if not is_local_session(df._session):
+        return _create_or_replace_dynamic_table(df, name, *args, **kwargs)
+    df._session.local_dynamic_tables.create(df, qualified_name(df._session, name))
+
+DataFrame.create_or_replace_dynamic_table = create_or_replace_dynamic_table
+
+class LocalAsyncJob:
+    # A job that already ran: local testing has no async queries, so block=False runs them right away
+    def __init__(self, result):
+        self._result = result
+
+    def is_done(self):
+        return True
+
+    def result(self):
+        return self._result
+
+_save_as_table = DataFrameWriter.save_as_table
+
+def save_as_table(writer, *args, block=True, **kwargs):
+    if block or not is_local_session(writer._dataframe._session):
+        return _save_as_table(writer, *args, block=block, **kwargs)
+    return LocalAsyncJob(_save_as_table(writer, *args, **kwargs))
+
+DataFrameWriter.save_as_table = save_as_table
+
+
+class LocalSql:
+    # Emulates the statements the steps send through session.sql(); anything else raises
+    # NotImplementedError, so new SQL in a step shows up here instead of being skipped
+    def __init__(self, session, streams):
+        self.session = session
+        self.streams = streams
+        self.statements = []
+        # DataFrame actions run to emulate the statements, see count_queries()
+        self.emulation_queries = 0
+        self.handlers = [
+            (r"SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA\.COLUMNS WHERE TABLE_SCHEMA IN \(([^)]*)\)(?: ORDER BY ORDINAL_POSITION)?", self.information_schema_columns),
+            (r"CREATE (?:OR REPLACE )?STREAM (\S+) ON (?:VIEW|TABLE|DYNAMIC TABLE) (\S+)( SHOW_INITIAL_ROWS = TRUE)?", self.create_stream),
+            (r"CREATE TABLE (\S+) LIKE (\S+)", self.create_table_like),
+            (r"ALTER TABLE (\S+) ADD COLUMN (\S+) (\w+)", self.add_column),
+            (r"ALTER TABLE (\S+) SWAP WITH (\S+)", self.swap_tables),
+            (r"ALTER TABLE \S+ CLUSTER BY .*", self.no_op),
+            (r"ALTER DYNAMIC TABLE (\S+) REFRESH", self.refresh_dynamic_table),
+            (r"ALTER WAREHOUSE .*", self.no_op),
+            (r"(?:BEGIN|COMMIT|ROLLBACK)", self.no_op),
+            (r"SHOW VIEWS LIKE '([^']+)' IN SCHEMA (\S+)", self.show_views),
+            (r"SHOW STREAMS LIKE '([^']+)' IN SCHEMA (\S+)", self.show_streams),
+            (r"SELECT SYSTEM\$STREAM_HAS_DATA\('([^']+)'\) AS HAS_DATA((?:, \(SELECT ROW_COUNT FROM INFORMATION_SCHEMA\.TABLES WHERE [^)]*\) AS \w+)*)", \
+             self.stream_has_data),
+        ]
+
+    def __call__(self, query, params=None):
+        statement = " ".join(query.split())
+        for pattern, handler in self.handlers:
+            match = re.fullmatch(pattern, statement, flags=re.IGNORECASE)
+            if match:
+                return LocalResult(lambda: handler(*match.groups()), self, statement)
+        raise NotImplementedError("Local testing has no SQL, and this statement is not emulated: {}".format(statement))
+
+    def information_schema_columns(self, schemas):
+        wanted = {unquote(s.strip().strip("'")) for s in schemas.split(',')}
+        registry = self.session._conn.entity_registry
+        rows = []
+        for name in [*registry.table_registry.keys(), *registry.view_registry.keys()]:
+            _, schema, table = unquote(name).split('.')
+            if schema in wanted:
+                rows += [Row(TABLE_SCHEMA=schema, TABLE_NAME=table, COLUMN_NAME=c) for c in self.session.table(name).columns]
+        return rows
+
+    def show_views(self, name, schema):
+        views = [unquote(v).split('.') for v in self.session._conn.entity_registry.view_registry.keys()]
+        return [Row(name=v[2], schema_name=v[1]) for v in views if v[1:] == [unquote(schema).upper(), name.upper()]]
+
+    def show_streams(self, name, schema):
+        stream = "{}.{}".format(unquote(schema), name).upper()
+        # Local streams never go stale
+        return [Row(name=name.upper(), schema_name=unquote(schema).upper(), stale='false')] if stream in self.streams.streams else []
+
+    def stream_has_data(self, name, row_counts):
+        # Also answers the ROW_COUNT subqueries that follow it, NULL for tables that don't exist
+        row = {"HAS_DATA": self.session.table(qualified_name(self.session, name)).limit(1).count() > 0}
+        tables = {unquote(t) for t in self.session._conn.entity_registry.table_registry.keys()}
+        for schema, table, column in re.findall(r"TABLE_SCHEMA = '(\w+)' AND TABLE_NAME = '(\w+)'\) AS (\w+)", row_counts):
+            name = "{}.{}.{}".format(unquote(self.session.get_current_database()), schema, table)
+            row[column] = self.session.table(name).count() if name in tables else None
+        return [Row(**row)]
+
+    def create_stream(self, name, source, show_initial_rows):
+        self.streams.create(qualified_name(self.session, name), qualified_name(self.session, source), bool(show_initial_rows))
+        return []
+
+    def create_table_like(self, name, source):
+        schema = self.session.table(qualified_name(self.session, source)).schema
+        self.session.create_dataframe([[None] * len(schema.names)], schema=schema).filter(F.lit(False)) \
+                    .write.mode('errorifexists').save_as_table(qualified_name(self.session, name))
+        return []
+
+    def add_column(self, name, column, column_type):
+        table = self.session.table(qualified_name(self.session, name))
+        table.with_column(column, F.lit(None).cast(COLUMN_TYPES[column_type.upper()])) \
+                    .write.mode('overwrite').save_as_table(qualified_name(self.session, name))
+        return []
+
+    def swap_tables(self, name, other):
+        name, other = qualified_name(self.session, name), qualified_name(self.session, other)
+        swap = name + '_SWAP'
+        self.session.table(name).write.mode('overwrite').save_as_table(swap)
+        self.session.table(other).write.mode('overwrite').save_as_table(name)
+        self.session.table(swap).write.mode('overwrite').save_as_table(other)
+        self.session.table(swap).drop_table()
+        return []
+
+    def refresh_dynamic_table(self, name):
+        self.session.local_dynamic_tables.refresh(qualified_name(self.session, name))
+        return []
+
+    def no_op(self, *args):
+        # Clustering, warehouse sizes and transactions don't exist in local testing
+        return []
+
+class LocalResult:
+    def __init__(self, run, sql, statement):
+        self.run = run
+        self.sql = sql
+        self.statement = statement
+
+    def collect(self, *args, **kwargs):
+        self.sql.statements.append(self.statement)
+        with self.sql.session.query_history() as history:
+            rows = self.run()
+        self.sql.emulation_queries += len(history.queries)
+        return rows
+
+
+def count_queries(session, run):
+    # Statements sent through session.sql() plus DataFrame actions, leaving out the ones LocalSql
+    # runs to emulate a statement (and the describe queries local testing doesn't have)
+    statements, emulation_queries = len(session.sql.statements), session.sql.emulation_queries
+    with session.query_history() as history:
+        run()
+    return len(session.sql.statements) - statements + len(history.queries) - (session.sql.emulation_queries - emulation_queries)
+
+
+def register_udfs(session):
+    # Local testing runs UDFs row by row, so the scalar handlers are registered
+    import sys
+    sys.path.insert(0, UDF_DIRECTORY)
+    import function
+    session.udf.register(function.main, name='ANALYTICS.FAHRENHEIT_TO_CELSIUS_UDF', \
+                         return_type=T.FloatType(), input_types=[T.FloatType()])
+    # INCH_TO_MILLIMETER_UDF is a SQL UDF in Snowflake (01_setup_snowflake.sql)
+    session.udf.register(function.inch_to_millimeter, name='ANALYTICS.INCH_TO_MILLIMETER_UDF', \
+                         return_type=T.FloatType(), input_types=[T.FloatType()])
+
+def create_local_session():
+    session = Session.builder.config('local_testing', True).create()
+    streams = LocalStreams(session)
+    session.local_dynamic_tables = LocalDynamicTables(session)
+    session.sql = LocalSql(session, streams)
+    register_udfs(session)
+    return session, streams
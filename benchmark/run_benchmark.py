@@ -0,0 +1,365 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       benchmark/run_benchmark.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+# Scale benchmark for the pipeline, in Snowpark local testing mode:
+#
+#   generate        synthetic data for the scale factor (generate_data.py)
+#   load_raw        the parquet files into the RAW_POS / RAW_CUSTOMER / weather tables
+#   create_pos_view 04_create_pos_view.py (the stream's initial rows evaluate the view)
+#   orders_update   06_orders_update_sp main()
+#   daily_city_metrics_update  07_daily_city_metrics_update_sp main()
+#
+# Each scale factor runs in its own process, so peak RSS is per scale factor. The
+# results are compared with a baseline file and the run fails when a stage got slower
+# or bigger than the tolerance allows. Local testing evaluates everything with pandas
+# in one process, so the numbers track the Python side of each step, not warehouse
+# time. It also evaluates joins as a cross product followed by a filter, so the view
+# step grows with the square of the data: 1k order lines take minutes and 10k is out
+# of reach. The default scale factors stay small for that reason.
+#
+# The curve from 1k to 100M order lines is measured in a real account instead, with
+# --snowflake: the generated files are PUT to an internal stage and COPYed into a
+# database of their own (--database), and the steps run there unchanged. The steps read
+# the weather from FROSTBYTE_WEATHERSOURCE.ONPOINT_ID, so the synthetic weather goes
+# into a FROSTBYTE_WEATHERSOURCE database too; use an account without the Weather
+# Source share. Both databases are replaced for every scale factor, so the benchmark
+# refuses to touch databases it didn't create. The steps resize HOL_WH as usual. Peak
+# RSS is only the client's in this mode.
+#
+# --snowflake is experimental: it hasn't been measured in an account yet, so it has no
+# baseline and isn't part of the regression check. Its results are printed and written
+# to --output only.
+#
+#   python benchmark/run_benchmark.py
+#   python benchmark/run_benchmark.py 250 500 1k --update-baseline
+#   python benchmark/run_benchmark.py --snowflake 1k 100k 10m 100m
+
+import importlib.util
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import pandas as pd
+import snowflake.snowpark.types as T
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIRECTORY)
+from generate_data import generate, scale_rows
+from local_session import create_local_session, STEPS_DIRECTORY, UDF_DIRECTORY
+
+DEFAULT_SCALES = ['250', '500', '1k']
+DATA_DIRECTORY = 'benchmark_data'
+BASELINE_FILE = os.path.join(BENCHMARK_DIRECTORY, 'baseline.json')
+SNOWFLAKE_SCALES = ['1k', '100k', '10m', '100m']
+SNOWFLAKE_DATABASE = 'HOL_BENCHMARK_DB'
+WEATHER_DATABASE = 'FROSTBYTE_WEATHERSOURCE'
+BENCHMARK_SCHEMAS = ['RAW_POS', 'RAW_CUSTOMER', 'HARMONIZED', 'ANALYTICS']
+BENCHMARK_STAGE = 'PUBLIC.BENCHMARK_STAGE'
+# Marks the databases the benchmark created, and may replace
+BENCHMARK_COMMENT = 'snowpark_de_hol benchmark data'
+RESULTS_FILE = 'benchmark_results.json'
+TOLERANCE = 0.25
+# Differences below this are noise at the small scale factors
+MIN_REGRESSION_SECONDS = 0.5
+MIN_REGRESSION_RSS_MB = 50
+POS_FLATTENED_V_STREAM = 'HARMONIZED.POS_FLATTENED_V_STREAM'
+ORDERS_STREAM = 'HARMONIZED.ORDERS_STREAM'
+
+# Where the generated files go, matching the tables 02_load_raw.py and 03_load_weather.sql create
+RAW_TABLES = {'pos/country': 'RAW_POS.COUNTRY', 'pos/franchise': 'RAW_POS.FRANCHISE', 'pos/location': 'RAW_POS.LOCATION', \
+              'pos/menu': 'RAW_POS.MENU', 'pos/truck': 'RAW_POS.TRUCK', 'pos/order_header': 'RAW_POS.ORDER_HEADER', \
+              'pos/order_detail': 'RAW_POS.ORDER_DETAIL', 'customer/customer_loyalty': 'RAW_CUSTOMER.CUSTOMER_LOYALTY', \
+              'weather/postal_codes': 'FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.POSTAL_CODES', \
+              'weather/history_day': 'FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.HISTORY_DAY'}
+
+
+def load_step(module_name, relative_path):
+    # The step scripts start with a number, so they can't be imported by name
+    if STEPS_DIRECTORY not in sys.path:
+        sys.path.insert(0, STEPS_DIRECTORY)
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(STEPS_DIRECTORY, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def load_raw_tables(session, data_directory, folders=None):
+    # folders limits the load to some of the RAW_TABLES folders
+    rows = 0
+    for folder, table in RAW_TABLES.items():
+        if folders is not None and folder not in folders:
+            continue
+        # Reading a year= partitioned folder adds the partition as a column, which COPY doesn't
+        df = pd.read_parquet(os.path.join(data_directory, folder))
+        df = df.drop(columns=['year'], errors='ignore')
+        # Local testing infers types value by value, and doesn't know pandas' NA
+        df = df.astype(object).where(df.notna(), None)
+        session.create_dataframe(df).write.mode('overwrite').save_as_table(table)
+        rows += len(df)
+    return rows
+
+def check_rows(table, actual, expected):
+    # A step that silently processed nothing would otherwise look like a speedup
+    if actual == 0 or (expected is not None and actual != expected):
+        raise Exception("{} has {} rows, expected {}".format(table, actual, expected or 'some'))
+
+def pipeline_stages(session, load, streams=None):
+    # The stages after generate, as (name, function) pairs returning the rows they processed;
+    # streams is the LocalStreams of a local session
+    create_pos_view = load_step('create_pos_view', '04_create_pos_view.py')
+    orders_update_sp = load_step('orders_update_sp', '06_orders_update_sp/orders_update_sp/procedure.py')
+    daily_city_metrics_update_sp = load_step('daily_city_metrics_update_sp', '07_daily_city_metrics_update_sp/daily_city_metrics_update_sp/procedure.py')
+
+    def stream_rows(name):
+        # Counting a stream doesn't consume it
+        return streams.rows(name) if streams else session.table(name).count()
+
+    def create_pos_view_and_stream():
+        create_pos_view.create_pos_view(session)
+        create_pos_view.create_pos_view_stream(session)
+        return stream_rows(POS_FLATTENED_V_STREAM)
+
+    def orders_update():
+        rows = stream_rows(POS_FLATTENED_V_STREAM)
+        orders_update_sp.main(session)
+        if streams:
+            # The MERGE read the stream, and ORDERS_STREAM now sees the merged rows
+            streams.consume(POS_FLATTENED_V_STREAM)
+            streams.refresh(ORDERS_STREAM)
+        check_rows('HARMONIZED.ORDERS', session.table('HARMONIZED.ORDERS').count(), rows)
+        return rows
+
+    def daily_city_metrics_update():
+        rows = stream_rows(ORDERS_STREAM)
+        daily_city_metrics_update_sp.main(session)
+        if streams:
+            streams.consume(ORDERS_STREAM)
+        check_rows('ANALYTICS.DAILY_CITY_METRICS', session.table('ANALYTICS.DAILY_CITY_METRICS').count(), None)
+        return rows
+
+    def check_rollups():
+        # Not timed: the rollups the daily step maintains have to match a full recompute
+        if not daily_city_metrics_update_sp.check_rollups(session):
+            raise Exception("CITY_METRICS rollups don't match a full recompute")
+
+    return [('load_raw', load), \
+            ('create_pos_view', create_pos_view_and_stream), \
+            ('orders_update', orders_update), \
+            ('daily_city_metrics_update', daily_city_metrics_update)], check_rollups
+
+def time_stages(stages):
+    results = {}
+    for name, stage in stages:
+        start = time.time()
+        rows = stage()
+        results[name] = stage_result(time.time() - start, rows)
+    return results
+
+def run_stages(data_directory):
+    session, streams = create_local_session()
+    stages, check_rollups = pipeline_stages(session, lambda: load_raw_tables(session, data_directory), streams)
+    results = time_stages(stages)
+    check_rollups()
+    session.close()
+    return results
+
+def check_benchmark_database(session, database):
+    # Every scale factor replaces the benchmark databases, so never touch one the benchmark didn't create
+    rows = session.sql("SHOW DATABASES LIKE '{}'".format(database)).collect()
+    if rows and rows[0]['comment'] != BENCHMARK_COMMENT:
+        raise Exception("{} exists and wasn't created by the benchmark; use another --database, or an account " \
+                        "without it (the Weather Source share in particular)".format(database))
+
+def reset_benchmark_databases(session, database):
+    for name in [database, WEATHER_DATABASE]:
+        check_benchmark_database(session, name)
+    for name in [database, WEATHER_DATABASE]:
+        _ = session.sql("CREATE OR REPLACE DATABASE {} COMMENT = '{}'".format(name, BENCHMARK_COMMENT)).collect()
+    _ = session.sql("CREATE SCHEMA {}.ONPOINT_ID".format(WEATHER_DATABASE)).collect()
+    for schema in BENCHMARK_SCHEMAS:
+        _ = session.sql("CREATE SCHEMA {}.{}".format(database, schema)).collect()
+    _ = session.sql("CREATE STAGE {}.{}".format(database, BENCHMARK_STAGE)).collect()
+    session.use_database(database)
+
+def create_benchmark_udfs(session, database):
+    # The UDFs 07_daily_city_metrics_update_sp calls, as 01_setup_snowflake.sql and 05_fahrenheit_to_celsius_udf create them
+    session.udf.register_from_file(os.path.join(UDF_DIRECTORY, 'function.py'), 'main', name='{}.ANALYTICS.FAHRENHEIT_TO_CELSIUS_UDF'.format(database), \
+                                   return_type=T.FloatType(), input_types=[T.FloatType()], packages=['numpy', 'pandas'], \
+                                   imports=[os.path.join(UDF_DIRECTORY, 'conversions.py')], is_permanent=True, \
+                                   stage_location='@{}.{}'.format(database, BENCHMARK_STAGE), replace=True)
+    _ = session.sql("""CREATE OR REPLACE FUNCTION {}.ANALYTICS.INCH_TO_MILLIMETER_UDF(INCH NUMBER(35,4))
+                        RETURNS NUMBER(35,4)
+                        AS 'inch * 25.4'""".format(database)).collect()
+
+def upload_raw_files(session, data_directory, database):
+    # One PUT per folder, into the same layout on the stage
+    files = 0
+    for folder in RAW_TABLES:
+        for root, _, names in os.walk(os.path.join(data_directory, folder)):
+            parquet = [n for n in names if n.endswith('.parquet')]
+            if not parquet:
+                continue
+            relative = os.path.relpath(root, data_directory).replace(os.sep, '/')
+            session.file.put(os.path.join(root, '*.parquet'), '@{}.{}/{}'.format(database, BENCHMARK_STAGE, relative), \
+                             auto_compress=False, overwrite=True)
+            files += len(parquet)
+    return files
+
+def copy_raw_tables(session, database):
+    # Like load_raw_table() in 02_load_raw.py, from the benchmark stage
+    rows = 0
+    for folder, table in RAW_TABLES.items():
+        df = session.read.option("compression", "snappy").parquet('@{}.{}/{}'.format(database, BENCHMARK_STAGE, folder))
+        copy_results = df.copy_into_table(table)
+        rows += sum(int(r.as_dict().get('rows_loaded', 0) or 0) for r in (copy_results or []))
+    return rows
+
+def run_snowflake_scale(session, scale, data_root=DATA_DIRECTORY, database=SNOWFLAKE_DATABASE, seed=42):
+    data_directory = os.path.join(data_root, scale)
+    start = time.time()
+    manifest = generate(data_directory, scale, seed=seed)
+    results = {"generate": stage_result(time.time() - start, manifest['order_lines'])}
+
+    reset_benchmark_databases(session, database)
+    create_benchmark_udfs(session, database)
+    start = time.time()
+    upload_raw_files(session, data_directory, database)
+    results["upload"] = stage_result(time.time() - start, manifest['order_lines'])
+    stages, check_rollups = pipeline_stages(session, lambda: copy_raw_tables(session, database))
+    results.update(time_stages(stages))
+    check_rollups()
+    return results
+
+def stage_result(seconds, rows):
+    rows = int(rows) if rows is not None else None
+    return {"seconds": round(seconds, 3), "rows": rows, \
+            "rows_per_second": round(rows / seconds) if rows and seconds > 0 else None, \
+            "peak_rss_mb": peak_rss_mb()}
+
+def run_scale(scale, data_root=DATA_DIRECTORY, seed=42):
+    data_directory = os.path.join(data_root, scale)
+    start = time.time()
+    manifest = generate(data_directory, scale, seed=seed)
+    results = {"generate": stage_result(time.time() - start, manifest['order_lines'])}
+
+    # A fresh process per scale factor, so peak RSS isn't carried over from the last one
+    worker = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', data_directory], \
+                            capture_output=True, text=True)
+    if worker.returncode != 0:
+        raise Exception("Benchmark for {} failed:\n{}".format(scale, worker.stderr[-4000:]))
+    results.update(json.loads(worker.stdout.strip().splitlines()[-1]))
+    return results
+
+def print_results(results):
+    print("{:>6}  {:<26} {:>9} {:>11} {:>12} {:>9}".format('scale', 'stage', 'seconds', 'rows', 'rows/s', 'RSS MB'))
+    for scale, stages in results.items():
+        for stage, r in stages.items():
+            print("{:>6}  {:<26} {:>9.3f} {:>11} {:>12} {:>9.1f}".format(scale, stage, r['seconds'], r['rows'] or '', \
+                                                                       r['rows_per_second'] or '', r['peak_rss_mb']))
+
+def print_scaling(results):
+    # How time grows with the data: 1.0 is linear, above 1.0 is worse than linear
+    scales = sorted(results, key=scale_rows)
+    if len(scales) < 2:
+        return
+    print("\nScaling exponent per stage ({}):".format(" -> ".join(scales)))
+    for stage in results[scales[0]]:
+        exponents = []
+        for small, large in zip(scales, scales[1:]):
+            t_small, t_large = results[small][stage]['seconds'], results[large][stage]['seconds']
+            if t_small > 0 and t_large > 0:
+                exponents.append("{:.2f}".format(math.log(t_large / t_small) / math.log(scale_rows(large) / scale_rows(small))))
+        print("\t{:<26} {}".format(stage, "  ".join(exponents)))
+
+def read_baseline(baseline_path):
+    if not os.path.exists(baseline_path):
+        return None
+    with open(baseline_path) as f:
+        return json.load(f)
+
+def write_baseline(results, baseline_path):
+    baseline = read_baseline(baseline_path) or {"results": {}}
+    baseline["machine"] = {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()}
+    baseline["results"].update(results)
+    with open(baseline_path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+def compare_with_baseline(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for scale, stages in results.items():
+        for stage, r in stages.items():
+            base = baseline["results"].get(scale, {}).get(stage)
+            if base is None:
+                continue
+            if r['seconds'] > base['seconds'] * (1 + tolerance) and r['seconds'] - base['seconds'] > MIN_REGRESSION_SECONDS:
+                regressions.append("{} {}: {:.3f}s vs {:.3f}s".format(scale, stage, r['seconds'], base['seconds']))
+            if r['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance) and r['peak_rss_mb'] - base['peak_rss_mb'] > MIN_REGRESSION_RSS_MB:
+                regressions.append("{} {}: {:.1f}MB vs {:.1f}MB peak RSS".format(scale, stage, r['peak_rss_mb'], base['peak_rss_mb']))
+    return regressions
+
+
+# For local debugging
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--worker']:
+        # Local testing warns a lot about pandas behaviour, which only matters if the worker fails
+        import warnings
+        warnings.simplefilter('ignore')
+        print(json.dumps(run_stages(sys.argv[2])))
+        sys.exit(0)
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data in Snowpark local testing mode")
+    parser.add_argument('scales', nargs='*', help="Scale factors (1k ... 100m, or a number of order lines)")
+    parser.add_argument('--data', default=DATA_DIRECTORY, help="Where the generated data is kept between runs")
+    parser.add_argument('--baseline', help="Baseline file to compare with")
+    parser.add_argument('--update-baseline', action='store_true', help="Write these results to the baseline file")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="Allowed slowdown/growth before it counts as a regression")
+    parser.add_argument('--output', default=RESULTS_FILE, help="Where to write the results")
+    parser.add_argument('--snowflake', action='store_true', \
+                        help="Experimental: run in the account of the default connection instead of locally, without a baseline")
+    parser.add_argument('--database', default=SNOWFLAKE_DATABASE, help="Database to load the data into with --snowflake")
+    args = parser.parse_args()
+    if args.snowflake and (args.baseline or args.update_baseline):
+        parser.error("--snowflake is experimental and has no baseline")
+
+    if args.snowflake:
+        from snowflake.snowpark import Session
+        with Session.builder.getOrCreate() as session:
+            results = {scale: run_snowflake_scale(session, scale, data_root=args.data, database=args.database) \
+                       for scale in args.scales or SNOWFLAKE_SCALES}
+    else:
+        args.baseline = args.baseline or BASELINE_FILE
+        results = {scale: run_scale(scale, data_root=args.data) for scale in args.scales or DEFAULT_SCALES}
+    print_results(results)
+    print_scaling(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.snowflake:
+        print("\nExperimental --snowflake run, not compared with a baseline")
+        sys.exit(0)
+
+    if args.update_baseline:
+        write_baseline(results, args.baseline)
+        print("\nBaseline written to {}".format(args.baseline))
+        sys.exit(0)
+    baseline = read_baseline(args.baseline)
+    if baseline is None:
+        print("\nNo baseline at {}, run with --update-baseline to create one".format(args.baseline))
+        sys.exit(0)
+    regressions = compare_with_baseline(results, baseline, tolerance=args.tolerance)
+    print("\n{} regression(s) against {}".format(len(regressions), args.baseline))
+    for regression in regressions:
+        print("\t" + regression)
+    sys.exit(1 if regressions else 0)
@@ -1,51 +1,236 @@
 import sys
 import os
+import hashlib
+import json
+import subprocess
+import time
+import fnmatch
+import argparse
+import tempfile
+import shutil
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 
-ignore_folders = ['.git', '__pycache__', '.ipynb_checkpoints']
 snowflake_project_config_filename = 'snowflake.yml'
+deploy_state_filename = '.snowpark_deploy_state.json'
+max_parallel_deploys = int(os.environ.get('SNOWPARK_DEPLOY_WORKERS', '4'))
 
-if len(sys.argv) != 2:
-    print("Root directory is required")
-    exit()
-
-root_directory = sys.argv[1]
-print(f"Deploying all Snowpark apps in root directory {root_directory}")
-
-# Walk the entire directory structure recursively
-for (directory_path, directory_names, file_names) in os.walk(root_directory):
-    # Get just the last/final folder name in the directory path
-    base_name = os.path.basename(directory_path)
-
-    # Skip any folders we want to ignore
-    # TODO: Update this logic to skip all subfolders of ignored folder
-    if base_name in ignore_folders:
-#        print(f"Skipping ignored folder {directory_path}")
-        continue
-
-    # An snowflake.yml file in the folder is our indication that this folder contains
-    # a Snow CLI project
-    if not snowflake_project_config_filename in file_names:
-#        print(f"Skipping non-app folder {directory_path}")
-        continue
-    print(f"Found Snowflake project in folder {directory_path}")
-
-    # Read the project config
-    project_settings = {}
-    with open(f"{directory_path}/{snowflake_project_config_filename}", "r") as yamlfile:
-        project_settings = yaml.load(yamlfile, Loader=yaml.FullLoader)
-
-    # Confirm that this is a Snowpark project
-    # TODO: Would be better if the project config file had a project_type key!
-    if 'snowpark' not in project_settings:
-        print(f"Skipping non Snowpark project in folder {base_name}")
-        continue
-
-    # Finally deploy the Snowpark project with the snowcli tool
-    print(f"Found Snowflake Snowpark project '{project_settings['snowpark']['project_name']}' in folder {base_name}")
-    print(f"Calling snowcli to deploy the project")
-    os.chdir(f"{directory_path}")
-    # Make sure all 6 SNOWFLAKE_ environment variables are set
-    # SnowCLI accesses the passowrd directly from the SNOWFLAKE_PASSWORD environmnet variable
-    os.system(f"snow snowpark build --temporary-connection --account $SNOWFLAKE_ACCOUNT --user $SNOWFLAKE_USER --role $SNOWFLAKE_ROLE --warehouse $SNOWFLAKE_WAREHOUSE --database $SNOWFLAKE_DATABASE")
-    os.system(f"snow snowpark deploy --replace --temporary-connection --account $SNOWFLAKE_ACCOUNT --user $SNOWFLAKE_USER --role $SNOWFLAKE_ROLE --warehouse $SNOWFLAKE_WAREHOUSE --database $SNOWFLAKE_DATABASE")
+# Make sure all 6 SNOWFLAKE_ environment variables are set
+# SnowCLI accesses the passowrd directly from the SNOWFLAKE_PASSWORD environmnet variable
+snow_connection_args = ['--temporary-connection',
+                        '--account', os.environ.get('SNOWFLAKE_ACCOUNT', ''),
+                        '--user', os.environ.get('SNOWFLAKE_USER', ''),
+                        '--role', os.environ.get('SNOWFLAKE_ROLE', ''),
+                        '--warehouse', os.environ.get('SNOWFLAKE_WAREHOUSE', ''),
+                        '--database', os.environ.get('SNOWFLAKE_DATABASE', '')]
+
+
+# Folders are pruned when any of these globs (or a pattern from a .gitignore in one of
+# the parent folders) matches them, so we never descend into them
+default_ignore_globs = ['.git', '__pycache__', '.ipynb_checkpoints', '.packages', '.venv', 'node_modules']
+ignore_globs = default_ignore_globs + [g for g in os.environ.get('SNOWPARK_DEPLOY_IGNORE', '').split(',') if g]
+
+
+def read_gitignore_patterns(directory_path):
+    # Only simple name/path patterns are supported, negations (!) are skipped
+    patterns = []
+    gitignore_path = os.path.join(directory_path, '.gitignore')
+    if os.path.isfile(gitignore_path):
+        with open(gitignore_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#') and not line.startswith('!'):
+                    patterns.append(line.rstrip('/'))
+    return patterns
+
+def is_ignored(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def discover_project_folders(root_directory):
+    # Walks the tree, pruning ignored folders so we never descend into them. Each folder is
+    # listed once with scandir, which also tells files and folders apart without a stat.
+    # (Caching folder listings between runs doesn't pay off: checking whether a folder
+    # changed costs as much as listing it, and CI checkouts reset every mtime anyway.)
+    project_folders = []
+    # Each pending folder carries the ignore patterns inherited from its parents
+    pending = [(root_directory, ignore_globs)]
+    while pending:
+        directory_path, patterns = pending.pop()
+        directory_names, file_names = [], []
+        with os.scandir(directory_path) as entries:
+            for e in entries:
+                (directory_names if e.is_dir(follow_symlinks=False) else file_names).append(e.name)
+        if '.gitignore' in file_names:
+            patterns = patterns + read_gitignore_patterns(directory_path)
+
+        # An snowflake.yml file in the folder is our indication that this folder contains
+        # a Snow CLI project
+        if snowflake_project_config_filename in file_names:
+            project_folders.append(directory_path)
+        for directory_name in sorted(directory_names, reverse=True):
+            if not is_ignored(directory_name, patterns):
+                pending.append((os.path.join(directory_path, directory_name), patterns))
+    return sorted(project_folders)
+
+def find_snowpark_projects(root_directory):
+    projects = []
+    for directory_path in discover_project_folders(root_directory):
+        print(f"Found Snowflake project in folder {directory_path}")
+        base_name = os.path.basename(directory_path)
+
+        # Read the project config
+        with open(os.path.join(directory_path, snowflake_project_config_filename), "r") as yamlfile:
+            project_settings = yaml.safe_load(yamlfile) or {}
+
+        # Confirm that this is a Snowpark project
+        # TODO: Would be better if the project config file had a project_type key!
+        if 'snowpark' not in project_settings:
+            print(f"Skipping non Snowpark project in folder {base_name}")
+            continue
+
+        print(f"Found Snowflake Snowpark project '{project_settings['snowpark']['project_name']}' in folder {base_name}")
+        projects.append({'path': directory_path, 'settings': project_settings['snowpark']})
+    return projects
+
+
+# Only projects whose source, requirements or config changed since the last successful
+# deploy to the same account and database are built and deployed again
+
+def project_hash(project):
+    digest = hashlib.sha256()
+    paths = [os.path.join(project['path'], snowflake_project_config_filename),
+             os.path.join(project['path'], 'requirements.txt')]
+    src_directory = os.path.join(project['path'], project['settings']['src'])
+    for (directory_path, directory_names, file_names) in os.walk(src_directory):
+        directory_names[:] = sorted(d for d in directory_names if not is_ignored(d, ignore_globs))
+        paths.extend(os.path.join(directory_path, f) for f in sorted(file_names))
+
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        digest.update(os.path.relpath(path, project['path']).replace(os.sep, '/').encode('utf-8'))
+        with open(path, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+def deploy_target():
+    # What was deployed where is remembered per account and database, so deploying to another
+    # database (or after dropping this one) deploys everything again
+    return f"{os.environ.get('SNOWFLAKE_ACCOUNT', '')}/{os.environ.get('SNOWFLAKE_DATABASE', '')}".upper()
+
+def read_deploy_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as f:
+        state = json.load(f)
+    # State files from before the deploy target was recorded map projects straight to hashes
+    return {target: projects for target, projects in state.items() if isinstance(projects, dict)}
+
+def write_deploy_state(state, state_path):
+    with open(state_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def run_snow(args, cwd):
+    # Returns the exit code instead of ignoring it like os.system did
+    return subprocess.run(['snow', 'snowpark', *args, *snow_connection_args], cwd=cwd).returncode
+
+def deploy_projects(projects):
+    # Projects sharing a stage and project name upload to the same place on the stage,
+    # so they are deployed one after the other by the same worker
+    results = []
+    for project in projects:
+        start = time.time()
+        print(f"Calling snowcli to deploy the project in folder {project['path']}")
+        exit_code = run_snow(['build'], project['path'])
+        if exit_code == 0:
+            exit_code = run_snow(['deploy', '--replace'], project['path'])
+        results.append({'project': project, 'exit_code': exit_code, 'seconds': time.time() - start})
+    return results
+
+def deploy_changed_projects(root_directory, max_workers=max_parallel_deploys, state_path=None, force=False):
+    # force=True deploys every project, changed or not
+    state_path = state_path or os.path.join(root_directory, deploy_state_filename)
+    state = read_deploy_state(state_path)
+    deployed = state.setdefault(deploy_target(), {})
+
+    changed = {}
+    for project in find_snowpark_projects(root_directory):
+        key = os.path.relpath(project['path'], root_directory).replace(os.sep, '/')
+        project['key'] = key
+        project['hash'] = project_hash(project)
+        if not force and deployed.get(key) == project['hash']:
+            print(f"Skipping unchanged Snowpark project in folder {key}")
+            continue
+        group = (project['settings']['stage_name'], project['settings']['project_name'])
+        changed.setdefault(group, []).append(project)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for group_results in executor.map(deploy_projects, changed.values()):
+            results.extend(group_results)
+
+    # Only remember successful deploys, so failed projects are retried on the next run
+    for result in results:
+        if result['exit_code'] == 0:
+            deployed[result['project']['key']] = result['project']['hash']
+    write_deploy_state(state, state_path)
+
+    print("Deploy summary:")
+    for result in sorted(results, key=lambda r: r['project']['key']):
+        status = 'OK' if result['exit_code'] == 0 else f"FAILED (exit code {result['exit_code']})"
+        print(f"\t{result['project']['key']}: {status} in {result['seconds']:.1f}s")
+    return 0 if all(r['exit_code'] == 0 for r in results) else 1
+
+
+def benchmark_discovery(num_directories=50000):
+    # Builds a synthetic tree with a few projects next to large ignored and vendored folders,
+    # then times an unpruned walk against the pruned one
+    root_directory = tempfile.mkdtemp()
+    try:
+        per_folder = max(num_directories // 5, 1)
+        for i in range(per_folder):
+            os.makedirs(os.path.join(root_directory, '.git', 'objects', f"{i:05d}"))
+            os.makedirs(os.path.join(root_directory, 'vendor', f"lib{i:05d}"))
+            os.makedirs(os.path.join(root_directory, 'apps', f"app{i:05d}", '__pycache__'))
+            os.makedirs(os.path.join(root_directory, 'apps', f"app{i:05d}", 'src'))
+        with open(os.path.join(root_directory, '.gitignore'), 'w') as f:
+            f.write("vendor/\n")
+        for i in range(0, per_folder, max(per_folder // 20, 1)):
+            with open(os.path.join(root_directory, 'apps', f"app{i:05d}", snowflake_project_config_filename), 'w') as f:
+                f.write(f"snowpark:\n  project_name: app{i}\n  stage_name: deployment\n  src: src/\n")
+
+        start = time.time()
+        walked = sum(1 for _ in os.walk(root_directory))
+        print(f"Unpruned os.walk: {walked} folders in {time.time() - start:.2f}s")
+
+        start = time.time()
+        project_folders = discover_project_folders(root_directory)
+        print(f"Pruned walk: {len(project_folders)} projects in {time.time() - start:.2f}s")
+    finally:
+        shutil.rmtree(root_directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deploy all Snowpark apps in a folder tree")
+    parser.add_argument('root_directory', nargs='?', help="Root directory to search for Snowpark projects")
+    parser.add_argument('--list', action='store_true', help="Only print the Snowpark projects that were found")
+    parser.add_argument('--force', action='store_true', help="Deploy every project, even the unchanged ones")
+    parser.add_argument('--benchmark', type=int, metavar='DIRECTORIES', help="Time project discovery on a synthetic tree")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_discovery(args.benchmark)
+        sys.exit(0)
+    if not args.root_directory:
+        print("Root directory is required")
+        exit()
+
+    root_directory = args.root_directory
+    if args.list:
+        for project in find_snowpark_projects(root_directory):
+            print(f"{project['settings']['project_name']}\t{project['path']}")
+        sys.exit(0)
+
+    print(f"Deploying all Snowpark apps in root directory {root_directory}")
+    sys.exit(deploy_changed_projects(root_directory, force=args.force))
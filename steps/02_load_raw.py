@@ -5,8 +5,15 @@
 # Last Updated: 1/9/2023
 #------------------------------------------------------------------------------
 
+import hashlib
+import json
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from snowflake.snowpark import Session
+from warehouse import warehouse_size, size_for_bytes
+from profiling import profile_step, consume_profile_flag, print_histograms
 #import snowflake.snowpark.types as T
 #import snowflake.snowpark.functions as F
 
@@ -17,46 +24,378 @@ TABLE_DICT = {
     "pos": {"schema": "RAW_POS", "tables": POS_TABLES},
     "customer": {"schema": "RAW_CUSTOMER", "tables": CUSTOMER_TABLES}
 }
+# Only load the first 3 years of data for the order tables at this point
+# We will load the 2022 data later in the lab
+YEAR_PARTITIONED_TABLES = ['order_header', 'order_detail']
+INITIAL_YEARS = ['2019', '2020', '2021']
+
+# Settings for the parallel loader
+MAX_CONCURRENT_LOADS = 4
+MAX_LOAD_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 5
+MANIFEST_FILE = 'raw_load_manifest.json'
+
+# Settings for incremental loads of new files
+INGEST_LEDGER_FILE = 'raw_ingest_ledger.json'
+COPY_FILES_BATCH_SIZE = 1000    # COPY accepts at most 1000 files in a FILES list
+
+# Settings for the schema registry
+SCHEMA_REGISTRY_FILE = 'raw_schema_registry.json'
+SCHEMA_REGISTRY_VERSION = 1
+
+TABLE_COMMENT = '''{"origin":"sf_sit-is","name":"snowpark_101_de","version":{"major":1, "minor":0},"attributes":{"is_quickstart":1, "source":"sql"}}'''
 
 # SNOWFLAKE ADVANTAGE: Schema detection
 # SNOWFLAKE ADVANTAGE: Data ingestion with COPY
 # SNOWFLAKE ADVANTAGE: Snowflake Tables (not file-based)
 
-def load_raw_table(session, tname=None, s3dir=None, year=None, schema=None):
-    session.use_schema(schema)
+def load_raw_table(session, tname=None, s3dir=None, year=None, schema=None, add_comment=True, registry=None):
     if year is None:
         location = "@external.frostbyte_raw_stage/{}/{}".format(s3dir, tname)
     else:
         print('\tLoading year {}'.format(year)) 
         location = "@external.frostbyte_raw_stage/{}/{}/year={}".format(s3dir, tname, year)
     
-    # we can infer schema using the parquet read option
-    df = session.read.option("compression", "snappy") \
-                            .parquet(location)
-    df.copy_into_table("{}".format(tname))
-    comment_text = '''{"origin":"sf_sit-is","name":"snowpark_101_de","version":{"major":1, "minor":0},"attributes":{"is_quickstart":1, "source":"sql"}}'''
-    sql_command = f"""COMMENT ON TABLE {tname} IS '{comment_text}';"""
+    # Use fully qualified table names (rather than session.use_schema()) so that
+    # loads running at the same time on one session can't change each other's schema
+    if registry is None:
+        # we can infer schema using the parquet read option
+        df = session.read.option("compression", "snappy") \
+                                .parquet(location)
+        copy_results = df.copy_into_table("{}.{}".format(schema, tname))
+    else:
+        # or skip inference entirely when the schema registry already knows the table
+        columns, _ = get_registered_columns(session, registry, tname=tname, schema=schema, location=location)
+        copy_results = copy_with_registered_columns(session, columns, tname=tname, schema=schema, location=location)
+    if add_comment:
+        comment_raw_table(session, tname=tname, schema=schema)
+
+    # COPY returns one row per file loaded
+    return sum(int(r.as_dict().get('rows_loaded', 0) or 0) for r in (copy_results or []))
+
+def comment_raw_table(session, tname=None, schema=None):
+    sql_command = f"""COMMENT ON TABLE {schema}.{tname} IS '{TABLE_COMMENT}';"""
     session.sql(sql_command).collect()
 
+def get_raw_partitions():
+    # Every independent unit of work (a table, or one year of a year-partitioned table)
+    partitions = []
+    for s3dir, data in TABLE_DICT.items():
+        for tname in data['tables']:
+            years = INITIAL_YEARS if tname in YEAR_PARTITIONED_TABLES else [None]
+            for year in years:
+                partitions.append({"s3dir": s3dir, "schema": data['schema'], "tname": tname, "year": year})
+    return partitions
+
+def partition_key(partition):
+    key = "{}/{}".format(partition['s3dir'], partition['tname'])
+    if partition['year'] is not None:
+        key = "{}/year={}".format(key, partition['year'])
+    return key
+
+
+# The schema registry remembers the inferred schema of each table and the files each
+# partition held when it was checked, so a partition is only inferred again when it is
+# new or its files change, instead of once per table and year on every run. Every new
+# or changed partition is compared against the registered schema.
+
+class SchemaDriftError(Exception):
+    pass
+
+_registry_lock = threading.Lock()
+
+def read_schema_registry(registry_path):
+    if os.path.exists(registry_path):
+        with open(registry_path, "r") as f:
+            registry = json.load(f)
+        # Throw away registries written by an older version of this script
+        if registry.get('version') == SCHEMA_REGISTRY_VERSION:
+            return registry
+    return {"version": SCHEMA_REGISTRY_VERSION, "tables": {}}
+
+def write_schema_registry(registry, registry_path):
+    with _registry_lock:
+        tmp_path = "{}.tmp".format(registry_path)
+        with open(tmp_path, "w") as f:
+            json.dump(registry, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, registry_path)
+
+def stage_fingerprint(session, location):
+    # LIST is a metadata-only call, much cheaper than reading parquet footers to infer a schema
+    files = session.sql("LIST {}".format(location)).collect()
+    entries = sorted("{}|{}|{}".format(r['name'], r['size'], r['md5']) for r in files)
+    return hashlib.sha256("\n".join(entries).encode("utf-8")).hexdigest()
+
+def infer_columns(session, location):
+    rows = session.sql("SELECT COLUMN_NAME, TYPE, EXPRESSION FROM TABLE(INFER_SCHEMA(LOCATION => '{}', FILE_FORMAT => 'EXTERNAL.PARQUET_FORMAT')) ORDER BY ORDER_ID".format(location)).collect()
+    return [{"name": r['COLUMN_NAME'], "type": r['TYPE'], "expression": r['EXPRESSION']} for r in rows]
+
+def diff_columns(expected, actual):
+    expected_types = {c['name']: c['type'] for c in expected}
+    actual_types = {c['name']: c['type'] for c in actual}
+    drift = []
+    for name in expected_types.keys() - actual_types.keys():
+        drift.append("column {} missing".format(name))
+    for name in actual_types.keys() - expected_types.keys():
+        drift.append("new column {} {}".format(name, actual_types[name]))
+    for name in expected_types.keys() & actual_types.keys():
+        if expected_types[name] != actual_types[name]:
+            drift.append("column {} changed from {} to {}".format(name, expected_types[name], actual_types[name]))
+    return sorted(drift)
+
+def get_registered_columns(session, registry, tname=None, schema=None, location=None, verify=False):
+    # Returns the columns for the table, and whether an inference round-trip was needed
+    table_key = "{}.{}".format(schema, tname)
+    fingerprint = stage_fingerprint(session, location)
+    with _registry_lock:
+        entry = registry['tables'].get(table_key)
+        known_fingerprint = entry['partitions'].get(location) if entry else None
+
+    if entry is not None and not verify and known_fingerprint == fingerprint:
+        return entry['columns'], False
+
+    columns = infer_columns(session, location)
+    with _registry_lock:
+        if entry is None:
+            registry['tables'][table_key] = {"columns": columns, "partitions": {location: fingerprint}}
+            return columns, True
+        # Don't silently widen the registered schema, report the drift instead
+        drift = diff_columns(entry['columns'], columns)
+        if drift:
+            raise SchemaDriftError("Schema drift in {} for {}: {}".format(table_key, location, "; ".join(drift)))
+        entry['partitions'][location] = fingerprint
+    return columns, True
+
+def copy_with_registered_columns(session, columns, tname=None, schema=None, location=None):
+    column_defs = ", ".join('"{}" {}'.format(c['name'], c['type']) for c in columns)
+    _ = session.sql("CREATE TABLE IF NOT EXISTS {}.{} ({})".format(schema, tname, column_defs)).collect()
+    column_names = ", ".join('"{}"'.format(c['name']) for c in columns)
+    expressions = ", ".join(c['expression'] for c in columns)
+    return session.sql("COPY INTO {}.{} ({}) FROM (SELECT {} FROM {}) FILE_FORMAT = (FORMAT_NAME = EXTERNAL.PARQUET_FORMAT)" \
+                        .format(schema, tname, column_names, expressions, location)).collect()
+
+
+# The manifest records what has been loaded so that a rerun only loads what is missing.
+# It is kept per account and database, and a partition only counts as loaded while its
+# table still exists, so loading into another database or after 11_teardown.sql loads
+# everything again.
+
+def load_target(session):
+    return "{}.{}".format(session.get_current_account(), session.get_current_database()).replace('"', '')
+
+def existing_tables(session, schemas):
+    rows = session.sql("SELECT TABLE_SCHEMA, TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA IN ({})" \
+                        .format(", ".join("'{}'".format(s) for s in schemas))).collect()
+    return {(r['TABLE_SCHEMA'], r['TABLE_NAME']) for r in rows}
+
+def read_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+def write_manifest(manifest, manifest_path):
+    # Write to a temp file first so an interrupted run never leaves a corrupt manifest
+    tmp_path = "{}.tmp".format(manifest_path)
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def load_partition_with_retry(session, partition, max_attempts=MAX_LOAD_ATTEMPTS, backoff_seconds=RETRY_BACKOFF_SECONDS, registry=None):
+    start = time.time()
+    for attempt in range(1, max_attempts + 1):
+        try:
+            rows_loaded = load_raw_table(session, tname=partition['tname'], s3dir=partition['s3dir'], \
+                                         year=partition['year'], schema=partition['schema'], add_comment=False, registry=registry)
+            return {"status": "loaded", "rows_loaded": rows_loaded, "attempts": attempt, \
+                    "elapsed_seconds": round(time.time() - start, 3)}
+        except SchemaDriftError as e:
+            # Retrying won't fix a schema change, so fail the partition straight away
+            print("\t{}".format(e))
+            return {"status": "failed", "error": str(e), "attempts": attempt, \
+                    "elapsed_seconds": round(time.time() - start, 3)}
+        except Exception as e:
+            print("\tFailed to load {} (attempt {} of {}): {}".format(partition_key(partition), attempt, max_attempts, e))
+            if attempt == max_attempts:
+                return {"status": "failed", "error": str(e), "attempts": attempt, \
+                        "elapsed_seconds": round(time.time() - start, 3)}
+            time.sleep(backoff_seconds * attempt)
+
+def load_partitions(session, partitions, max_workers=MAX_CONCURRENT_LOADS, manifest_path=MANIFEST_FILE, \
+                    max_attempts=MAX_LOAD_ATTEMPTS, backoff_seconds=RETRY_BACKOFF_SECONDS, registry_path=SCHEMA_REGISTRY_FILE):
+    manifests = read_manifest(manifest_path)
+    manifest = manifests.setdefault(load_target(session), {})
+    # Pass registry_path=None to fall back to letting Snowpark infer every partition
+    registry = read_schema_registry(registry_path) if registry_path else None
+    manifest_lock = threading.Lock()
+
+    tables = existing_tables(session, sorted({p['schema'] for p in partitions}))
+    def is_loaded(p):
+        return manifest.get(partition_key(p), {}).get('status') == 'loaded' and (p['schema'], p['tname'].upper()) in tables
+    pending = [p for p in partitions if not is_loaded(p)]
+    for p in partitions:
+        if p not in pending:
+            print("Skipping {} (already loaded)".format(partition_key(p)))
+
+    def run(partition):
+        print("Loading {}".format(partition_key(partition)))
+        result = load_partition_with_retry(session, partition, max_attempts=max_attempts, backoff_seconds=backoff_seconds, registry=registry)
+        with manifest_lock:
+            manifest[partition_key(partition)] = result
+            write_manifest(manifests, manifest_path)
+        return result
+
+    # COPY creates the target table on first load, so the first partition of each table
+    # has to finish before the table's other partitions can run alongside each other
+    first_wave, second_wave, seen_tables = [], [], set()
+    for p in pending:
+        table = (p['schema'], p['tname'])
+        if table in seen_tables:
+            second_wave.append(p)
+        else:
+            seen_tables.add(table)
+            first_wave.append(p)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for wave in [first_wave, second_wave]:
+            list(executor.map(run, wave))
+    if registry is not None:
+        write_schema_registry(registry, registry_path)
+
+    # Only comment each table once, instead of once per partition
+    loaded_tables = {(p['schema'], p['tname']) for p in pending \
+                        if manifest[partition_key(p)]['status'] == 'loaded'}
+    for schema, tname in sorted(loaded_tables):
+        comment_raw_table(session, tname=tname, schema=schema)
+
+    failed = [partition_key(p) for p in pending if manifest[partition_key(p)]['status'] != 'loaded']
+    if failed:
+        raise Exception("Failed to load partitions: {}".format(", ".join(failed)))
+    return manifest
+
 # SNOWFLAKE ADVANTAGE: Warehouse elasticity (dynamic scaling)
 
-def load_all_raw_tables(session):
-    _ = session.sql("ALTER WAREHOUSE HOL_WH SET WAREHOUSE_SIZE = XLARGE WAIT_FOR_COMPLETION = TRUE").collect()
+def staged_bytes(session):
+    # Size of everything in the stage folders we load from, used to pick the warehouse size
+    total = 0
+    for s3dir in TABLE_DICT.keys():
+        total += sum(int(r['size']) for r in session.sql("LIST @external.frostbyte_raw_stage/{}".format(s3dir)).collect())
+    return total
+
+def load_all_raw_tables(session, max_workers=MAX_CONCURRENT_LOADS, manifest_path=MANIFEST_FILE, registry_path=SCHEMA_REGISTRY_FILE):
+    with warehouse_size(session, size_for_bytes(staged_bytes(session)), job="load_all_raw_tables"):
+        load_partitions(session, get_raw_partitions(), max_workers=max_workers, manifest_path=manifest_path, registry_path=registry_path)
+
+# SNOWFLAKE ADVANTAGE: Incremental loads with COPY file lists
+
+def list_stage_files(session, s3dir=None, tname=None):
+    # Returns the table's files relative to its folder in the stage, e.g. 'year=2022/part-0.snappy.parquet'
+    prefix = "{}/{}/".format(s3dir, tname)
+    files = []
+    for r in session.sql("LIST @external.frostbyte_raw_stage/{}/{}".format(s3dir, tname)).collect():
+        name = r['name']
+        if prefix in name:
+            files.append(name[name.index(prefix) + len(prefix):])
+    return sorted(files)
 
+def local_file_lister(directory):
+    # Lists a local folder laid out like the stage (<s3dir>/<tname>/year=<year>/*.parquet),
+    # so incremental loads can be tried out without the S3 stage
+    def list_files(session, s3dir=None, tname=None):
+        table_dir = os.path.join(directory, s3dir, tname)
+        files = []
+        for (directory_path, directory_names, file_names) in os.walk(table_dir):
+            for file_name in file_names:
+                if file_name.endswith(".parquet"):
+                    files.append(os.path.relpath(os.path.join(directory_path, file_name), table_dir).replace(os.sep, "/"))
+        return sorted(files)
+    return list_files
+
+def copy_stage_files(session, tname=None, s3dir=None, schema=None, files=None):
+    # COPY only the listed files (relative to the table's folder), returns the rows loaded
+    file_list = ", ".join("'{}'".format(f) for f in files)
+    copy_results = session.sql("""COPY INTO {}.{}
+                                    FROM @external.frostbyte_raw_stage/{}/{}/
+                                    FILES = ({})
+                                    FILE_FORMAT = (FORMAT_NAME = EXTERNAL.PARQUET_FORMAT)
+                                    MATCH_BY_COLUMN_NAME = CASE_SENSITIVE""".format(schema, tname, s3dir, tname, file_list)).collect()
+    return sum(int(r.as_dict().get('rows_loaded', 0) or 0) for r in copy_results)
+
+def local_file_copier(directory):
+    # Appends files from a folder laid out like the stage (see local_file_lister) to the table,
+    # for sessions without the stage such as Snowpark local testing
+    def copy_files(session, tname=None, s3dir=None, schema=None, files=None):
+        import pandas as pd
+        df = pd.concat([pd.read_parquet(os.path.join(directory, s3dir, tname, f)) for f in files], ignore_index=True)
+        # Local testing infers types value by value, and doesn't know pandas' NA
+        df = df.astype(object).where(df.notna(), None)
+        session.create_dataframe(df).write.mode('append').save_as_table("{}.{}".format(schema, tname))
+        return len(df)
+    return copy_files
+
+def discover_years(files):
+    return sorted({f.split("/")[0][len("year="):] for f in files if f.startswith("year=")})
+
+def seed_ledger_from_manifest(files, partition, manifest):
+    # Files in year partitions already loaded by load_all_raw_tables don't need loading again
+    loaded_years = set()
+    for year in discover_years(files):
+        key = partition_key({**partition, "year": year})
+        if manifest.get(key, {}).get('status') == 'loaded':
+            loaded_years.add(year)
+    return [f for f in files if f.split("/")[0][len("year="):] in loaded_years]
+
+def load_raw_table_incremental(session, tname=None, s3dir=None, schema=None, ledger=None, ledger_path=INGEST_LEDGER_FILE, \
+                                list_files=list_stage_files, batch_size=COPY_FILES_BATCH_SIZE, manifest_path=MANIFEST_FILE, registry=None, \
+                                copy_files=copy_stage_files):
+    table_key = "{}.{}".format(schema, tname)
+    files = list_files(session, s3dir=s3dir, tname=tname)
+    if table_key not in ledger:
+        partition = {"s3dir": s3dir, "schema": schema, "tname": tname}
+        manifest = read_manifest(manifest_path).get(load_target(session), {})
+        ledger[table_key] = seed_ledger_from_manifest(files, partition, manifest)
+
+    ingested = set(ledger[table_key])
+    new_files = [f for f in files if f not in ingested]
+    print("{}: {} new files in years {}".format(table_key, len(new_files), discover_years(new_files)))
+    if registry is not None:
+        # Check the years with new files against the registered schema before loading anything
+        for year in discover_years(new_files):
+            location = "@external.frostbyte_raw_stage/{}/{}/year={}".format(s3dir, tname, year)
+            get_registered_columns(session, registry, tname=tname, schema=schema, location=location)
+
+    rows_loaded = 0
+    for i in range(0, len(new_files), batch_size):
+        batch = new_files[i:i + batch_size]
+        rows_loaded += copy_files(session, tname=tname, s3dir=s3dir, schema=schema, files=batch)
+        # Record each batch as soon as it is loaded so a failed run picks up where it stopped
+        ledger[table_key].extend(batch)
+        write_ledger(ledger, ledger_path)
+    return rows_loaded
+
+def read_ledger(ledger_path):
+    return read_manifest(ledger_path)
+
+def write_ledger(ledger, ledger_path):
+    write_manifest(ledger, ledger_path)
+
+def load_new_raw_files(session, tnames=YEAR_PARTITIONED_TABLES, ledger_path=INGEST_LEDGER_FILE, list_files=list_stage_files, \
+                        batch_size=COPY_FILES_BATCH_SIZE, manifest_path=MANIFEST_FILE, registry_path=SCHEMA_REGISTRY_FILE, \
+                        copy_files=copy_stage_files):
+    # Replaces the hand-written COPY INTO ... year=2022 statements in 09_process_incrementally.sql
+    ledger = read_ledger(ledger_path)
+    # Pass registry_path=None to load new files without checking them for schema drift
+    registry = read_schema_registry(registry_path) if registry_path else None
     for s3dir, data in TABLE_DICT.items():
-        tnames = data['tables']
-        schema = data['schema']
-        for tname in tnames:
-            print("Loading {}".format(tname))
-            # Only load the first 3 years of data for the order tables at this point
-            # We will load the 2022 data later in the lab
-            if tname in ['order_header', 'order_detail']:
-                for year in ['2019', '2020', '2021']:
-                    load_raw_table(session, tname=tname, s3dir=s3dir, year=year, schema=schema)
-            else:
-                load_raw_table(session, tname=tname, s3dir=s3dir, schema=schema)
-
-    _ = session.sql("ALTER WAREHOUSE HOL_WH SET WAREHOUSE_SIZE = XSMALL").collect()
+        for tname in data['tables']:
+            if tname not in tnames:
+                continue
+            rows_loaded = load_raw_table_incremental(session, tname=tname, s3dir=s3dir, schema=data['schema'], ledger=ledger, \
+                                                    ledger_path=ledger_path, list_files=list_files, batch_size=batch_size, \
+                                                    manifest_path=manifest_path, registry=registry, copy_files=copy_files)
+            print("{}: loaded {} rows".format(tname, rows_loaded))
+            if registry is not None:
+                write_schema_registry(registry, registry_path)
 
 def validate_raw_tables(session):
     # check column names from the inferred schema
@@ -66,10 +405,57 @@ def validate_raw_tables(session):
     for tname in CUSTOMER_TABLES:
         print('{}: \n\t{}\n'.format(tname, session.table('RAW_CUSTOMER.{}'.format(tname)).columns))
 
+def validate_load_manifest(manifest_path=MANIFEST_FILE):
+    # print rows loaded and elapsed time per partition from the last run, per account and database
+    for target, manifest in sorted(read_manifest(manifest_path).items()):
+        print(target)
+        for key, result in sorted(manifest.items()):
+            print('\t{}: {} rows in {}s ({})'.format(key, result.get('rows_loaded', 0), result['elapsed_seconds'], result['status']))
+
+def validate_schema_drift(session, registry_path=SCHEMA_REGISTRY_FILE):
+    # infer every partition again and report any that no longer match the registered schema
+    registry = read_schema_registry(registry_path)
+    for p in get_raw_partitions():
+        location = "@external.frostbyte_raw_stage/{}".format(partition_key(p))
+        try:
+            get_registered_columns(session, registry, tname=p['tname'], schema=p['schema'], location=location, verify=True)
+        except SchemaDriftError as e:
+            print(e)
+
+def benchmark_schema_registry(session, registry_path='benchmark_schema_registry.json'):
+    # count the schema inference round-trips for the POS tables without and with the registry
+    partitions = [p for p in get_raw_partitions() if p['s3dir'] == 'pos']
+    if os.path.exists(registry_path):
+        os.remove(registry_path)
+    print('Without registry: {} inference round-trips per run'.format(len(partitions)))
+    for run in ['First run', 'Later runs']:
+        registry = read_schema_registry(registry_path)
+        start = time.time()
+        inferred = 0
+        for p in partitions:
+            location = "@external.frostbyte_raw_stage/{}".format(partition_key(p))
+            _, was_inferred = get_registered_columns(session, registry, tname=p['tname'], schema=p['schema'], location=location)
+            inferred += int(was_inferred)
+        write_schema_registry(registry, registry_path)
+        print('{} with registry: {} inference round-trips ({} removed) in {:.2f}s' \
+                .format(run, inferred, len(partitions) - inferred, time.time() - start))
+    os.remove(registry_path)
+
 
 # For local debugging
 if __name__ == "__main__":
     # Create a local Snowpark session
     with Session.builder.getOrCreate() as session:
-        load_all_raw_tables(session)
+        import sys
+        args = consume_profile_flag(sys.argv[1:])
+        if len(args) > 0 and args[0] == '--incremental':
+            with profile_step(session, 'load_new_raw_files'):
+                load_new_raw_files(session)
+        else:
+            with profile_step(session, 'load_all_raw_tables'):
+                load_all_raw_tables(session)
+        print_histograms()
 #        validate_raw_tables(session)
+#        validate_load_manifest()
+#        validate_schema_drift(session)
+#        benchmark_schema_registry(session)
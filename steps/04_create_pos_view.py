@@ -13,10 +13,21 @@
 from snowflake.snowpark import Session
 #import snowflake.snowpark.types as T
 import snowflake.snowpark.functions as F
+from profiling import profile_step, consume_profile_flag, print_histograms
 
 
-def create_pos_view(session):
-    session.use_schema('HARMONIZED')
+POS_FLATTENED_COLUMNS = ["ORDER_ID", "TRUCK_ID", "ORDER_TS", "ORDER_TS_DATE", "ORDER_DETAIL_ID", "LINE_NUMBER", \
+                         "TRUCK_BRAND_NAME", "MENU_TYPE", "PRIMARY_CITY", "REGION", "COUNTRY", "FRANCHISE_FLAG", \
+                         "FRANCHISE_ID", "FRANCHISEE_FIRST_NAME", "FRANCHISEE_LAST_NAME", "LOCATION_ID", "MENU_ITEM_ID", \
+                         "MENU_ITEM_NAME", "QUANTITY", "UNIT_PRICE", "PRICE", "ORDER_AMOUNT", "ORDER_TAX_AMOUNT", \
+                         "ORDER_DISCOUNT_AMOUNT", "ORDER_TOTAL"]
+# What DAILY_CITY_METRICS_UPDATE_SP reads from the flattened orders (through ORDERS), for when nothing else uses them
+DOWNSTREAM_COLUMNS = ["ORDER_DETAIL_ID", "ORDER_TS_DATE", "PRIMARY_CITY", "COUNTRY", "PRICE"]
+POS_FLATTENED_TABLE = 'POS_FLATTENED'
+POS_MODES = ('view', 'materialized')
+
+
+def pos_flattened_df(session, columns=POS_FLATTENED_COLUMNS):
     order_detail = session.table("RAW_POS.ORDER_DETAIL").select(F.col("ORDER_DETAIL_ID"), \
                                                                 F.col("LINE_NUMBER"), \
                                                                 F.col("MENU_ITEM_ID"), \
@@ -64,39 +75,50 @@ def create_pos_view(session):
                                 .join(location, order_header['LOCATION_ID'] == location['LOCATION_ID'], rsuffix='_l')
     final_df = order_detail.join(oh_w_t_and_l, order_detail['ORDER_ID'] == oh_w_t_and_l['ORDER_ID'], rsuffix='_oh') \
                             .join(menu, order_detail['MENU_ITEM_ID'] == menu['MENU_ITEM_ID'], rsuffix='_m')
-    final_df = final_df.select(F.col("ORDER_ID"), \
-                            F.col("TRUCK_ID"), \
-                            F.col("ORDER_TS"), \
-                            F.col('ORDER_TS_DATE'), \
-                            F.col("ORDER_DETAIL_ID"), \
-                            F.col("LINE_NUMBER"), \
-                            F.col("TRUCK_BRAND_NAME"), \
-                            F.col("MENU_TYPE"), \
-                            F.col("PRIMARY_CITY"), \
-                            F.col("REGION"), \
-                            F.col("COUNTRY"), \
-                            F.col("FRANCHISE_FLAG"), \
-                            F.col("FRANCHISE_ID"), \
-                            F.col("FRANCHISEE_FIRST_NAME"), \
-                            F.col("FRANCHISEE_LAST_NAME"), \
-                            F.col("LOCATION_ID"), \
-                            F.col("MENU_ITEM_ID"), \
-                            F.col("MENU_ITEM_NAME"), \
-                            F.col("QUANTITY"), \
-                            F.col("UNIT_PRICE"), \
-                            F.col("PRICE"), \
-                            F.col("ORDER_AMOUNT"), \
-                            F.col("ORDER_TAX_AMOUNT"), \
-                            F.col("ORDER_DISCOUNT_AMOUNT"), \
-                            F.col("ORDER_TOTAL"))
-    final_df.create_or_replace_view('POS_FLATTENED_V')
-
-def create_pos_view_stream(session):
+    return final_df.select([F.col(c) for c in columns])
+
+def create_pos_view(session, mode='view', columns=None, feeds_orders=True, lag='1 minute', warehouse='HOL_WH'):
+    # mode='materialized' builds POS_FLATTENED as an incremental dynamic table with POS_FLATTENED_V as a
+    # view over it. ORDERS is built from every column of the view, so trimming needs feeds_orders=False
+    if mode not in POS_MODES:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {POS_MODES}")
+    columns = columns or POS_FLATTENED_COLUMNS
+    if feeds_orders and set(columns) != set(POS_FLATTENED_COLUMNS):
+        raise ValueError("ORDERS is built from every column of POS_FLATTENED_V, pass feeds_orders=False to trim it")
+    session.use_schema('HARMONIZED')
+    if mode == 'view':
+        pos_flattened_df(session, columns).create_or_replace_view('POS_FLATTENED_V')
+        return
+
+    pos_flattened_df(session, columns) \
+        .create_or_replace_dynamic_table(POS_FLATTENED_TABLE, warehouse=warehouse, lag=lag, \
+                                         refresh_mode='INCREMENTAL', initialize='ON_CREATE', \
+                                         clustering_keys=[F.col("ORDER_TS_DATE")])
+    session.table(POS_FLATTENED_TABLE).create_or_replace_view('POS_FLATTENED_V')
+
+def create_pos_view_stream(session, mode='view'):
     session.use_schema('HARMONIZED')
-    _ = session.sql('CREATE OR REPLACE STREAM POS_FLATTENED_V_STREAM \
-                        ON VIEW POS_FLATTENED_V \
+    # In materialized mode the stream sits on the dynamic table itself, under the same name so
+    # ORDERS_UPDATE_SP is untouched; recreating it here also replaces a stream left on the old join view
+    source = 'VIEW POS_FLATTENED_V' if mode == 'view' else f'DYNAMIC TABLE {POS_FLATTENED_TABLE}'
+    _ = session.sql(f'CREATE OR REPLACE STREAM POS_FLATTENED_V_STREAM \
+                        ON {source} \
                         SHOW_INITIAL_ROWS = TRUE').collect()
 
+def check_pos_equivalence(session, columns=None):
+    # True when the refreshed POS_FLATTENED holds the same rows (duplicates included) as the join view
+    session.use_schema('HARMONIZED')
+    materialized = session.table(POS_FLATTENED_TABLE)
+    columns = columns or materialized.columns
+    _ = session.sql(f'ALTER DYNAMIC TABLE {POS_FLATTENED_TABLE} REFRESH').collect()
+
+    expected = pos_flattened_df(session, columns).group_by(columns).agg(F.count(F.lit(1)).alias("N"))
+    actual = materialized.select(columns).group_by(columns).agg(F.count(F.lit(1)).alias("N"))
+    missing = expected.except_(actual).count()
+    extra = actual.except_(expected).count()
+    print(f"POS_FLATTENED vs join view on {len(columns)} columns: {missing} row groups missing, {extra} unexpected")
+    return missing == 0 and extra == 0
+
 def test_pos_view(session):
     session.use_schema('HARMONIZED')
     tv = session.table('POS_FLATTENED_V')
@@ -107,6 +129,14 @@ def test_pos_view(session):
 if __name__ == "__main__":
     # Create a local Snowpark session
     with Session.builder.getOrCreate() as session:
-        create_pos_view(session)
-        create_pos_view_stream(session)
+        import sys
+        args = consume_profile_flag(sys.argv[1:])
+        mode = 'materialized' if '--materialized' in args else 'view'
+        with profile_step(session, 'create_pos_view'):
+            create_pos_view(session, mode=mode)
+        with profile_step(session, 'create_pos_view_stream'):
+            create_pos_view_stream(session, mode=mode)
+        print_histograms()
+        if mode == 'materialized' and '--check' in args:
+            sys.exit(0 if check_pos_equivalence(session) else 1)
 #        test_pos_view(session)
@@ -0,0 +1,82 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       05_fahrenheit_to_celsius_udf/conversions.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+# Unit conversions for the weather UDFs. All of the conversions are plain arithmetic,
+# so they work the same on Python floats, NumPy arrays and pandas Series and don't
+# need any third-party packages to be imported when a UDF starts up.
+
+ZERO_CELSIUS_IN_KELVIN = 273.15
+MILLIMETERS_PER_INCH = 25.4
+KILOMETERS_PER_MILE = 1.609344
+METERS_PER_MILE = 1609.344
+SECONDS_PER_HOUR = 3600
+
+# Temperatures go through Kelvin, exactly like scipy.constants.convert_temperature,
+# so the results are bit-identical to the scipy based UDF these replace
+def fahrenheit_to_celsius(value):
+    return (value - 32) * 5 / 9 + ZERO_CELSIUS_IN_KELVIN - ZERO_CELSIUS_IN_KELVIN
+
+def celsius_to_fahrenheit(value):
+    return (value + ZERO_CELSIUS_IN_KELVIN - ZERO_CELSIUS_IN_KELVIN) * 9 / 5 + 32
+
+# The less common scales (Kelvin, Rankine) are converted through Kelvin the same way
+TO_KELVIN = {
+    "C": lambda value: value + ZERO_CELSIUS_IN_KELVIN,
+    "F": lambda value: (value - 32) * 5 / 9 + ZERO_CELSIUS_IN_KELVIN,
+    "K": lambda value: value,
+    "R": lambda value: value * 5 / 9,
+}
+FROM_KELVIN = {
+    "C": lambda value: value - ZERO_CELSIUS_IN_KELVIN,
+    "F": lambda value: (value - ZERO_CELSIUS_IN_KELVIN) * 9 / 5 + 32,
+    "K": lambda value: value,
+    "R": lambda value: value * 9 / 5,
+}
+
+def temperature_conversion(from_unit, to_unit):
+    to_kelvin, from_kelvin = TO_KELVIN[from_unit], FROM_KELVIN[to_unit]
+    return lambda value: from_kelvin(to_kelvin(value))
+
+def inch_to_millimeter(value):
+    return value * MILLIMETERS_PER_INCH
+
+def millimeter_to_inch(value):
+    return value / MILLIMETERS_PER_INCH
+
+def mph_to_kph(value):
+    return value * KILOMETERS_PER_MILE
+
+def mph_to_meters_per_second(value):
+    return value * METERS_PER_MILE / SECONDS_PER_HOUR
+
+CONVERSIONS = {
+    "temperature": {
+        ("F", "C"): fahrenheit_to_celsius,
+        ("C", "F"): celsius_to_fahrenheit,
+        **{(f, t): temperature_conversion(f, t) for f in TO_KELVIN for t in FROM_KELVIN \
+            if f != t and {f, t} != {"C", "F"}},
+    },
+    "length": {
+        ("in", "mm"): inch_to_millimeter,
+        ("mm", "in"): millimeter_to_inch,
+    },
+    "speed": {
+        ("mph", "kph"): mph_to_kph,
+        ("mph", "m/s"): mph_to_meters_per_second,
+    },
+}
+
+TEMPERATURE_SCALES = list(TO_KELVIN)
+
+def get_conversion(from_unit, to_unit):
+    for conversions in CONVERSIONS.values():
+        if (from_unit, to_unit) in conversions:
+            return conversions[(from_unit, to_unit)]
+    raise ValueError(f"No conversion from '{from_unit}' to '{to_unit}'")
+
+def convert(value, from_unit, to_unit):
+    return get_conversion(from_unit, to_unit)(value)
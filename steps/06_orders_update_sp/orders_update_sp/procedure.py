@@ -8,51 +8,137 @@
 # SNOWFLAKE ADVANTAGE: Python Stored Procedures
 
 import time
-from snowflake.snowpark import Session
+import weakref
+from snowflake.snowpark import Session, Window
 #import snowflake.snowpark.types as T
 import snowflake.snowpark.functions as F
+from warehouse import warehouse_size, size_for_rows
+from profiling import profile_step, consume_profile_flag, print_histograms
 
+POS_FLATTENED_V_STREAM = 'HARMONIZED.POS_FLATTENED_V_STREAM'
+# Schemas whose tables are looked up once per session, see table_columns()
+METADATA_SCHEMAS = ['HARMONIZED']
+
+_metadata_cache = weakref.WeakKeyDictionary()
+
+
+def table_columns(session, schema='', name=''):
+    # Existence and column checks for all tables in METADATA_SCHEMAS are answered from one
+    # INFORMATION_SCHEMA query per session, instead of one query per check
+    if session not in _metadata_cache:
+        schemas = ", ".join("'{}'".format(s) for s in METADATA_SCHEMAS)
+        rows = session.sql("SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA IN ({}) ORDER BY ORDINAL_POSITION".format(schemas)).collect()
+        tables = {}
+        for r in rows:
+            tables.setdefault((r['TABLE_SCHEMA'], r['TABLE_NAME']), []).append(r['COLUMN_NAME'])
+        _metadata_cache[session] = tables
+    return _metadata_cache[session].get((schema, name))
 
 def table_exists(session, schema='', name=''):
-    exists = session.sql("SELECT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = '{}' AND TABLE_NAME = '{}') AS TABLE_EXISTS".format(schema, name)).collect()[0]['TABLE_EXISTS']
-    return exists
+    return table_columns(session, schema=schema, name=name) is not None
+
+def clear_metadata_cache(session):
+    _metadata_cache.pop(session, None)
 
 def create_orders_table(session):
     _ = session.sql("CREATE TABLE HARMONIZED.ORDERS LIKE HARMONIZED.POS_FLATTENED_V").collect()
     _ = session.sql("ALTER TABLE HARMONIZED.ORDERS ADD COLUMN META_UPDATED_AT TIMESTAMP").collect()
+    _ = session.sql("ALTER TABLE HARMONIZED.ORDERS ADD COLUMN META_ROW_HASH NUMBER").collect()
 
 def create_orders_stream(session):
     _ = session.sql("CREATE STREAM HARMONIZED.ORDERS_STREAM ON TABLE HARMONIZED.ORDERS").collect()
 
-def merge_order_updates(session):
-    _ = session.sql('ALTER WAREHOUSE HOL_WH SET WAREHOUSE_SIZE = XLARGE WAIT_FOR_COMPLETION = TRUE').collect()
-
-    source = session.table('HARMONIZED.POS_FLATTENED_V_STREAM')
-    target = session.table('HARMONIZED.ORDERS')
-
-    # TODO: Is the if clause supposed to be based on "META_UPDATED_AT"?
-    cols_to_update = {c: source[c] for c in source.schema.names if "METADATA" not in c}
-    metadata_col_to_update = {"META_UPDATED_AT": F.current_timestamp()}
-    updates = {**cols_to_update, **metadata_col_to_update}
-
-    # merge into DIM_CUSTOMER
-    target.merge(source, target['ORDER_DETAIL_ID'] == source['ORDER_DETAIL_ID'], \
-                        [F.when_matched().update(updates), F.when_not_matched().insert(updates)])
-
-    _ = session.sql('ALTER WAREHOUSE HOL_WH SET WAREHOUSE_SIZE = XSMALL').collect()
+def collapse_stream_changes(source):
+    # An update shows up in the stream as a DELETE of the old row plus an INSERT of the
+    # new one (both with METADATA$ISUPDATE = TRUE). Keep one row per ORDER_DETAIL_ID,
+    # preferring the INSERT, so that only real deletes are left as DELETE rows.
+    is_insert = F.iff(F.col("METADATA$ACTION") == "INSERT", F.lit(1), F.lit(0))
+    window = Window.partition_by(F.col("ORDER_DETAIL_ID")).order_by(is_insert.desc())
+    return source.with_column("CHANGE_RANK", F.row_number().over(window)) \
+                    .filter(F.col("CHANGE_RANK") == 1) \
+                    .drop("CHANGE_RANK")
+
+def row_hash(data_cols):
+    return F.hash(*[F.col(c) for c in data_cols])
+
+def pending_order_lines(session):
+    # Counting the view's stream would compute its changes (the six-way join) once more just to size
+    # the warehouse. ORDERS has a row per ORDER_DETAIL row merged so far, so the difference of their
+    # row counts, which are table metadata, is about the number of new order lines
+    row = session.sql("""SELECT SYSTEM$STREAM_HAS_DATA('{}') AS HAS_DATA,
+                            (SELECT ROW_COUNT FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = 'RAW_POS' AND TABLE_NAME = 'ORDER_DETAIL') AS ORDER_DETAIL_ROWS,
+                            (SELECT ROW_COUNT FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = 'HARMONIZED' AND TABLE_NAME = 'ORDERS') AS ORDERS_ROWS""" \
+                        .format(POS_FLATTENED_V_STREAM)).collect()[0]
+    if not row['HAS_DATA']:
+        return None
+    return max((row['ORDER_DETAIL_ROWS'] or 0) - (row['ORDERS_ROWS'] or 0), 0)
+
+def merge_order_updates(session, change_aware=True, source_table=POS_FLATTENED_V_STREAM):
+    source = session.table(source_table)
+    source_rows = pending_order_lines(session) if source_table == POS_FLATTENED_V_STREAM else source.count()
+    if source_rows is None:
+        # Nothing in the stream, so there's nothing to merge either
+        return
+    with warehouse_size(session, size_for_rows(source_rows), job='merge_order_updates'):
+        target = session.table('HARMONIZED.ORDERS')
+
+        # TODO: Is the if clause supposed to be based on "META_UPDATED_AT"?
+        # The stream has the view's columns, which are already in the metadata cache
+        view_cols = table_columns(session, schema='HARMONIZED', name='POS_FLATTENED_V') if source_table == POS_FLATTENED_V_STREAM else None
+        data_cols = view_cols or [c for c in source.schema.names if "METADATA" not in c]
+        if not change_aware:
+            # The row hash is kept up to date here too, or a later change-aware merge would compare
+            # against the hash of an older version of the row and could skip a real change
+            source = source.with_column("META_ROW_HASH", row_hash(data_cols))
+            cols_to_update = {c: source[c] for c in data_cols}
+            metadata_col_to_update = {"META_ROW_HASH": source["META_ROW_HASH"], "META_UPDATED_AT": F.current_timestamp()}
+            updates = {**cols_to_update, **metadata_col_to_update}
+
+            # merge into DIM_CUSTOMER
+            target.merge(source, target['ORDER_DETAIL_ID'] == source['ORDER_DETAIL_ID'], \
+                                [F.when_matched().update(updates), F.when_not_matched().insert(updates)])
+        else:
+            # Only rewrite rows whose values actually changed, using a hash of all the data columns
+            changes = collapse_stream_changes(source).with_column("META_ROW_HASH", row_hash(data_cols))
+            cols_to_update = {c: changes[c] for c in data_cols}
+            metadata_col_to_update = {"META_ROW_HASH": changes["META_ROW_HASH"], "META_UPDATED_AT": F.current_timestamp()}
+            updates = {**cols_to_update, **metadata_col_to_update}
+
+            is_delete = changes["METADATA$ACTION"] == "DELETE"
+            is_insert = changes["METADATA$ACTION"] == "INSERT"
+            has_changed = ~target['META_ROW_HASH'].equal_null(changes['META_ROW_HASH'])
+            target.merge(changes, target['ORDER_DETAIL_ID'] == changes['ORDER_DETAIL_ID'], \
+                                [F.when_matched(is_delete).delete(), \
+                                 F.when_matched(is_insert & has_changed).update(updates), \
+                                 F.when_not_matched(is_insert).insert(updates)])
 
 def main(session: Session) -> str:
     # Create the ORDERS table and ORDERS_STREAM stream if they don't exist
     if not table_exists(session, schema='HARMONIZED', name='ORDERS'):
         create_orders_table(session)
         create_orders_stream(session)
+        clear_metadata_cache(session)
+    elif 'META_ROW_HASH' not in table_columns(session, schema='HARMONIZED', name='ORDERS'):
+        # ORDERS tables created before the change-aware merge don't have the row hash yet
+        _ = session.sql("ALTER TABLE HARMONIZED.ORDERS ADD COLUMN META_ROW_HASH NUMBER").collect()
+        clear_metadata_cache(session)
 
     # Process data incrementally
-    merge_order_updates(session)
+    with profile_step(session, 'merge_order_updates'):
+        merge_order_updates(session)
 #    session.table('HARMONIZED.ORDERS').limit(5).show()
 
     return f"Successfully processed ORDERS"
 
+def count_round_trips(session):
+    # count the queries (including describe queries) one run of main() issues
+    with session.query_history(include_describe=True) as history:
+        main(session)
+    print('main() issued {} queries:'.format(len(history.queries)))
+    for query_record in history.queries:
+        print('\t{}'.format(query_record.sql_text[:100]))
+    return len(history.queries)
+
 
 # For local debugging
 # Be aware you may need to type-convert arguments if you add input parameters
@@ -60,7 +146,10 @@ if __name__ == '__main__':
     # Create a local Snowpark session
     with Session.builder.getOrCreate() as session:
         import sys
-        if len(sys.argv) > 1:
-            print(main(session, *sys.argv[1:]))  # type: ignore
+        args = consume_profile_flag(sys.argv[1:])
+        if len(args) > 0:
+            print(main(session, *args))  # type: ignore
         else:
             print(main(session))  # type: ignore
+        print_histograms()
+#        count_round_trips(session)
@@ -5,26 +5,76 @@
 # Last Updated: 1/9/2023
 #------------------------------------------------------------------------------
 
+import datetime
+import logging
 import time
+import weakref
 from snowflake.snowpark import Session
 import snowflake.snowpark.types as T
 import snowflake.snowpark.functions as F
+from warehouse import warehouse_size, size_for_rows
+from profiling import profile_step, consume_profile_flag, print_histograms
 
 
+CITY_WEATHER_DAILY_TABLE = 'ANALYTICS.CITY_WEATHER_DAILY'
+# Weather for the newest days in the stream is read again on every run, so late or revised
+# HISTORY_DAY rows replace what was cached while orders for those days still arrive
+WEATHER_REFRESH_DAYS = 7
+DAILY_CITY_METRICS_STG_COLUMNS = ["DATE", "CITY_NAME", "COUNTRY_DESC", "DAILY_SALES", \
+                                  "AVG_TEMPERATURE_FAHRENHEIT", "AVG_TEMPERATURE_CELSIUS", \
+                                  "AVG_PRECIPITATION_INCHES", "AVG_PRECIPITATION_MILLIMETERS", \
+                                  "MAX_WIND_SPEED_100M_MPH"]
+BACKFILL_CHECKPOINT_TABLE = 'ANALYTICS.DAILY_CITY_METRICS_BACKFILL'
+BACKFILL_POLL_SECONDS = 2
+# Each chunk's staging rows go to a temporary table named after it, see backfill_chunk_table()
+BACKFILL_STAGING_TABLE = 'ANALYTICS.DAILY_CITY_METRICS_BACKFILL_STG'
+DAILY_CITY_METRICS_MIGRATION_TABLE = 'ANALYTICS.DAILY_CITY_METRICS_MIGRATION'
+# Sums of order prices keep the scale of PRICE; the weather metrics are rounded to 2 decimals
+SALES_TYPE = T.DecimalType(18, 4)
+METRIC_TYPE = T.DecimalType(9, 2)
+WEATHER_AVG_COLUMNS = ["AVG_TEMPERATURE_FAHRENHEIT", "AVG_TEMPERATURE_CELSIUS", \
+                       "AVG_PRECIPITATION_INCHES", "AVG_PRECIPITATION_MILLIMETERS"]
+DAILY_CITY_METRICS_TYPES = {"DAILY_SALES": SALES_TYPE, **{c: METRIC_TYPE for c in WEATHER_AVG_COLUMNS}, \
+                            "MAX_WIND_SPEED_100M_MPH": METRIC_TYPE}
+# Rollups of DAILY_CITY_METRICS for the dashboards, keyed by DATE_TRUNC part
+ROLLUP_TABLES = {'week': 'ANALYTICS.CITY_METRICS_WEEKLY', 'month': 'ANALYTICS.CITY_METRICS_MONTHLY'}
+ROLLUP_COLUMNS = ["PERIOD_START", "CITY_NAME", "COUNTRY_DESC", "DAYS", "TOTAL_SALES", *WEATHER_AVG_COLUMNS, \
+                  "MAX_WIND_SPEED_100M_MPH"]
+# Schemas whose tables are looked up once per session, see table_columns()
+METADATA_SCHEMAS = ['ANALYTICS']
+
+logger = logging.getLogger(__name__)
+_metadata_cache = weakref.WeakKeyDictionary()
+DATES_SCHEMA = T.StructType([T.StructField("DATE", T.DateType())])
+
+def table_columns(session, schema='', name=''):
+    # Existence and column checks for all tables in METADATA_SCHEMAS are answered from one
+    # INFORMATION_SCHEMA query per session, instead of one query per check
+    if session not in _metadata_cache:
+        schemas = ", ".join("'{}'".format(s) for s in METADATA_SCHEMAS)
+        rows = session.sql("SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA IN ({}) ORDER BY ORDINAL_POSITION".format(schemas)).collect()
+        tables = {}
+        for r in rows:
+            tables.setdefault((r['TABLE_SCHEMA'], r['TABLE_NAME']), []).append(r['COLUMN_NAME'])
+        _metadata_cache[session] = tables
+    return _metadata_cache[session].get((schema, name))
+
 def table_exists(session, schema='', name=''):
-    exists = session.sql("SELECT EXISTS (SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = '{}' AND TABLE_NAME = '{}') AS TABLE_EXISTS".format(schema, name)).collect()[0]['TABLE_EXISTS']
-    return exists
+    return table_columns(session, schema=schema, name=name) is not None
+
+def clear_metadata_cache(session):
+    _metadata_cache.pop(session, None)
 
 def create_daily_city_metrics_table(session):
     SHARED_COLUMNS= [T.StructField("DATE", T.DateType()),
                                         T.StructField("CITY_NAME", T.StringType()),
                                         T.StructField("COUNTRY_DESC", T.StringType()),
-                                        T.StructField("DAILY_SALES", T.StringType()),
-                                        T.StructField("AVG_TEMPERATURE_FAHRENHEIT", T.DecimalType()),
-                                        T.StructField("AVG_TEMPERATURE_CELSIUS", T.DecimalType()),
-                                        T.StructField("AVG_PRECIPITATION_INCHES", T.DecimalType()),
-                                        T.StructField("AVG_PRECIPITATION_MILLIMETERS", T.DecimalType()),
-                                        T.StructField("MAX_WIND_SPEED_100M_MPH", T.DecimalType()),
+                                        T.StructField("DAILY_SALES", SALES_TYPE),
+                                        T.StructField("AVG_TEMPERATURE_FAHRENHEIT", METRIC_TYPE),
+                                        T.StructField("AVG_TEMPERATURE_CELSIUS", METRIC_TYPE),
+                                        T.StructField("AVG_PRECIPITATION_INCHES", METRIC_TYPE),
+                                        T.StructField("AVG_PRECIPITATION_MILLIMETERS", METRIC_TYPE),
+                                        T.StructField("MAX_WIND_SPEED_100M_MPH", METRIC_TYPE),
                                     ]
     DAILY_CITY_METRICS_COLUMNS = [*SHARED_COLUMNS, T.StructField("META_UPDATED_AT", T.TimestampType())]
     DAILY_CITY_METRICS_SCHEMA = T.StructType(DAILY_CITY_METRICS_COLUMNS)
@@ -34,29 +84,67 @@ def create_daily_city_metrics_table(session):
                         .write.mode('overwrite').save_as_table('ANALYTICS.DAILY_CITY_METRICS')
     dcm = session.table('ANALYTICS.DAILY_CITY_METRICS')
 
+def migrate_daily_city_metrics(session):
+    # Snowflake can't change a column's type or scale in place, so the table is copied with the new
+    # types and swapped in. Backfilling brings back the decimals the old NUMBER(38,0) rounded away
+    dcm = session.table('ANALYTICS.DAILY_CITY_METRICS')
+    current_types = {f.name: f.datatype for f in dcm.schema.fields}
+    to_convert = [c for c, t in DAILY_CITY_METRICS_TYPES.items() if current_types.get(c) != t]
+    if not to_convert:
+        return "DAILY_CITY_METRICS already has the current column types"
 
-def merge_daily_city_metrics(session):
-    _ = session.sql('ALTER WAREHOUSE HOL_WH SET WAREHOUSE_SIZE = XLARGE WAIT_FOR_COMPLETION = TRUE').collect()
+    dcm.select([F.col(c).cast(DAILY_CITY_METRICS_TYPES[c]).alias(c) if c in to_convert else F.col(c) for c in dcm.columns]) \
+                        .write.mode('overwrite').save_as_table(DAILY_CITY_METRICS_MIGRATION_TABLE)
+    _ = session.sql("ALTER TABLE ANALYTICS.DAILY_CITY_METRICS SWAP WITH {}".format(DAILY_CITY_METRICS_MIGRATION_TABLE)).collect()
+    session.table(DAILY_CITY_METRICS_MIGRATION_TABLE).drop_table()
+    for grain in ROLLUP_TABLES:
+        create_city_metrics_rollup_table(session, grain)
+    clear_metadata_cache(session)
+    return f"Converted {', '.join(to_convert)} in DAILY_CITY_METRICS"
 
-    print("{} records in stream".format(session.table('HARMONIZED.ORDERS_STREAM').count()))
-    orders_stream_dates = session.table('HARMONIZED.ORDERS_STREAM').select(F.col("ORDER_TS_DATE").alias("DATE")).distinct()
-    orders_stream_dates.limit(5).show()
 
-    orders = session.table("HARMONIZED.ORDERS_STREAM").group_by(F.col('ORDER_TS_DATE'), F.col('PRIMARY_CITY'), F.col('COUNTRY')) \
-                                        .agg(F.sum(F.col("PRICE")).as_("price_nulls")) \
-                                        .with_column("DAILY_SALES", F.call_builtin("ZEROIFNULL", F.col("price_nulls"))) \
-                                        .select(F.col('ORDER_TS_DATE').alias("DATE"), F.col("PRIMARY_CITY").alias("CITY_NAME"), \
-                                        F.col("COUNTRY").alias("COUNTRY_DESC"), F.col("DAILY_SALES"))
-#    orders.limit(5).show()
+def city_metrics_rollup(session, grain, dates=None):
+    # One row per city and week/month. With dates, only the periods those dates fall in are rolled
+    # up. Both sides use the same DATE_TRUNC, so the periods always line up (weeks start on the
+    # account's WEEK_START day, Monday by default)
+    dcm = session.table('ANALYTICS.DAILY_CITY_METRICS').with_column("PERIOD_START", F.date_trunc(grain, F.col("DATE")))
+    if dates is not None:
+        periods = session.create_dataframe([[d] for d in dates], schema=DATES_SCHEMA) \
+                        .select(F.date_trunc(grain, F.col("DATE")).alias("PERIOD_START")).distinct()
+        dcm = dcm.join(periods, dcm['PERIOD_START'] == periods['PERIOD_START'], how='leftsemi')
+    return dcm.group_by(F.col("PERIOD_START"), F.col("CITY_NAME"), F.col("COUNTRY_DESC")) \
+                        .agg( \
+                            F.count(F.lit(1)).alias("DAYS"), \
+                            F.sum(F.col("DAILY_SALES")).alias("TOTAL_SALES"), \
+                            *[F.avg(F.col(c)).alias(c) for c in WEATHER_AVG_COLUMNS], \
+                            F.max(F.col("MAX_WIND_SPEED_100M_MPH")).alias("MAX_WIND_SPEED_100M_MPH") \
+                        ) \
+                        .select(F.col("PERIOD_START"), F.col("CITY_NAME"), F.col("COUNTRY_DESC"), F.col("DAYS"), \
+                            F.col("TOTAL_SALES").cast(SALES_TYPE).alias("TOTAL_SALES"), \
+                            *[F.round(F.col(c), 2).cast(METRIC_TYPE).alias(c) for c in WEATHER_AVG_COLUMNS], \
+                            F.col("MAX_WIND_SPEED_100M_MPH").cast(METRIC_TYPE).alias("MAX_WIND_SPEED_100M_MPH")
+                            )
 
-    weather_pc = session.table("FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.POSTAL_CODES")
-    countries = session.table("RAW_POS.COUNTRY")
-    weather = session.table("FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.HISTORY_DAY")
-    weather = weather.join(weather_pc, (weather['POSTAL_CODE'] == weather_pc['POSTAL_CODE']) & (weather['COUNTRY'] == weather_pc['COUNTRY']), rsuffix='_pc')
-    weather = weather.join(countries, (weather['COUNTRY'] == countries['ISO_COUNTRY']) & (weather['CITY_NAME'] == countries['CITY']), rsuffix='_c')
-    weather = weather.join(orders_stream_dates, weather['DATE_VALID_STD'] == orders_stream_dates['DATE'])
+def create_city_metrics_rollup_table(session, grain):
+    # Rolls up all of DAILY_CITY_METRICS once; after that runs only recompute the periods they touch
+    city_metrics_rollup(session, grain).with_column("META_UPDATED_AT", F.current_timestamp()) \
+                        .write.mode('overwrite').save_as_table(ROLLUP_TABLES[grain])
+
+def update_city_metrics_rollups(session, dates):
+    # Recomputes the weeks and months the merged dates fall in from DAILY_CITY_METRICS. The dates
+    # come in as values, so this never reads (or consumes) the stream
+    if not dates:
+        return
+    for grain, table in ROLLUP_TABLES.items():
+        rollup = city_metrics_rollup(session, grain, dates)
+        updates = {**{c: rollup[c] for c in ROLLUP_COLUMNS}, "META_UPDATED_AT": F.current_timestamp()}
+        target = session.table(table)
+        target.merge(rollup, (target['PERIOD_START'] == rollup['PERIOD_START']) & (target['CITY_NAME'] == rollup['CITY_NAME']) & (target['COUNTRY_DESC'] == rollup['COUNTRY_DESC']), \
+                            [F.when_matched().update(updates), F.when_not_matched().insert(updates)])
 
-    weather_agg = weather.group_by(F.col('DATE_VALID_STD'), F.col('CITY_NAME'), F.col('COUNTRY_C')) \
+
+def aggregate_weather(weather):
+    return weather.group_by(F.col('DATE_VALID_STD'), F.col('CITY_NAME'), F.col('COUNTRY_C')) \
                         .agg( \
                             F.avg('AVG_TEMPERATURE_AIR_2M_F').alias("AVG_TEMPERATURE_F"), \
                             F.avg(F.call_udf("ANALYTICS.FAHRENHEIT_TO_CELSIUS_UDF", F.col("AVG_TEMPERATURE_AIR_2M_F"))).alias("AVG_TEMPERATURE_C"), \
@@ -71,36 +159,309 @@ def merge_daily_city_metrics(session):
                             F.round(F.col("AVG_PRECIPITATION_MM"), 2).alias("AVG_PRECIPITATION_MILLIMETERS"), \
                             F.col("MAX_WIND_SPEED_100M_MPH")
                             )
-#    weather_agg.limit(5).show()
 
-    daily_city_metrics_stg = orders.join(weather_agg, (orders['DATE'] == weather_agg['DATE']) & (orders['CITY_NAME'] == weather_agg['CITY_NAME']) & (orders['COUNTRY_DESC'] == weather_agg['COUNTRY_DESC']), \
+def full_weather_agg(session, dates):
+    # Joins all of the weather history before filtering it down to the dates we need
+    weather_pc = session.table("FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.POSTAL_CODES")
+    countries = session.table("RAW_POS.COUNTRY")
+    weather = session.table("FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.HISTORY_DAY")
+    weather = weather.join(weather_pc, (weather['POSTAL_CODE'] == weather_pc['POSTAL_CODE']) & (weather['COUNTRY'] == weather_pc['COUNTRY']), rsuffix='_pc')
+    weather = weather.join(countries, (weather['COUNTRY'] == countries['ISO_COUNTRY']) & (weather['CITY_NAME'] == countries['CITY']), rsuffix='_c')
+    weather = weather.join(dates, weather['DATE_VALID_STD'] == dates['DATE'])
+    return aggregate_weather(weather)
+
+def pruned_weather_agg(session, dates):
+    # Filters the weather history to the dates we need first, and only carries the
+    # columns we aggregate through the joins
+    weather = session.table("FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.HISTORY_DAY") \
+                        .select(F.col("DATE_VALID_STD"), F.col("POSTAL_CODE"), F.col("COUNTRY"), \
+                            F.col("AVG_TEMPERATURE_AIR_2M_F"), F.col("TOT_PRECIPITATION_IN"), F.col("MAX_WIND_SPEED_100M_MPH"))
+    weather = weather.join(dates, weather['DATE_VALID_STD'] == dates['DATE'], how='leftsemi')
+    weather_pc = session.table("FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.POSTAL_CODES") \
+                        .select(F.col("POSTAL_CODE"), F.col("COUNTRY"), F.col("CITY_NAME"))
+    countries = session.table("RAW_POS.COUNTRY").select(F.col("ISO_COUNTRY"), F.col("CITY"), F.col("COUNTRY"))
+    weather = weather.join(weather_pc, (weather['POSTAL_CODE'] == weather_pc['POSTAL_CODE']) & (weather['COUNTRY'] == weather_pc['COUNTRY']), rsuffix='_pc')
+    weather = weather.join(countries, (weather['COUNTRY'] == countries['ISO_COUNTRY']) & (weather['CITY_NAME'] == countries['CITY']), rsuffix='_c')
+    return aggregate_weather(weather)
+
+def create_city_weather_daily_table(session):
+    # Use an empty aggregate to get exactly the same column types as the weather aggregate
+    dates = session.create_dataframe([[None]], schema=DATES_SCHEMA).na.drop()
+    pruned_weather_agg(session, dates).write.mode('overwrite').save_as_table(CITY_WEATHER_DAILY_TABLE)
+    _ = session.sql("ALTER TABLE {} CLUSTER BY (DATE)".format(CITY_WEATHER_DAILY_TABLE)).collect()
+
+def refresh_city_weather_daily(session, dates, refresh_days=WEATHER_REFRESH_DAYS):
+    # Re-aggregates the dates that aren't cached yet and those within refresh_days of the newest one
+    # (refresh_days=None: all of them), and MERGEs them so overlapping refreshes can't add rows twice
+    if not dates:
+        return
+    date_values = session.create_dataframe([[d] for d in dates], schema=DATES_SCHEMA)
+    if refresh_days is None:
+        refresh_dates = date_values
+    else:
+        cached_dates = session.table(CITY_WEATHER_DAILY_TABLE).select(F.col("DATE")).distinct()
+        new_dates = date_values.join(cached_dates, date_values['DATE'] == cached_dates['DATE'], how='leftanti')
+        refresh_from = max(dates) - datetime.timedelta(days=refresh_days)
+        recent_dates = session.create_dataframe([[d] for d in dates if d >= refresh_from], schema=DATES_SCHEMA)
+        refresh_dates = new_dates.union(recent_dates)
+
+    weather = pruned_weather_agg(session, refresh_dates)
+    updates = {c: weather[c] for c in weather.columns}
+    cache = session.table(CITY_WEATHER_DAILY_TABLE)
+    cache.merge(weather, (cache['DATE'] == weather['DATE']) & (cache['CITY_NAME'] == weather['CITY_NAME']) & (cache['COUNTRY_DESC'] == weather['COUNTRY_DESC']), \
+                        [F.when_matched().update(updates), F.when_not_matched().insert(updates)])
+
+
+def daily_sales(orders):
+    return orders.group_by(F.col('ORDER_TS_DATE'), F.col('PRIMARY_CITY'), F.col('COUNTRY')) \
+                        .agg(F.sum(F.col("PRICE")).as_("price_nulls")) \
+                        .with_column("DAILY_SALES", F.call_builtin("ZEROIFNULL", F.col("price_nulls"))) \
+                        .select(F.col('ORDER_TS_DATE').alias("DATE"), F.col("PRIMARY_CITY").alias("CITY_NAME"), \
+                        F.col("COUNTRY").alias("COUNTRY_DESC"), F.col("DAILY_SALES"))
+
+def daily_city_metrics_stg(orders, weather_agg):
+    return orders.join(weather_agg, (orders['DATE'] == weather_agg['DATE']) & (orders['CITY_NAME'] == weather_agg['CITY_NAME']) & (orders['COUNTRY_DESC'] == weather_agg['COUNTRY_DESC']), \
                         how='left', rsuffix='_w') \
-                    .select("DATE", "CITY_NAME", "COUNTRY_DESC", "DAILY_SALES", \
-                        "AVG_TEMPERATURE_FAHRENHEIT", "AVG_TEMPERATURE_CELSIUS", \
-                        "AVG_PRECIPITATION_INCHES", "AVG_PRECIPITATION_MILLIMETERS", \
-                        "MAX_WIND_SPEED_100M_MPH")
-#    daily_city_metrics_stg.limit(5).show()
+                    .select(*DAILY_CITY_METRICS_STG_COLUMNS)
 
-    cols_to_update = {c: daily_city_metrics_stg[c] for c in daily_city_metrics_stg.schema.names}
+def merge_into_daily_city_metrics(session, stg, block=True):
+    # The column names are known up front, so there's no need for a describe query to get them
+    cols_to_update = {c: stg[c] for c in DAILY_CITY_METRICS_STG_COLUMNS}
     metadata_col_to_update = {"META_UPDATED_AT": F.current_timestamp()}
     updates = {**cols_to_update, **metadata_col_to_update}
 
     dcm = session.table('ANALYTICS.DAILY_CITY_METRICS')
-    dcm.merge(daily_city_metrics_stg, (dcm['DATE'] == daily_city_metrics_stg['DATE']) & (dcm['CITY_NAME'] == daily_city_metrics_stg['CITY_NAME']) & (dcm['COUNTRY_DESC'] == daily_city_metrics_stg['COUNTRY_DESC']), \
-                        [F.when_matched().update(updates), F.when_not_matched().insert(updates)])
+    # With block=False this returns an AsyncJob instead of waiting for the MERGE
+    return dcm.merge(stg, (dcm['DATE'] == stg['DATE']) & (dcm['CITY_NAME'] == stg['CITY_NAME']) & (dcm['COUNTRY_DESC'] == stg['COUNTRY_DESC']), \
+                        [F.when_matched().update(updates), F.when_not_matched().insert(updates)], block=block)
 
-    _ = session.sql('ALTER WAREHOUSE HOL_WH SET WAREHOUSE_SIZE = XSMALL').collect()
+def merge_daily_city_metrics(session, use_weather_cache=True):
+    # One query gets the dates in the stream, and how many rows each has for sizing and the debug
+    # log. Resizing the warehouse commits any open transaction, so this runs before the one below
+    date_counts = session.table('HARMONIZED.ORDERS_STREAM').group_by(F.col("ORDER_TS_DATE")) \
+                                        .agg(F.count(F.lit(1)).alias("RECORDS")).collect()
+    stream_rows = sum(r['RECORDS'] for r in date_counts)
+    logger.debug("%s records in stream", stream_rows)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Stream dates: %s", sorted(r['ORDER_TS_DATE'] for r in date_counts)[:5])
+    with warehouse_size(session, size_for_rows(stream_rows), job='merge_daily_city_metrics'):
+        # The weather refresh, the MERGE and the rollups run in one transaction, so they see the
+        # same stream contents even when ORDERS changes in between, and a failure can't leave the
+        # rollups behind DAILY_CITY_METRICS
+        _ = session.sql("BEGIN").collect()
+        try:
+            dates = [r['ORDER_TS_DATE'] for r in date_counts]
+            merge_stream_dates(session, dates, use_weather_cache=use_weather_cache)
+            update_city_metrics_rollups(session, dates)
+        except Exception:
+            _ = session.sql("ROLLBACK").collect()
+            raise
+        _ = session.sql("COMMIT").collect()
+    return [r['ORDER_TS_DATE'] for r in date_counts]
 
-def main(session: Session) -> str:
-    # Create the DAILY_CITY_METRICS table if it doesn't exist
+def merge_stream_dates(session, dates, use_weather_cache=True):
+    orders_stream_dates = session.table('HARMONIZED.ORDERS_STREAM').select(F.col("ORDER_TS_DATE").alias("DATE")).distinct()
+
+    orders = daily_sales(session.table("HARMONIZED.ORDERS_STREAM"))
+#    orders.limit(5).show()
+
+    if use_weather_cache:
+        # Only the new and recent dates are joined with the weather data, older dates come from the
+        # cache. Writing to the cache from a query on the stream would consume the stream before
+        # the MERGE below, so the (few) stream dates are passed in as values instead. Orders that
+        # reach the stream after its dates were read still find the weather cached for their dates
+        refresh_city_weather_daily(session, dates)
+        weather_cache = session.table(CITY_WEATHER_DAILY_TABLE)
+        weather_agg = weather_cache.join(orders_stream_dates, weather_cache['DATE'] == orders_stream_dates['DATE'], how='leftsemi')
+    else:
+        weather_agg = full_weather_agg(session, orders_stream_dates)
+#    weather_agg.limit(5).show()
+
+    merge_into_daily_city_metrics(session, daily_city_metrics_stg(orders, weather_agg))
+
+def create_missing_tables(session):
+    # Create the DAILY_CITY_METRICS table (and the weather cache and rollups) if they don't exist
     if not table_exists(session, schema='ANALYTICS', name='DAILY_CITY_METRICS'):
         create_daily_city_metrics_table(session)
-    
-    merge_daily_city_metrics(session)
+        clear_metadata_cache(session)
+    if not table_exists(session, schema='ANALYTICS', name='CITY_WEATHER_DAILY'):
+        create_city_weather_daily_table(session)
+        clear_metadata_cache(session)
+    for grain, table in ROLLUP_TABLES.items():
+        if not table_exists(session, schema='ANALYTICS', name=table.split('.')[1]):
+            create_city_metrics_rollup_table(session, grain)
+            clear_metadata_cache(session)
+
+
+def date_chunks(start_date, end_date, chunk_days):
+    chunks = []
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days - 1), end_date)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + datetime.timedelta(days=1)
+    return chunks
+
+def create_backfill_checkpoint_table(session):
+    schema = T.StructType([T.StructField("BACKFILL_ID", T.StringType()),
+                           T.StructField("CHUNK_START", T.DateType()),
+                           T.StructField("CHUNK_END", T.DateType()),
+                           T.StructField("RECORDS", T.LongType()),
+                           T.StructField("META_UPDATED_AT", T.TimestampType())])
+    session.create_dataframe([[None]*len(schema.names)], schema=schema) \
+                        .na.drop() \
+                        .write.mode('overwrite').save_as_table(BACKFILL_CHECKPOINT_TABLE)
+
+def completed_chunks(session, backfill_id):
+    rows = session.table(BACKFILL_CHECKPOINT_TABLE).filter(F.col("BACKFILL_ID") == backfill_id) \
+                        .select(F.col("CHUNK_START"), F.col("CHUNK_END")).collect()
+    return {(r['CHUNK_START'], r['CHUNK_END']) for r in rows}
+
+def checkpoint_chunk(session, backfill_id, chunk, records):
+    session.create_dataframe([[backfill_id, chunk[0], chunk[1], int(records)]], schema=["BACKFILL_ID", "CHUNK_START", "CHUNK_END", "RECORDS"]) \
+                        .with_column("META_UPDATED_AT", F.current_timestamp()) \
+                        .write.mode('append').save_as_table(BACKFILL_CHECKPOINT_TABLE)
+
+def backfill_chunk_stg(session, chunk):
+    # Reads HARMONIZED.ORDERS (not the stream) so a backfill never consumes ORDERS_STREAM
+    orders = session.table('HARMONIZED.ORDERS').filter(F.col("ORDER_TS_DATE").between(F.lit(chunk[0]), F.lit(chunk[1])))
+    weather_cache = session.table(CITY_WEATHER_DAILY_TABLE)
+    weather_agg = weather_cache.filter(F.col("DATE").between(F.lit(chunk[0]), F.lit(chunk[1])))
+    return daily_city_metrics_stg(daily_sales(orders), weather_agg)
+
+def backfill_chunk_table(chunk):
+    return "{}_{}_{}".format(BACKFILL_STAGING_TABLE, chunk[0].strftime('%Y%m%d'), chunk[1].strftime('%Y%m%d'))
+
+def backfill_daily_city_metrics(session, start_date, end_date, chunk_days=31, max_parallel=4, restart=False):
+    # Rebuilds [start_date, end_date] chunk_days at a time, computing up to max_parallel chunks at once
+    # and merging them one by one; finished chunks are checkpointed, so running it again resumes
+    if isinstance(start_date, str):
+        start_date = datetime.date.fromisoformat(start_date)
+    if isinstance(end_date, str):
+        end_date = datetime.date.fromisoformat(end_date)
+    chunk_days, max_parallel = int(chunk_days), int(max_parallel)
+    if chunk_days < 1 or max_parallel < 1:
+        raise ValueError("chunk_days and max_parallel must be at least 1")
+
+    create_missing_tables(session)
+    if not table_exists(session, schema='ANALYTICS', name='DAILY_CITY_METRICS_BACKFILL'):
+        create_backfill_checkpoint_table(session)
+        clear_metadata_cache(session)
+
+    backfill_id = "{}:{}:{}".format(start_date, end_date, chunk_days)
+    if restart:
+        session.table(BACKFILL_CHECKPOINT_TABLE).delete(F.col("BACKFILL_ID") == backfill_id)
+    done = completed_chunks(session, backfill_id)
+    pending = [c for c in date_chunks(start_date, end_date, chunk_days) if c not in done]
+    if not pending:
+        return f"Backfill {backfill_id} already complete"
+
+    # One query gets the order dates in the range and their row counts, for the weather cache and sizing
+    date_counts = session.table('HARMONIZED.ORDERS').filter(F.col("ORDER_TS_DATE").between(F.lit(start_date), F.lit(end_date))) \
+                                        .group_by(F.col("ORDER_TS_DATE")).agg(F.count(F.lit(1)).alias("RECORDS")).collect()
+    chunk_dates = {c: [r['ORDER_TS_DATE'] for r in date_counts if c[0] <= r['ORDER_TS_DATE'] <= c[1]] for c in pending}
+    chunk_rows = {c: sum(r['RECORDS'] for r in date_counts if c[0] <= r['ORDER_TS_DATE'] <= c[1]) for c in pending}
+
+    # The warehouse computes up to max_parallel of the largest chunks at a time
+    concurrent_rows = sum(sorted(chunk_rows.values(), reverse=True)[:max_parallel])
+    queue = list(pending)
+    running = {}
+    failed = []
+    with warehouse_size(session, size_for_rows(concurrent_rows), job='backfill_daily_city_metrics'):
+        while queue or running:
+            while queue and not failed and len(running) < max_parallel:
+                chunk = queue.pop(0)
+                if chunk_rows[chunk] == 0:
+                    checkpoint_chunk(session, backfill_id, chunk, 0)
+                    continue
+                try:
+                    # Without a refresh window: a backfill is how old dates get revised weather
+                    refresh_city_weather_daily(session, chunk_dates[chunk], refresh_days=None)
+                    running[chunk] = backfill_chunk_stg(session, chunk).write \
+                                        .save_as_table(backfill_chunk_table(chunk), mode='overwrite', table_type='temporary', block=False)
+                except Exception as e:
+                    logger.error("Backfill chunk %s..%s failed: %s", chunk[0], chunk[1], e)
+                    failed.append(chunk)
+            if failed:
+                queue = []
+            finished = [c for c, job in running.items() if job.is_done()]
+            if not finished:
+                if running:
+                    time.sleep(BACKFILL_POLL_SECONDS)
+                continue
+            for chunk in finished:
+                job = running.pop(chunk)
+                try:
+                    job.result()
+                    # A chunk's MERGE, rollups and checkpoint are committed together, so a resumed
+                    # backfill never skips a chunk whose rollups weren't updated
+                    _ = session.sql("BEGIN").collect()
+                    try:
+                        merge_into_daily_city_metrics(session, session.table(backfill_chunk_table(chunk)))
+                        update_city_metrics_rollups(session, chunk_dates[chunk])
+                        checkpoint_chunk(session, backfill_id, chunk, chunk_rows[chunk])
+                    except Exception:
+                        _ = session.sql("ROLLBACK").collect()
+                        raise
+                    _ = session.sql("COMMIT").collect()
+                except Exception as e:
+                    logger.error("Backfill chunk %s..%s failed: %s", chunk[0], chunk[1], e)
+                    failed.append(chunk)
+                    continue
+                session.table(backfill_chunk_table(chunk)).drop_table()
+                logger.info("Backfill chunk %s..%s done (%s records)", chunk[0], chunk[1], chunk_rows[chunk])
+
+    if failed:
+        raise RuntimeError("Backfill {}: {} chunk(s) failed, starting with {}..{}; run it again to resume" \
+                            .format(backfill_id, len(failed), failed[0][0], failed[0][1]))
+    return f"Successfully backfilled DAILY_CITY_METRICS from {start_date} to {end_date} in {len(pending)} chunks"
+
+def backfill(session: Session, start_date: str, end_date: str, chunk_days: int, max_parallel: int) -> str:
+    # Handler for DAILY_CITY_METRICS_BACKFILL_SP
+    with profile_step(session, 'backfill_daily_city_metrics'):
+        return backfill_daily_city_metrics(session, start_date, end_date, chunk_days, max_parallel)
+
+
+def main(session: Session) -> str:
+    create_missing_tables(session)
+
+    with profile_step(session, 'merge_daily_city_metrics'):
+        merge_daily_city_metrics(session)
 #    session.table('ANALYTICS.DAILY_CITY_METRICS').limit(5).show()
 
     return f"Successfully processed DAILY_CITY_METRICS"
 
+def count_round_trips(session):
+    # count the queries (including describe queries) one run of main() issues
+    with session.query_history(include_describe=True) as history:
+        main(session)
+    print('main() issued {} queries:'.format(len(history.queries)))
+    for query_record in history.queries:
+        print('\t{}'.format(query_record.sql_text[:100]))
+    return len(history.queries)
+
+def compare_weather_plans(session):
+    # compare the full weather join with the date-pruned one for the dates in the stream
+    dates = session.table('HARMONIZED.ORDERS_STREAM').select(F.col("ORDER_TS_DATE").alias("DATE")).distinct()
+    for name, weather_agg in [('full', full_weather_agg(session, dates)), ('pruned', pruned_weather_agg(session, dates))]:
+        print('{} weather join: {} rows'.format(name, weather_agg.count()))
+        weather_agg.explain()
+    full_rows = full_weather_agg(session, dates).collect()
+    pruned_rows = pruned_weather_agg(session, dates).collect()
+    print('Results match: {}'.format(sorted(full_rows, key=str) == sorted(pruned_rows, key=str)))
+
+def check_rollups(session):
+    # the incrementally maintained rollups should equal rolling up all of DAILY_CITY_METRICS again
+    matches = True
+    for grain, table in ROLLUP_TABLES.items():
+        maintained = session.table(table).select(*ROLLUP_COLUMNS)
+        full = city_metrics_rollup(session, grain)
+        missing, unexpected = full.except_(maintained).count(), maintained.except_(full).count()
+        print('{}: {} rows, {} missing, {} unexpected'.format(table, maintained.count(), missing, unexpected))
+        matches = matches and missing == 0 and unexpected == 0
+    print('Rollups match a full recompute: {}'.format(matches))
+    return matches
+
 
 # For local debugging
 # Be aware you may need to type-convert arguments if you add input parameters
@@ -108,10 +469,20 @@ if __name__ == '__main__':
     # Create a local Snowpark session
     with Session.builder.getOrCreate() as session:
         import sys
-        if len(sys.argv) > 1:
-            print(main(session, *sys.argv[1:]))  # type: ignore
+        args = consume_profile_flag(sys.argv[1:])
+        if args[:1] == ['--backfill']:
+            # --backfill START_DATE END_DATE [CHUNK_DAYS [MAX_PARALLEL]]
+            print(backfill_daily_city_metrics(session, *args[1:]))
+        elif args[:1] == ['--migrate']:
+            print(migrate_daily_city_metrics(session))
+        elif args[:1] == ['--check-rollups']:
+            sys.exit(0 if check_rollups(session) else 1)
+        elif len(args) > 0:
+            print(main(session, *args))  # type: ignore
         else:
             print(main(session))  # type: ignore
+        print_histograms()
+#        count_round_trips(session)
 
 
 ### MERGE  INTO ANALYTICS.DAILY_CITY_METRICS USING ( SELECT "DATE" AS "r_0003_DATE", "CITY_NAME" AS "r_0003_CITY_NAME", "COUNTRY_DESC" AS "r_0003_COUNTRY_DESC", "DAILY_SALES" AS "r_0003_DAILY_SALES", "AVG_TEMPERATURE_FAHRENHEIT" AS "r_0003_AVG_TEMPERATURE_FAHRENHEIT", "AVG_TEMPERATURE_CELSIUS" AS "r_0003_AVG_TEMPERATURE_CELSIUS", "AVG_PRECIPITATION_INCHES" AS "r_0003_AVG_PRECIPITATION_INCHES", "AVG_PRECIPITATION_MILLIMETERS" AS "r_0003_AVG_PRECIPITATION_MILLIMETERS", "MAX_WIND_SPEED_100M_MPH" AS "r_0003_MAX_WIND_SPEED_100M_MPH" FROM ( SELECT  *  FROM (( SELECT "DATE" AS "DATE", "CITY_NAME" AS "CITY_NAME", "COUNTRY_DESC" AS "COUNTRY_DESC", "DAILY_SALES" AS "DAILY_SALES" FROM ( SELECT "ORDER_TS_DATE" AS "DATE", "PRIMARY_CITY" AS "CITY_NAME", "COUNTRY" AS "COUNTRY_DESC", ZEROIFNULL("PRICE_NULLS") AS "DAILY_SALES" FROM ( SELECT "ORDER_TS_DATE", "PRIMARY_CITY", "COUNTRY", sum("PRICE") AS "PRICE_NULLS" FROM ( SELECT  *  FROM HARMONIZED.ORDERS_STREAM) GROUP BY "ORDER_TS_DATE", "PRIMARY_CITY", "COUNTRY"))) AS SNOWPARK_LEFT LEFT OUTER JOIN ( SELECT "DATE" AS "DATE_W", "CITY_NAME" AS "CITY_NAME_W", "COUNTRY_DESC" AS "COUNTRY_DESC_W", "AVG_TEMPERATURE_FAHRENHEIT" AS "AVG_TEMPERATURE_FAHRENHEIT", "AVG_TEMPERATURE_CELSIUS" AS "AVG_TEMPERATURE_CELSIUS", "AVG_PRECIPITATION_INCHES" AS "AVG_PRECIPITATION_INCHES", "AVG_PRECIPITATION_MILLIMETERS" AS "AVG_PRECIPITATION_MILLIMETERS", "MAX_WIND_SPEED_100M_MPH" AS "MAX_WIND_SPEED_100M_MPH" FROM ( SELECT "DATE_VALID_STD" AS "DATE", "CITY_NAME", "COUNTRY_C" AS "COUNTRY_DESC", round("AVG_TEMPERATURE_F", 2) AS "AVG_TEMPERATURE_FAHRENHEIT", round("AVG_TEMPERATURE_C", 2) AS "AVG_TEMPERATURE_CELSIUS", round("AVG_PRECIPITATION_IN", 2) AS "AVG_PRECIPITATION_INCHES", round("AVG_PRECIPITATION_MM", 2) AS "AVG_PRECIPITATION_MILLIMETERS", "MAX_WIND_SPEED_100M_MPH" FROM ( SELECT "DATE_VALID_STD", "CITY_NAME", "COUNTRY_C", avg("AVG_TEMPERATURE_AIR_2M_F") AS "AVG_TEMPERATURE_F", avg(ANALYTICS.FAHRENHEIT_TO_CELSIUS_UDF("AVG_TEMPERATURE_AIR_2M_F")) AS "AVG_TEMPERATURE_C", avg("TOT_PRECIPITATION_IN") AS "AVG_PRECIPITATION_IN", avg(ANALYTICS.INCH_TO_MILLIMETER_UDF("TOT_PRECIPITATION_IN")) AS "AVG_PRECIPITATION_MM", max("MAX_WIND_SPEED_100M_MPH") AS "MAX_WIND_SPEED_100M_MPH" FROM ( SELECT  *  FROM (( SELECT "POSTAL_CODE" AS "POSTAL_CODE", "CITY_NAME" AS "CITY_NAME", "COUNTRY" AS "COUNTRY", "DATE_VALID_STD" AS "DATE_VALID_STD", "DOY_STD" AS "DOY_STD", "MIN_TEMPERATURE_AIR_2M_F" AS "MIN_TEMPERATURE_AIR_2M_F", "AVG_TEMPERATURE_AIR_2M_F" AS "AVG_TEMPERATURE_AIR_2M_F", "MAX_TEMPERATURE_AIR_2M_F" AS "MAX_TEMPERATURE_AIR_2M_F", "MIN_TEMPERATURE_WETBULB_2M_F" AS "MIN_TEMPERATURE_WETBULB_2M_F", "AVG_TEMPERATURE_WETBULB_2M_F" AS "AVG_TEMPERATURE_WETBULB_2M_F", "MAX_TEMPERATURE_WETBULB_2M_F" AS "MAX_TEMPERATURE_WETBULB_2M_F", "MIN_TEMPERATURE_DEWPOINT_2M_F" AS "MIN_TEMPERATURE_DEWPOINT_2M_F", "AVG_TEMPERATURE_DEWPOINT_2M_F" AS "AVG_TEMPERATURE_DEWPOINT_2M_F", "MAX_TEMPERATURE_DEWPOINT_2M_F" AS "MAX_TEMPERATURE_DEWPOINT_2M_F", "MIN_TEMPERATURE_FEELSLIKE_2M_F" AS "MIN_TEMPERATURE_FEELSLIKE_2M_F", "AVG_TEMPERATURE_FEELSLIKE_2M_F" AS "AVG_TEMPERATURE_FEELSLIKE_2M_F", "MAX_TEMPERATURE_FEELSLIKE_2M_F" AS "MAX_TEMPERATURE_FEELSLIKE_2M_F", "MIN_TEMPERATURE_WINDCHILL_2M_F" AS "MIN_TEMPERATURE_WINDCHILL_2M_F", "AVG_TEMPERATURE_WINDCHILL_2M_F" AS "AVG_TEMPERATURE_WINDCHILL_2M_F", "MAX_TEMPERATURE_WINDCHILL_2M_F" AS "MAX_TEMPERATURE_WINDCHILL_2M_F", "MIN_TEMPERATURE_HEATINDEX_2M_F" AS "MIN_TEMPERATURE_HEATINDEX_2M_F", "AVG_TEMPERATURE_HEATINDEX_2M_F" AS "AVG_TEMPERATURE_HEATINDEX_2M_F", "MAX_TEMPERATURE_HEATINDEX_2M_F" AS "MAX_TEMPERATURE_HEATINDEX_2M_F", "MIN_HUMIDITY_RELATIVE_2M_PCT" AS "MIN_HUMIDITY_RELATIVE_2M_PCT", "AVG_HUMIDITY_RELATIVE_2M_PCT" AS "AVG_HUMIDITY_RELATIVE_2M_PCT", "MAX_HUMIDITY_RELATIVE_2M_PCT" AS "MAX_HUMIDITY_RELATIVE_2M_PCT", "MIN_HUMIDITY_SPECIFIC_2M_GPKG" AS "MIN_HUMIDITY_SPECIFIC_2M_GPKG", "AVG_HUMIDITY_SPECIFIC_2M_GPKG" AS "AVG_HUMIDITY_SPECIFIC_2M_GPKG", "MAX_HUMIDITY_SPECIFIC_2M_GPKG" AS "MAX_HUMIDITY_SPECIFIC_2M_GPKG", "MIN_PRESSURE_2M_MB" AS "MIN_PRESSURE_2M_MB", "AVG_PRESSURE_2M_MB" AS "AVG_PRESSURE_2M_MB", "MAX_PRESSURE_2M_MB" AS "MAX_PRESSURE_2M_MB", "MIN_PRESSURE_TENDENCY_2M_MB" AS "MIN_PRESSURE_TENDENCY_2M_MB", "AVG_PRESSURE_TENDENCY_2M_MB" AS "AVG_PRESSURE_TENDENCY_2M_MB", "MAX_PRESSURE_TENDENCY_2M_MB" AS "MAX_PRESSURE_TENDENCY_2M_MB", "MIN_PRESSURE_MEAN_SEA_LEVEL_MB" AS "MIN_PRESSURE_MEAN_SEA_LEVEL_MB", "AVG_PRESSURE_MEAN_SEA_LEVEL_MB" AS "AVG_PRESSURE_MEAN_SEA_LEVEL_MB", "MAX_PRESSURE_MEAN_SEA_LEVEL_MB" AS "MAX_PRESSURE_MEAN_SEA_LEVEL_MB", "MIN_WIND_SPEED_10M_MPH" AS "MIN_WIND_SPEED_10M_MPH", "AVG_WIND_SPEED_10M_MPH" AS "AVG_WIND_SPEED_10M_MPH", "MAX_WIND_SPEED_10M_MPH" AS "MAX_WIND_SPEED_10M_MPH", "AVG_WIND_DIRECTION_10M_DEG" AS "AVG_WIND_DIRECTION_10M_DEG", "MIN_WIND_SPEED_80M_MPH" AS "MIN_WIND_SPEED_80M_MPH", "AVG_WIND_SPEED_80M_MPH" AS "AVG_WIND_SPEED_80M_MPH", "MAX_WIND_SPEED_80M_MPH" AS "MAX_WIND_SPEED_80M_MPH", "AVG_WIND_DIRECTION_80M_DEG" AS "AVG_WIND_DIRECTION_80M_DEG", "MIN_WIND_SPEED_100M_MPH" AS "MIN_WIND_SPEED_100M_MPH", "AVG_WIND_SPEED_100M_MPH" AS "AVG_WIND_SPEED_100M_MPH", "MAX_WIND_SPEED_100M_MPH" AS "MAX_WIND_SPEED_100M_MPH", "AVG_WIND_DIRECTION_100M_DEG" AS "AVG_WIND_DIRECTION_100M_DEG", "TOT_PRECIPITATION_IN" AS "TOT_PRECIPITATION_IN", "TOT_SNOWFALL_IN" AS "TOT_SNOWFALL_IN", "TOT_SNOWDEPTH_IN" AS "TOT_SNOWDEPTH_IN", "MIN_CLOUD_COVER_TOT_PCT" AS "MIN_CLOUD_COVER_TOT_PCT", "AVG_CLOUD_COVER_TOT_PCT" AS "AVG_CLOUD_COVER_TOT_PCT", "MAX_CLOUD_COVER_TOT_PCT" AS "MAX_CLOUD_COVER_TOT_PCT", "MIN_RADIATION_SOLAR_TOTAL_WPM2" AS "MIN_RADIATION_SOLAR_TOTAL_WPM2", "AVG_RADIATION_SOLAR_TOTAL_WPM2" AS "AVG_RADIATION_SOLAR_TOTAL_WPM2", "MAX_RADIATION_SOLAR_TOTAL_WPM2" AS "MAX_RADIATION_SOLAR_TOTAL_WPM2", "TOT_RADIATION_SOLAR_TOTAL_WPM2" AS "TOT_RADIATION_SOLAR_TOTAL_WPM2", "POSTAL_CODE_PC" AS "POSTAL_CODE_PC", "CITY_NAME_PC" AS "CITY_NAME_PC", "COUNTRY_PC" AS "COUNTRY_PC", "COUNTRY_ID" AS "COUNTRY_ID", "COUNTRY_C" AS "COUNTRY_C", "ISO_CURRENCY" AS "ISO_CURRENCY", "ISO_COUNTRY" AS "ISO_COUNTRY", "CITY_ID" AS "CITY_ID", "CITY" AS "CITY", "CITY_POPULATION" AS "CITY_POPULATION" FROM ( SELECT  *  FROM (( SELECT "POSTAL_CODE" AS "POSTAL_CODE", "CITY_NAME" AS "CITY_NAME", "COUNTRY" AS "COUNTRY", "DATE_VALID_STD" AS "DATE_VALID_STD", "DOY_STD" AS "DOY_STD", "MIN_TEMPERATURE_AIR_2M_F" AS "MIN_TEMPERATURE_AIR_2M_F", "AVG_TEMPERATURE_AIR_2M_F" AS "AVG_TEMPERATURE_AIR_2M_F", "MAX_TEMPERATURE_AIR_2M_F" AS "MAX_TEMPERATURE_AIR_2M_F", "MIN_TEMPERATURE_WETBULB_2M_F" AS "MIN_TEMPERATURE_WETBULB_2M_F", "AVG_TEMPERATURE_WETBULB_2M_F" AS "AVG_TEMPERATURE_WETBULB_2M_F", "MAX_TEMPERATURE_WETBULB_2M_F" AS "MAX_TEMPERATURE_WETBULB_2M_F", "MIN_TEMPERATURE_DEWPOINT_2M_F" AS "MIN_TEMPERATURE_DEWPOINT_2M_F", "AVG_TEMPERATURE_DEWPOINT_2M_F" AS "AVG_TEMPERATURE_DEWPOINT_2M_F", "MAX_TEMPERATURE_DEWPOINT_2M_F" AS "MAX_TEMPERATURE_DEWPOINT_2M_F", "MIN_TEMPERATURE_FEELSLIKE_2M_F" AS "MIN_TEMPERATURE_FEELSLIKE_2M_F", "AVG_TEMPERATURE_FEELSLIKE_2M_F" AS "AVG_TEMPERATURE_FEELSLIKE_2M_F", "MAX_TEMPERATURE_FEELSLIKE_2M_F" AS "MAX_TEMPERATURE_FEELSLIKE_2M_F", "MIN_TEMPERATURE_WINDCHILL_2M_F" AS "MIN_TEMPERATURE_WINDCHILL_2M_F", "AVG_TEMPERATURE_WINDCHILL_2M_F" AS "AVG_TEMPERATURE_WINDCHILL_2M_F", "MAX_TEMPERATURE_WINDCHILL_2M_F" AS "MAX_TEMPERATURE_WINDCHILL_2M_F", "MIN_TEMPERATURE_HEATINDEX_2M_F" AS "MIN_TEMPERATURE_HEATINDEX_2M_F", "AVG_TEMPERATURE_HEATINDEX_2M_F" AS "AVG_TEMPERATURE_HEATINDEX_2M_F", "MAX_TEMPERATURE_HEATINDEX_2M_F" AS "MAX_TEMPERATURE_HEATINDEX_2M_F", "MIN_HUMIDITY_RELATIVE_2M_PCT" AS "MIN_HUMIDITY_RELATIVE_2M_PCT", "AVG_HUMIDITY_RELATIVE_2M_PCT" AS "AVG_HUMIDITY_RELATIVE_2M_PCT", "MAX_HUMIDITY_RELATIVE_2M_PCT" AS "MAX_HUMIDITY_RELATIVE_2M_PCT", "MIN_HUMIDITY_SPECIFIC_2M_GPKG" AS "MIN_HUMIDITY_SPECIFIC_2M_GPKG", "AVG_HUMIDITY_SPECIFIC_2M_GPKG" AS "AVG_HUMIDITY_SPECIFIC_2M_GPKG", "MAX_HUMIDITY_SPECIFIC_2M_GPKG" AS "MAX_HUMIDITY_SPECIFIC_2M_GPKG", "MIN_PRESSURE_2M_MB" AS "MIN_PRESSURE_2M_MB", "AVG_PRESSURE_2M_MB" AS "AVG_PRESSURE_2M_MB", "MAX_PRESSURE_2M_MB" AS "MAX_PRESSURE_2M_MB", "MIN_PRESSURE_TENDENCY_2M_MB" AS "MIN_PRESSURE_TENDENCY_2M_MB", "AVG_PRESSURE_TENDENCY_2M_MB" AS "AVG_PRESSURE_TENDENCY_2M_MB", "MAX_PRESSURE_TENDENCY_2M_MB" AS "MAX_PRESSURE_TENDENCY_2M_MB", "MIN_PRESSURE_MEAN_SEA_LEVEL_MB" AS "MIN_PRESSURE_MEAN_SEA_LEVEL_MB", "AVG_PRESSURE_MEAN_SEA_LEVEL_MB" AS "AVG_PRESSURE_MEAN_SEA_LEVEL_MB", "MAX_PRESSURE_MEAN_SEA_LEVEL_MB" AS "MAX_PRESSURE_MEAN_SEA_LEVEL_MB", "MIN_WIND_SPEED_10M_MPH" AS "MIN_WIND_SPEED_10M_MPH", "AVG_WIND_SPEED_10M_MPH" AS "AVG_WIND_SPEED_10M_MPH", "MAX_WIND_SPEED_10M_MPH" AS "MAX_WIND_SPEED_10M_MPH", "AVG_WIND_DIRECTION_10M_DEG" AS "AVG_WIND_DIRECTION_10M_DEG", "MIN_WIND_SPEED_80M_MPH" AS "MIN_WIND_SPEED_80M_MPH", "AVG_WIND_SPEED_80M_MPH" AS "AVG_WIND_SPEED_80M_MPH", "MAX_WIND_SPEED_80M_MPH" AS "MAX_WIND_SPEED_80M_MPH", "AVG_WIND_DIRECTION_80M_DEG" AS "AVG_WIND_DIRECTION_80M_DEG", "MIN_WIND_SPEED_100M_MPH" AS "MIN_WIND_SPEED_100M_MPH", "AVG_WIND_SPEED_100M_MPH" AS "AVG_WIND_SPEED_100M_MPH", "MAX_WIND_SPEED_100M_MPH" AS "MAX_WIND_SPEED_100M_MPH", "AVG_WIND_DIRECTION_100M_DEG" AS "AVG_WIND_DIRECTION_100M_DEG", "TOT_PRECIPITATION_IN" AS "TOT_PRECIPITATION_IN", "TOT_SNOWFALL_IN" AS "TOT_SNOWFALL_IN", "TOT_SNOWDEPTH_IN" AS "TOT_SNOWDEPTH_IN", "MIN_CLOUD_COVER_TOT_PCT" AS "MIN_CLOUD_COVER_TOT_PCT", "AVG_CLOUD_COVER_TOT_PCT" AS "AVG_CLOUD_COVER_TOT_PCT", "MAX_CLOUD_COVER_TOT_PCT" AS "MAX_CLOUD_COVER_TOT_PCT", "MIN_RADIATION_SOLAR_TOTAL_WPM2" AS "MIN_RADIATION_SOLAR_TOTAL_WPM2", "AVG_RADIATION_SOLAR_TOTAL_WPM2" AS "AVG_RADIATION_SOLAR_TOTAL_WPM2", "MAX_RADIATION_SOLAR_TOTAL_WPM2" AS "MAX_RADIATION_SOLAR_TOTAL_WPM2", "TOT_RADIATION_SOLAR_TOTAL_WPM2" AS "TOT_RADIATION_SOLAR_TOTAL_WPM2", "POSTAL_CODE_PC" AS "POSTAL_CODE_PC", "CITY_NAME_PC" AS "CITY_NAME_PC", "COUNTRY_PC" AS "COUNTRY_PC" FROM ( SELECT  *  FROM (( SELECT "POSTAL_CODE" AS "POSTAL_CODE", "CITY_NAME" AS "CITY_NAME", "COUNTRY" AS "COUNTRY", "DATE_VALID_STD" AS "DATE_VALID_STD", "DOY_STD" AS "DOY_STD", "MIN_TEMPERATURE_AIR_2M_F" AS "MIN_TEMPERATURE_AIR_2M_F", "AVG_TEMPERATURE_AIR_2M_F" AS "AVG_TEMPERATURE_AIR_2M_F", "MAX_TEMPERATURE_AIR_2M_F" AS "MAX_TEMPERATURE_AIR_2M_F", "MIN_TEMPERATURE_WETBULB_2M_F" AS "MIN_TEMPERATURE_WETBULB_2M_F", "AVG_TEMPERATURE_WETBULB_2M_F" AS "AVG_TEMPERATURE_WETBULB_2M_F", "MAX_TEMPERATURE_WETBULB_2M_F" AS "MAX_TEMPERATURE_WETBULB_2M_F", "MIN_TEMPERATURE_DEWPOINT_2M_F" AS "MIN_TEMPERATURE_DEWPOINT_2M_F", "AVG_TEMPERATURE_DEWPOINT_2M_F" AS "AVG_TEMPERATURE_DEWPOINT_2M_F", "MAX_TEMPERATURE_DEWPOINT_2M_F" AS "MAX_TEMPERATURE_DEWPOINT_2M_F", "MIN_TEMPERATURE_FEELSLIKE_2M_F" AS "MIN_TEMPERATURE_FEELSLIKE_2M_F", "AVG_TEMPERATURE_FEELSLIKE_2M_F" AS "AVG_TEMPERATURE_FEELSLIKE_2M_F", "MAX_TEMPERATURE_FEELSLIKE_2M_F" AS "MAX_TEMPERATURE_FEELSLIKE_2M_F", "MIN_TEMPERATURE_WINDCHILL_2M_F" AS "MIN_TEMPERATURE_WINDCHILL_2M_F", "AVG_TEMPERATURE_WINDCHILL_2M_F" AS "AVG_TEMPERATURE_WINDCHILL_2M_F", "MAX_TEMPERATURE_WINDCHILL_2M_F" AS "MAX_TEMPERATURE_WINDCHILL_2M_F", "MIN_TEMPERATURE_HEATINDEX_2M_F" AS "MIN_TEMPERATURE_HEATINDEX_2M_F", "AVG_TEMPERATURE_HEATINDEX_2M_F" AS "AVG_TEMPERATURE_HEATINDEX_2M_F", "MAX_TEMPERATURE_HEATINDEX_2M_F" AS "MAX_TEMPERATURE_HEATINDEX_2M_F", "MIN_HUMIDITY_RELATIVE_2M_PCT" AS "MIN_HUMIDITY_RELATIVE_2M_PCT", "AVG_HUMIDITY_RELATIVE_2M_PCT" AS "AVG_HUMIDITY_RELATIVE_2M_PCT", "MAX_HUMIDITY_RELATIVE_2M_PCT" AS "MAX_HUMIDITY_RELATIVE_2M_PCT", "MIN_HUMIDITY_SPECIFIC_2M_GPKG" AS "MIN_HUMIDITY_SPECIFIC_2M_GPKG", "AVG_HUMIDITY_SPECIFIC_2M_GPKG" AS "AVG_HUMIDITY_SPECIFIC_2M_GPKG", "MAX_HUMIDITY_SPECIFIC_2M_GPKG" AS "MAX_HUMIDITY_SPECIFIC_2M_GPKG", "MIN_PRESSURE_2M_MB" AS "MIN_PRESSURE_2M_MB", "AVG_PRESSURE_2M_MB" AS "AVG_PRESSURE_2M_MB", "MAX_PRESSURE_2M_MB" AS "MAX_PRESSURE_2M_MB", "MIN_PRESSURE_TENDENCY_2M_MB" AS "MIN_PRESSURE_TENDENCY_2M_MB", "AVG_PRESSURE_TENDENCY_2M_MB" AS "AVG_PRESSURE_TENDENCY_2M_MB", "MAX_PRESSURE_TENDENCY_2M_MB" AS "MAX_PRESSURE_TENDENCY_2M_MB", "MIN_PRESSURE_MEAN_SEA_LEVEL_MB" AS "MIN_PRESSURE_MEAN_SEA_LEVEL_MB", "AVG_PRESSURE_MEAN_SEA_LEVEL_MB" AS "AVG_PRESSURE_MEAN_SEA_LEVEL_MB", "MAX_PRESSURE_MEAN_SEA_LEVEL_MB" AS "MAX_PRESSURE_MEAN_SEA_LEVEL_MB", "MIN_WIND_SPEED_10M_MPH" AS "MIN_WIND_SPEED_10M_MPH", "AVG_WIND_SPEED_10M_MPH" AS "AVG_WIND_SPEED_10M_MPH", "MAX_WIND_SPEED_10M_MPH" AS "MAX_WIND_SPEED_10M_MPH", "AVG_WIND_DIRECTION_10M_DEG" AS "AVG_WIND_DIRECTION_10M_DEG", "MIN_WIND_SPEED_80M_MPH" AS "MIN_WIND_SPEED_80M_MPH", "AVG_WIND_SPEED_80M_MPH" AS "AVG_WIND_SPEED_80M_MPH", "MAX_WIND_SPEED_80M_MPH" AS "MAX_WIND_SPEED_80M_MPH", "AVG_WIND_DIRECTION_80M_DEG" AS "AVG_WIND_DIRECTION_80M_DEG", "MIN_WIND_SPEED_100M_MPH" AS "MIN_WIND_SPEED_100M_MPH", "AVG_WIND_SPEED_100M_MPH" AS "AVG_WIND_SPEED_100M_MPH", "MAX_WIND_SPEED_100M_MPH" AS "MAX_WIND_SPEED_100M_MPH", "AVG_WIND_DIRECTION_100M_DEG" AS "AVG_WIND_DIRECTION_100M_DEG", "TOT_PRECIPITATION_IN" AS "TOT_PRECIPITATION_IN", "TOT_SNOWFALL_IN" AS "TOT_SNOWFALL_IN", "TOT_SNOWDEPTH_IN" AS "TOT_SNOWDEPTH_IN", "MIN_CLOUD_COVER_TOT_PCT" AS "MIN_CLOUD_COVER_TOT_PCT", "AVG_CLOUD_COVER_TOT_PCT" AS "AVG_CLOUD_COVER_TOT_PCT", "MAX_CLOUD_COVER_TOT_PCT" AS "MAX_CLOUD_COVER_TOT_PCT", "MIN_RADIATION_SOLAR_TOTAL_WPM2" AS "MIN_RADIATION_SOLAR_TOTAL_WPM2", "AVG_RADIATION_SOLAR_TOTAL_WPM2" AS "AVG_RADIATION_SOLAR_TOTAL_WPM2", "MAX_RADIATION_SOLAR_TOTAL_WPM2" AS "MAX_RADIATION_SOLAR_TOTAL_WPM2", "TOT_RADIATION_SOLAR_TOTAL_WPM2" AS "TOT_RADIATION_SOLAR_TOTAL_WPM2" FROM FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.HISTORY_DAY) AS SNOWPARK_LEFT INNER JOIN ( SELECT "POSTAL_CODE" AS "POSTAL_CODE_PC", "CITY_NAME" AS "CITY_NAME_PC", "COUNTRY" AS "COUNTRY_PC" FROM FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.POSTAL_CODES) AS SNOWPARK_RIGHT ON (("POSTAL_CODE" = "POSTAL_CODE_PC") AND ("COUNTRY" = "COUNTRY_PC"))))) AS SNOWPARK_LEFT INNER JOIN ( SELECT "COUNTRY_ID" AS "COUNTRY_ID", "COUNTRY" AS "COUNTRY_C", "ISO_CURRENCY" AS "ISO_CURRENCY", "ISO_COUNTRY" AS "ISO_COUNTRY", "CITY_ID" AS "CITY_ID", "CITY" AS "CITY", "CITY_POPULATION" AS "CITY_POPULATION" FROM RAW_POS.COUNTRY) AS SNOWPARK_RIGHT ON (("COUNTRY" = "ISO_COUNTRY") AND ("CITY_NAME" = "CITY"))))) AS SNOWPARK_LEFT INNER JOIN ( SELECT "DATE" AS "DATE" FROM ( SELECT "DATE" FROM ( SELECT "ORDER_TS_DATE" AS "DATE" FROM HARMONIZED.ORDERS_STREAM) GROUP BY "DATE")) AS SNOWPARK_RIGHT ON ("DATE_VALID_STD" = "DATE"))) GROUP BY "DATE_VALID_STD", "CITY_NAME", "COUNTRY_C"))) AS SNOWPARK_RIGHT ON ((("DATE" = "DATE_W") AND ("CITY_NAME" = "CITY_NAME_W")) AND ("COUNTRY_DESC" = "COUNTRY_DESC_W"))))) ON ((("DATE" = "r_0003_DATE") AND ("CITY_NAME" = "r_0003_CITY_NAME")) AND ("COUNTRY_DESC" = "r_0003_COUNTRY_DESC")) WHEN  MATCHED  THEN  UPDATE  SET "DATE" = "r_0003_DATE", "CITY_NAME" = "r_0003_CITY_NAME", "COUNTRY_DESC" = "r_0003_COUNTRY_DESC", "DAILY_SALES" = "r_0003_DAILY_SALES", "AVG_TEMPERATURE_FAHRENHEIT" = "r_0003_AVG_TEMPERATURE_FAHRENHEIT", "AVG_TEMPERATURE_CELSIUS" = "r_0003_AVG_TEMPERATURE_CELSIUS", "AVG_PRECIPITATION_INCHES" = "r_0003_AVG_PRECIPITATION_INCHES", "AVG_PRECIPITATION_MILLIMETERS" = "r_0003_AVG_PRECIPITATION_MILLIMETERS", "MAX_WIND_SPEED_100M_MPH" = "r_0003_MAX_WIND_SPEED_100M_MPH", "META_UPDATED_AT" = current_timestamp() WHEN  NOT  MATCHED  THEN  INSERT ("DATE", "CITY_NAME", "COUNTRY_DESC", "DAILY_SALES", "AVG_TEMPERATURE_FAHRENHEIT", "AVG_TEMPERATURE_CELSIUS", "AVG_PRECIPITATION_INCHES", "AVG_PRECIPITATION_MILLIMETERS", "MAX_WIND_SPEED_100M_MPH", "META_UPDATED_AT") VALUES ("r_0003_DATE", "r_0003_CITY_NAME", "r_0003_COUNTRY_DESC", "r_0003_DAILY_SALES", "r_0003_AVG_TEMPERATURE_FAHRENHEIT", "r_0003_AVG_TEMPERATURE_CELSIUS", "r_0003_AVG_PRECIPITATION_INCHES", "r_0003_AVG_PRECIPITATION_MILLIMETERS", "r_0003_MAX_WIND_SPEED_100M_MPH", current_timestamp())
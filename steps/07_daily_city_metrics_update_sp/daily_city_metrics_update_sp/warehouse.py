@@ -0,0 +1,91 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       warehouse.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+# SNOWFLAKE ADVANTAGE: Warehouse elasticity (dynamic scaling)
+
+# Sizes the shared warehouse for a job based on how much data it has to process, and
+# always puts it back afterwards. Jobs running at the same time in one process share
+# the warehouse: it stays at the largest size any of them asked for until the last
+# one is done.
+#
+# That bookkeeping is per process. Stored procedures each run in their own session, so
+# jobs in different procedures don't know about each other. The tasks in
+# 08_orchestrate_jobs.sql run one after the other, but when a procedure call overlaps
+# them (a backfill, or a manual call), the first job to finish puts the warehouse back
+# while the other is still running, and its remaining queries run on the smaller size.
+# Run overlapping jobs from one process (08_orchestrate_jobs.py), or give them their
+# own warehouses.
+#
+# Each Snowpark project is deployed on its own, so an identical copy of this module
+# lives in every project that needs it (steps/, 06_orders_update_sp and
+# 07_daily_city_metrics_update_sp). tests/test_shared_modules.py fails when they differ.
+
+import threading
+import time
+from contextlib import contextmanager
+
+WAREHOUSE_NAME = 'HOL_WH'
+DEFAULT_WAREHOUSE_SIZE = 'XSMALL'
+WAREHOUSE_SIZES = ['XSMALL', 'SMALL', 'MEDIUM', 'LARGE', 'XLARGE']
+CREDITS_PER_HOUR = {'XSMALL': 1, 'SMALL': 2, 'MEDIUM': 4, 'LARGE': 8, 'XLARGE': 16}
+
+# Smallest size to use for at least this many rows / bytes of input
+ROWS_PER_SIZE = [(200000000, 'XLARGE'), (50000000, 'LARGE'), (10000000, 'MEDIUM'), (1000000, 'SMALL')]
+BYTES_PER_SIZE = [(100 * 1024**3, 'XLARGE'), (25 * 1024**3, 'LARGE'), (5 * 1024**3, 'MEDIUM'), (1024**3, 'SMALL')]
+
+_lock = threading.Lock()
+_holders = {}
+_current_sizes = {}
+
+def size_for_rows(rows):
+    for threshold, size in ROWS_PER_SIZE:
+        if rows >= threshold:
+            return size
+    return DEFAULT_WAREHOUSE_SIZE
+
+def size_for_bytes(num_bytes):
+    for threshold, size in BYTES_PER_SIZE:
+        if num_bytes >= threshold:
+            return size
+    return DEFAULT_WAREHOUSE_SIZE
+
+def largest_size(sizes):
+    return max(sizes, key=WAREHOUSE_SIZES.index)
+
+def set_warehouse_size(session, size, warehouse=WAREHOUSE_NAME):
+    if WAREHOUSE_SIZES.index(size) > WAREHOUSE_SIZES.index(_current_sizes.get(warehouse, DEFAULT_WAREHOUSE_SIZE)):
+        # Wait for the new servers when growing so the job gets the capacity it asked for
+        _ = session.sql("ALTER WAREHOUSE {} SET WAREHOUSE_SIZE = {} WAIT_FOR_COMPLETION = TRUE".format(warehouse, size)).collect()
+    else:
+        _ = session.sql("ALTER WAREHOUSE {} SET WAREHOUSE_SIZE = {}".format(warehouse, size)).collect()
+    _current_sizes[warehouse] = size
+
+@contextmanager
+def warehouse_size(session, size, job=None, warehouse=WAREHOUSE_NAME, restore_size=DEFAULT_WAREHOUSE_SIZE):
+    with _lock:
+        holders = _holders.setdefault(warehouse, [])
+        wanted = largest_size(holders + [size])
+        # Don't trust the warehouse's size until this process has set it once
+        if wanted != _current_sizes.get(warehouse):
+            set_warehouse_size(session, wanted, warehouse=warehouse)
+        # Only count the job once the resize worked, a failed ALTER leaves nothing behind
+        holders.append(size)
+        used_size = _current_sizes[warehouse]
+
+    start = time.time()
+    try:
+        yield used_size
+    finally:
+        elapsed = time.time() - start
+        with _lock:
+            holders.remove(size)
+            wanted = largest_size(holders) if holders else restore_size
+            if wanted != _current_sizes[warehouse]:
+                set_warehouse_size(session, wanted, warehouse=warehouse)
+        print("{}: {} at {} for {:.1f}s ({:.1f} size-seconds, {:.4f} credits)".format( \
+                job or 'job', warehouse, used_size, elapsed, \
+                elapsed * CREDITS_PER_HOUR[used_size], elapsed * CREDITS_PER_HOUR[used_size] / 3600))
@@ -0,0 +1,251 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       08_orchestrate_jobs.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+# Runs the same task graph as 08_orchestrate_jobs.sql, but locally from Python, so that
+# it can be timed and load tested (including against Snowpark local testing mode).
+#
+#   LOAD_RAW_FILES -> ORDERS_UPDATE -> DAILY_CITY_METRICS_UPDATE
+#   (CREATE_POS_VIEW runs once, before ORDERS_UPDATE, unless the view and its stream
+#   already exist)
+#
+# The script exits with 1 when a node failed. With --local-testing the pipeline runs
+# on a Snowpark local testing session (benchmark/local_session.py) over a synthetic
+# data set (benchmark/generate_data.py), which needs the packages in
+# benchmark/requirements.txt.
+#
+#   python steps/08_orchestrate_jobs.py --local-testing --batches 2 --interval 0
+
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from snowflake.snowpark import Session
+
+STEPS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_DIRECTORY = os.path.join(os.path.dirname(STEPS_DIRECTORY), 'benchmark')
+MAX_CONCURRENT_NODES = 4
+MICRO_BATCH_INTERVAL_SECONDS = 60
+POS_FLATTENED_V_STREAM = 'HARMONIZED.POS_FLATTENED_V_STREAM'
+ORDERS_STREAM = 'HARMONIZED.ORDERS_STREAM'
+# Settings for --local-testing
+LOCAL_DATA_DIRECTORY = 'benchmark_data'
+LOCAL_DATA_SCALE = '250'
+
+# The stored procedures import their helper modules (like warehouse.py) as top-level
+# modules, and identical copies of those live in this folder
+sys.path.insert(0, STEPS_DIRECTORY)
+from profiling import enable_profiling, print_histograms
+
+def load_step(module_name, relative_path):
+    # The step scripts start with a number, so they can't be imported by name
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(STEPS_DIRECTORY, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def stream_has_data(stream_name):
+    def check(session):
+        try:
+            return bool(session.sql("SELECT SYSTEM$STREAM_HAS_DATA('{}') AS HAS_DATA".format(stream_name)).collect()[0]['HAS_DATA'])
+        except Exception:
+            # Local testing mode doesn't support SYSTEM$ functions, so look at the stream itself
+            return session.table(stream_name).limit(1).count() > 0
+    return check
+
+def pos_view_and_stream_exist(session):
+    views = session.sql("SHOW VIEWS LIKE 'POS_FLATTENED_V' IN SCHEMA HARMONIZED").collect()
+    streams = session.sql("SHOW STREAMS LIKE 'POS_FLATTENED_V_STREAM' IN SCHEMA HARMONIZED").collect()
+    return len(views) > 0 and any(str(r['stale']).lower() == 'false' for r in streams)
+
+def build_pipeline(replace_pos_view=False):
+    load_raw = load_step('load_raw', '02_load_raw.py')
+    create_pos_view = load_step('create_pos_view', '04_create_pos_view.py')
+    orders_update_sp = load_step('orders_update_sp', '06_orders_update_sp/orders_update_sp/procedure.py')
+    daily_city_metrics_update_sp = load_step('daily_city_metrics_update_sp', '07_daily_city_metrics_update_sp/daily_city_metrics_update_sp/procedure.py')
+
+    def create_pos_view_and_stream(session):
+        # Replacing the stream would throw away its offset and start over from all rows in the
+        # view (SHOW_INITIAL_ROWS), so an existing view and stream are kept unless asked otherwise
+        if not replace_pos_view and pos_view_and_stream_exist(session):
+            print("POS_FLATTENED_V and its stream already exist")
+            return
+        create_pos_view.create_pos_view(session)
+        create_pos_view.create_pos_view_stream(session)
+
+    # Each node has the function to run, the nodes it runs after, an optional predicate that
+    # has to be true for it to run (like the WHEN clause on a task), and the table whose rows
+    # it processes
+    return {
+        "LOAD_RAW_FILES": {"run": load_raw.load_new_raw_files, "after": [], "when": None, "rows_from": None, "once": False},
+        "CREATE_POS_VIEW": {"run": create_pos_view_and_stream, "after": [], "when": None, "rows_from": None, "once": True},
+        "ORDERS_UPDATE": {"run": orders_update_sp.main, "after": ["LOAD_RAW_FILES", "CREATE_POS_VIEW"], \
+                          "when": stream_has_data(POS_FLATTENED_V_STREAM), \
+                          "rows_from": POS_FLATTENED_V_STREAM, "once": False},
+        "DAILY_CITY_METRICS_UPDATE": {"run": daily_city_metrics_update_sp.main, "after": ["ORDERS_UPDATE"], \
+                                      "when": stream_has_data(ORDERS_STREAM), \
+                                      "rows_from": ORDERS_STREAM, "once": False},
+    }
+
+def create_local_pipeline_session(data_directory=LOCAL_DATA_DIRECTORY, scale=LOCAL_DATA_SCALE):
+    # A local testing session with the dimension and weather tables of a synthetic data set loaded;
+    # the order files are left for LOAD_RAW_FILES
+    # Local testing warns a lot about pandas behaviour, which doesn't matter here
+    import warnings
+    warnings.simplefilter('ignore')
+    sys.path.insert(0, BENCHMARK_DIRECTORY)
+    from generate_data import generate
+    from local_session import create_local_session
+    from run_benchmark import load_raw_tables, RAW_TABLES
+    data_directory = os.path.join(data_directory, scale)
+    generate(data_directory, scale)
+    session, streams = create_local_session()
+    load_raw_tables(session, data_directory, folders=[f for f in RAW_TABLES if f.split('/')[-1] not in ('order_header', 'order_detail')])
+    return session, streams, data_directory
+
+def build_local_pipeline(streams, data_directory, replace_pos_view=False):
+    # The same graph on a local testing session. LOAD_RAW_FILES reads the order files from
+    # the data set's folder, and after each node the streams it wrote to or read from are
+    # brought up to date, which Snowflake does by itself
+    pipeline = build_pipeline(replace_pos_view=replace_pos_view)
+    load_raw = load_step('load_raw', '02_load_raw.py')
+    # Local tables only live as long as the session, so the ledger starts empty every run
+    state_directory = tempfile.mkdtemp()
+
+    def load_raw_files(session):
+        load_raw.load_new_raw_files(session, ledger_path=os.path.join(state_directory, load_raw.INGEST_LEDGER_FILE), \
+                                    manifest_path=os.path.join(state_directory, load_raw.MANIFEST_FILE), registry_path=None, \
+                                    list_files=load_raw.local_file_lister(data_directory), \
+                                    copy_files=load_raw.local_file_copier(data_directory))
+        if POS_FLATTENED_V_STREAM in streams.streams:
+            streams.refresh(POS_FLATTENED_V_STREAM)
+
+    def then_update_streams(run, consumed, refreshed=None):
+        def run_and_update_streams(session):
+            run(session)
+            streams.consume(consumed)
+            if refreshed in streams.streams:
+                streams.refresh(refreshed)
+        return run_and_update_streams
+
+    pipeline['LOAD_RAW_FILES']['run'] = load_raw_files
+    pipeline['ORDERS_UPDATE']['run'] = then_update_streams(pipeline['ORDERS_UPDATE']['run'], POS_FLATTENED_V_STREAM, ORDERS_STREAM)
+    pipeline['DAILY_CITY_METRICS_UPDATE']['run'] = then_update_streams(pipeline['DAILY_CITY_METRICS_UPDATE']['run'], ORDERS_STREAM)
+    return pipeline
+
+def run_node(session, name, node, count_rows):
+    start = time.time()
+    if node['when'] is not None and not node['when'](session):
+        return {"node": name, "status": "skipped", "rows": 0, "seconds": time.time() - start}
+    rows = None
+    try:
+        # A full count of the node's input, so only when asked for
+        if count_rows and node['rows_from']:
+            rows = session.table(node['rows_from']).count()
+        node['run'](session)
+        status = "succeeded"
+    except Exception as e:
+        print("{} failed: {}".format(name, e))
+        status = "failed"
+    return {"node": name, "status": status, "rows": rows, "seconds": time.time() - start}
+
+def run_pipeline(session, pipeline, max_workers=MAX_CONCURRENT_NODES, count_rows=False, completed_once=None):
+    # Runs every node as soon as all the nodes it runs after have finished, so independent
+    # nodes run at the same time. Nodes after a failed node don't run at all.
+    completed_once = completed_once if completed_once is not None else set()
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(results) < len(pipeline):
+            progressed = False
+            for name, node in pipeline.items():
+                if name in results or name in running:
+                    continue
+                parent_statuses = [results[parent]['status'] for parent in node['after'] if parent in results]
+                if node['once'] and name in completed_once:
+                    results[name] = {"node": name, "status": "skipped", "rows": 0, "seconds": 0.0}
+                elif 'failed' in parent_statuses or 'not run' in parent_statuses:
+                    results[name] = {"node": name, "status": "not run", "rows": 0, "seconds": 0.0}
+                elif len(parent_statuses) == len(node['after']):
+                    running[name] = executor.submit(run_node, session, name, node, count_rows)
+                else:
+                    continue
+                progressed = True
+            if not running:
+                if not progressed:
+                    raise Exception("Pipeline has a cycle or an unknown dependency")
+                continue
+            done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+            for name in [n for n, f in running.items() if f in done]:
+                results[name] = running.pop(name).result()
+                if results[name]['status'] == 'succeeded' and pipeline[name]['once']:
+                    completed_once.add(name)
+    return results
+
+def print_results(results, batch_seconds):
+    for result in results.values():
+        rows = '' if result['rows'] is None else ', {} rows'.format(result['rows'])
+        print("\t{}: {} in {:.2f}s{}".format(result['node'], result['status'], result['seconds'], rows))
+    print("\tEnd-to-end: {:.2f}s".format(batch_seconds))
+
+def run_micro_batches(session, pipeline=None, interval_seconds=MICRO_BATCH_INTERVAL_SECONDS, max_batches=None, \
+                      max_workers=MAX_CONCURRENT_NODES, count_rows=False):
+    # Runs the pipeline every interval_seconds (or right away if a batch took longer than that)
+    pipeline = pipeline or build_pipeline()
+    completed_once = set()
+    batches = []
+    batch = 0
+    while max_batches is None or batch < max_batches:
+        batch += 1
+        start = time.time()
+        results = run_pipeline(session, pipeline, max_workers=max_workers, count_rows=count_rows, completed_once=completed_once)
+        batch_seconds = time.time() - start
+        print("Batch {}:".format(batch))
+        print_results(results, batch_seconds)
+        batches.append({"results": results, "seconds": batch_seconds})
+        if max_batches is None or batch < max_batches:
+            time.sleep(max(interval_seconds - batch_seconds, 0))
+    return batches
+
+def failed_nodes(batches):
+    return sorted({r['node'] for batch in batches for r in batch['results'].values() if r['status'] == 'failed'})
+
+
+# For local debugging
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the ORDERS -> DAILY_CITY_METRICS task graph locally")
+    parser.add_argument('--interval', type=float, default=MICRO_BATCH_INTERVAL_SECONDS, help="Seconds between micro-batches")
+    parser.add_argument('--batches', type=int, default=1, help="Number of micro-batches to run")
+    parser.add_argument('--replace-pos-view', action='store_true', help="Recreate POS_FLATTENED_V and its stream even if they exist")
+    parser.add_argument('--local-testing', action='store_true', help="Use a Snowpark local testing session over synthetic data")
+    parser.add_argument('--scale', default=LOCAL_DATA_SCALE, help="Order lines in the synthetic data for --local-testing")
+    parser.add_argument('--profile', action='store_true', help="Record the queries each step issues")
+    parser.add_argument('--count-rows', action='store_true', help="Count each node's input rows (one more query per node)")
+    args = parser.parse_args()
+    if args.profile:
+        enable_profiling()
+
+    if args.local_testing:
+        session, streams, data_directory = create_local_pipeline_session(scale=args.scale)
+        pipeline = build_local_pipeline(streams, data_directory, replace_pos_view=args.replace_pos_view)
+        # Local testing evaluates everything in this process, so nodes run one at a time
+        max_workers = 1
+    else:
+        # Create a local Snowpark session
+        session = Session.builder.getOrCreate()
+        pipeline = build_pipeline(replace_pos_view=args.replace_pos_view)
+        max_workers = MAX_CONCURRENT_NODES
+    with session:
+        batches = run_micro_batches(session, pipeline=pipeline, interval_seconds=args.interval, max_batches=args.batches, \
+                                    max_workers=max_workers, count_rows=args.count_rows)
+        print_histograms()
+    failed = failed_nodes(batches)
+    if failed:
+        print("Failed nodes: {}".format(", ".join(failed)))
+        sys.exit(1)
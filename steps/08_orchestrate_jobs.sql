@@ -12,6 +12,8 @@ USE ROLE HOL_ROLE;
 USE WAREHOUSE HOL_WH;
 USE SCHEMA HOL_DB.HARMONIZED;
 
+-- To run and time the same task graph locally, see 08_orchestrate_jobs.py
+
 
 -- ----------------------------------------------------------------------------
 -- Step #1: Create the tasks to call our Python stored procedures
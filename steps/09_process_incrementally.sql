@@ -16,23 +16,15 @@ USE DATABASE HOL_DB;
 
 USE SCHEMA RAW_POS;
 
-ALTER WAREHOUSE HOL_WH SET WAREHOUSE_SIZE = XLARGE WAIT_FOR_COMPLETION = TRUE;
-
-COPY INTO ORDER_HEADER
-FROM @external.frostbyte_raw_stage/pos/order_header/year=2022
-FILE_FORMAT = (FORMAT_NAME = EXTERNAL.PARQUET_FORMAT)
-MATCH_BY_COLUMN_NAME = CASE_SENSITIVE;
-
-COPY INTO ORDER_DETAIL
-FROM @external.frostbyte_raw_stage/pos/order_detail/year=2022
-FILE_FORMAT = (FORMAT_NAME = EXTERNAL.PARQUET_FORMAT)
-MATCH_BY_COLUMN_NAME = CASE_SENSITIVE;
+-- New order files are loaded by the incremental loader, which finds any new year=
+-- partitions in the stage and only COPYs the files that haven't been loaded yet
+-- (raw_ingest_ledger.json). Run it from the root of the repo before the next step:
+--
+--   python steps/02_load_raw.py --incremental
 
 -- See how many new records are in the stream (this may be a bit slow)
 --SELECT COUNT(*) FROM HARMONIZED.POS_FLATTENED_V_STREAM;
 
-ALTER WAREHOUSE HOL_WH SET WAREHOUSE_SIZE = XSMALL;
-
 
 -- ----------------------------------------------------------------------------
 -- Step #2: Execute the tasks
@@ -0,0 +1,173 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       profiling.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+# SNOWFLAKE ADVANTAGE: Query tags
+# SNOWFLAKE ADVANTAGE: Query history
+
+# Records which queries each pipeline step issues and how long they take. While a step
+# is profiled its queries are tagged with the step name (so they are easy to find in
+# QUERY_HISTORY), and every query's ID, a hash of its text, how long the step waited
+# for it (client_ms), its elapsed time in Snowflake (server_ms) and the rows it produced
+# are written as JSON lines. The client times are kept in a per-step histogram. When
+# profiling isn't enabled profile_step() does nothing at all.
+#
+# client_ms runs from the query's START_TIME in QUERY_HISTORY to the moment the session
+# reports it finished (with the results) to the query listener below, so it includes
+# queueing, compilation, execution and fetching the results. It is never shorter than
+# server_ms, which also absorbs small differences between the two clocks.
+#
+# The query tag is a session parameter, so steps running at the same time on one
+# session (see 08_orchestrate_jobs.py) share it: the tag lists every step that is
+# running, and the session's own tag is put back when the last of them finishes.
+#
+# Each Snowpark project is deployed on its own, so an identical copy of this module
+# lives in every project that needs it (steps/, 06_orders_update_sp and
+# 07_daily_city_metrics_update_sp). tests/test_shared_modules.py fails when they differ.
+
+import hashlib
+import json
+import sys
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from snowflake.snowpark.query_history import QueryHistory
+
+PIPELINE_NAME = 'snowpark_de_hol'
+LATENCY_BUCKETS_MS = [10, 50, 100, 500, 1000, 5000, 30000, 60000]
+
+profiling_enabled = False
+profile_output = sys.stdout
+step_latencies = {}
+_lock = threading.Lock()
+# Session -> {'previous_tag': ..., 'steps': [...]} for the steps running on it
+_running_steps = weakref.WeakKeyDictionary()
+
+def enable_profiling(output=None):
+    global profiling_enabled, profile_output
+    profiling_enabled = True
+    profile_output = output or sys.stdout
+
+def consume_profile_flag(argv):
+    # Turns profiling on when --profile is passed, and returns the other arguments
+    if '--profile' in argv:
+        enable_profiling()
+    return [a for a in argv if a != '--profile']
+
+def query_stats(session, query_ids):
+    # One extra query at the end of the step, only when profiling
+    if not query_ids:
+        return {}
+    rows = session.sql("""SELECT QUERY_ID, ROWS_PRODUCED, TOTAL_ELAPSED_TIME, DATE_PART(EPOCH_MILLISECOND, START_TIME) AS START_MS
+                            FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_SESSION(RESULT_LIMIT => 10000))
+                            WHERE QUERY_ID IN ({})""".format(", ".join("'{}'".format(q) for q in query_ids))).collect()
+    return {r['QUERY_ID']: r for r in rows}
+
+def emit(record):
+    with _lock:
+        profile_output.write(json.dumps(record, default=str) + "\n")
+        profile_output.flush()
+        if record['client_ms'] is not None:
+            step_latencies.setdefault(record['step'], []).append(record['client_ms'])
+
+class StepQueryHistory(QueryHistory):
+    # Records when each query from one thread finished, as the session reports it
+    def __init__(self, session, thread_id):
+        super().__init__(session, include_thread_id=True)
+        self.thread_id = thread_id
+        self.finished = []
+
+    def _notify(self, query_record, **kwargs):
+        if query_record.thread_id in (None, self.thread_id):
+            self.finished.append((query_record, time.time()))
+
+def client_ms(server, finished_at):
+    if not server:
+        return None
+    return max(round(finished_at * 1000 - server['START_MS'], 1), server['TOTAL_ELAPSED_TIME'])
+
+def step_query_tag(steps):
+    return json.dumps({"pipeline": PIPELINE_NAME, "steps": steps})
+
+def start_tagging(session, step):
+    with _lock:
+        running = _running_steps.get(session)
+        if running is None:
+            running = _running_steps[session] = {'previous_tag': session.query_tag, 'steps': []}
+        running['steps'].append(step)
+        session.query_tag = step_query_tag(running['steps'])
+
+def stop_tagging(session, step):
+    with _lock:
+        running = _running_steps[session]
+        running['steps'].remove(step)
+        if running['steps']:
+            session.query_tag = step_query_tag(running['steps'])
+        else:
+            session.query_tag = running['previous_tag']
+            del _running_steps[session]
+
+@contextmanager
+def profile_step(session, step):
+    if not profiling_enabled:
+        yield
+        return
+
+    # Steps can run at the same time on one session, so only record the queries issued
+    # from this step's thread
+    history = StepQueryHistory(session, threading.get_ident())
+    start = time.time()
+    start_tagging(session, step)
+    # Registered the way session.query_history() registers its listener
+    session._conn.add_query_listener(history)
+    try:
+        with history:
+            yield
+    finally:
+        stop_tagging(session, step)
+        stats = query_stats(session, [q.query_id for q, _ in history.finished])
+        for query_record, finished_at in history.finished:
+            server = stats.get(query_record.query_id)
+            emit({"step": step, "query_id": query_record.query_id, \
+                  "text_hash": hashlib.sha256(query_record.sql_text.encode('utf-8')).hexdigest()[:16], \
+                  "client_ms": client_ms(server, finished_at), \
+                  "server_ms": server['TOTAL_ELAPSED_TIME'] if server else None, \
+                  "rows": server['ROWS_PRODUCED'] if server else None})
+        emit_step_summary(step, len(history.finished), (time.time() - start) * 1000)
+
+def emit_step_summary(step, query_count, step_ms):
+    with _lock:
+        profile_output.write(json.dumps({"step": step, "queries": query_count, "step_ms": round(step_ms, 1)}) + "\n")
+
+def latency_histogram(step):
+    # Number of queries in each client time bucket (upper bound in ms, None for anything
+    # slower). Queries QUERY_HISTORY doesn't know about (local testing) aren't counted
+    histogram = {bucket: 0 for bucket in LATENCY_BUCKETS_MS + [None]}
+    for latency in step_latencies.get(step, []):
+        bucket = next((b for b in LATENCY_BUCKETS_MS if latency <= b), None)
+        histogram[bucket] += 1
+    return histogram
+
+def print_histograms():
+    if not profiling_enabled:
+        return
+    for step in sorted(step_latencies):
+        print("{}:".format(step))
+        for bucket, count in latency_histogram(step).items():
+            print("\t{:>8} {}".format('<= {}ms'.format(bucket) if bucket else 'slower', count))
+
+def measure_disabled_overhead(iterations=100000):
+    # Cost of wrapping a step with profile_step() when profiling is turned off
+    if profiling_enabled:
+        raise Exception("Profiling is enabled")
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with profile_step(None, 'overhead'):
+            pass
+    per_step_us = (time.perf_counter() - start) / iterations * 1000000
+    print("profile_step() overhead when disabled: {:.2f}us per step".format(per_step_us))
+    return per_step_us
@@ -0,0 +1,70 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/conftest.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+# Shared fixtures for the tests. Steps that only issue SQL are tested against small
+# fake sessions defined next to their tests; steps that use DataFrames run against a
+# Snowpark local testing session (benchmark/local_session.py).
+#
+#   pip install -r benchmark/requirements.txt pytest
+#   python -m pytest tests
+
+import os
+import sys
+import warnings
+import pytest
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIRECTORY, 'benchmark'))
+sys.path.insert(0, os.path.join(REPO_DIRECTORY, 'steps'))
+from run_benchmark import load_step, load_raw_tables
+from generate_data import generate
+
+PIPELINE_DATA_SCALE = 250
+
+
+@pytest.fixture
+def local_session():
+    from local_session import create_local_session
+    # Local testing warns about pandas behaviour on nearly every query
+    warnings.simplefilter('ignore')
+    session, streams = create_local_session()
+    yield session, streams
+    session.close()
+
+@pytest.fixture
+def load_raw():
+    return load_step('load_raw', '02_load_raw.py')
+
+@pytest.fixture(scope='session')
+def pipeline_data(tmp_path_factory):
+    # One small synthetic data set (benchmark/generate_data.py) shared by all tests
+    directory = str(tmp_path_factory.mktemp('pipeline_data'))
+    generate(directory, PIPELINE_DATA_SCALE, seed=7)
+    return directory
+
+@pytest.fixture
+def raw_session(local_session, pipeline_data):
+    # A local session with the raw and weather tables loaded
+    session, streams = local_session
+    load_raw_tables(session, pipeline_data)
+    return session, streams
+
+@pytest.fixture
+def orchestrate_jobs():
+    return load_step('orchestrate_jobs', '08_orchestrate_jobs.py')
+
+@pytest.fixture
+def orders_update():
+    return load_step('orders_update_sp', '06_orders_update_sp/orders_update_sp/procedure.py')
+
+@pytest.fixture
+def daily_city_metrics():
+    return load_step('daily_city_metrics_update_sp', '07_daily_city_metrics_update_sp/daily_city_metrics_update_sp/procedure.py')
+
+@pytest.fixture
+def create_pos_view():
+    return load_step('create_pos_view', '04_create_pos_view.py')
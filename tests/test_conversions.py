@@ -0,0 +1,71 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_conversions.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+
+UDF_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), \
+                             'steps', '05_fahrenheit_to_celsius_udf', 'fahrenheit_to_celsius_udf')
+sys.path.insert(0, UDF_DIRECTORY)
+import conversions
+
+TEMPERATURES = np.random.default_rng(7).uniform(-100, 500, 10000)
+TEMPERATURE_PAIRS = [(f, t) for f in conversions.TEMPERATURE_SCALES for t in conversions.TEMPERATURE_SCALES if f != t]
+
+
+@pytest.mark.parametrize("from_unit, to_unit", TEMPERATURE_PAIRS)
+def test_temperatures_match_scipy(from_unit, to_unit):
+    # scipy isn't a dependency any more, but when it is installed the results must match it exactly
+    scipy_constants = pytest.importorskip("scipy.constants")
+    expected = scipy_constants.convert_temperature(TEMPERATURES, from_unit, to_unit)
+    assert np.array_equal(conversions.convert(TEMPERATURES, from_unit, to_unit), expected)
+    # Python floats take the same path as arrays
+    assert conversions.convert(float(TEMPERATURES[0]), from_unit, to_unit) == expected[0]
+
+def test_temperatures_round_trip_through_every_scale():
+    for from_unit, to_unit in TEMPERATURE_PAIRS:
+        back = conversions.convert(conversions.convert(TEMPERATURES, from_unit, to_unit), to_unit, from_unit)
+        assert np.allclose(back, TEMPERATURES)
+
+def test_unknown_conversion_raises():
+    with pytest.raises(ValueError):
+        conversions.get_conversion("F", "mm")
+
+def test_conversions_never_import_scipy():
+    code = "import conversions, sys; conversions.convert(1.0, 'K', 'R'); sys.exit('scipy' in sys.modules)"
+    assert subprocess.run([sys.executable, '-c', code], cwd=UDF_DIRECTORY).returncode == 0
+
+@pytest.mark.parametrize("handler, vectorized_handler", [("main", "main_vectorized"), \
+                                                         ("inch_to_millimeter", "inch_to_millimeter_vectorized")])
+def test_vectorized_handlers_are_bit_identical_to_the_scalar_ones(handler, vectorized_handler):
+    import function
+    import pandas as pd
+    values = pd.Series([*TEMPERATURES[:1000], float('nan'), None, 0.0, -0.0], dtype=object)
+    # Snowflake passes a batch as a DataFrame with one column per argument
+    batch = getattr(function, vectorized_handler)(pd.DataFrame({0: values}))
+    expected = [getattr(function, handler)(v) for v in values]
+    assert len(batch) == len(expected)
+    for actual, wanted in zip(batch, expected):
+        if wanted is None:
+            assert actual is None
+        else:
+            # Compares the bits, so NaN matches NaN and -0.0 doesn't match 0.0
+            assert np.float64(actual).tobytes() == np.float64(wanted).tobytes()
+    # Without NULLs the batch stays a float column
+    assert getattr(function, vectorized_handler)(pd.DataFrame({0: TEMPERATURES})).dtype == np.float64
+
+@pytest.mark.parametrize("vectorized_handler", ["main_vectorized", "inch_to_millimeter_vectorized"])
+def test_vectorized_handlers_are_registered_as_vectorized(vectorized_handler):
+    # Snowpark reads these attributes when it registers the handler
+    import function
+    import pandas as pd
+    handler = getattr(function, vectorized_handler)
+    assert handler._sf_vectorized_input is pd.DataFrame
+    assert handler._sf_max_batch_size == function.MAX_BATCH_SIZE
@@ -0,0 +1,48 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_create_pos_view.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+import pytest
+from run_benchmark import load_raw_tables, RAW_TABLES
+from generate_data import generate
+
+# The six-way join is slow in local testing, so these tests use a smaller data set
+POS_DATA_SCALE = 50
+POS_FOLDERS = [f for f in RAW_TABLES if f.startswith('pos/')]
+
+
+@pytest.fixture(scope='module')
+def pos_data(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('pos_data'))
+    generate(directory, POS_DATA_SCALE, seed=7)
+    return directory
+
+@pytest.fixture
+def pos_session(local_session, pos_data):
+    session, streams = local_session
+    load_raw_tables(session, pos_data, folders=POS_FOLDERS)
+    return session, streams
+
+
+def test_materialized_pos_flattened_matches_the_view_and_feeds_orders(pos_session, create_pos_view, orders_update):
+    session, _ = pos_session
+    create_pos_view.create_pos_view(session, mode='materialized')
+    assert session.table('HARMONIZED.POS_FLATTENED').count() == POS_DATA_SCALE
+    assert create_pos_view.check_pos_equivalence(session)
+
+    # ORDERS gets every column of the view, as it does in view mode
+    create_pos_view.create_pos_view_stream(session, mode='materialized')
+    orders_update.main(session)
+    assert session.table('HARMONIZED.ORDERS').columns == [*create_pos_view.POS_FLATTENED_COLUMNS, 'META_UPDATED_AT', 'META_ROW_HASH']
+    assert session.table('HARMONIZED.ORDERS').count() == POS_DATA_SCALE
+
+def test_trimmed_pos_flattened_needs_feeds_orders_false(pos_session, create_pos_view):
+    session, _ = pos_session
+    with pytest.raises(ValueError):
+        create_pos_view.create_pos_view(session, mode='materialized', columns=create_pos_view.DOWNSTREAM_COLUMNS)
+    create_pos_view.create_pos_view(session, mode='materialized', columns=create_pos_view.DOWNSTREAM_COLUMNS, feeds_orders=False)
+    assert session.table('HARMONIZED.POS_FLATTENED_V').columns == create_pos_view.DOWNSTREAM_COLUMNS
+    assert create_pos_view.check_pos_equivalence(session)
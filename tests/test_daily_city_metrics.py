@@ -0,0 +1,153 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_daily_city_metrics.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+import datetime
+import snowflake.snowpark.types as T
+import snowflake.snowpark.functions as F
+import warehouse
+from local_session import count_queries
+
+HISTORY_DAY = 'FROSTBYTE_WEATHERSOURCE.ONPOINT_ID.HISTORY_DAY'
+ORDERS_STREAM_SCHEMA = T.StructType([T.StructField("ORDER_TS_DATE", T.DateType()), T.StructField("PRIMARY_CITY", T.StringType()), \
+                                     T.StructField("COUNTRY", T.StringType()), T.StructField("PRICE", T.DoubleType())])
+
+
+def weather_dates(session):
+    return sorted(r['DATE_VALID_STD'] for r in session.table(HISTORY_DAY).select(F.col("DATE_VALID_STD")).distinct().collect())
+
+def cached_weather(session, daily_city_metrics):
+    return {(r['DATE'], r['CITY_NAME'], r['COUNTRY_DESC']): r['AVG_TEMPERATURE_FAHRENHEIT'] \
+            for r in session.table(daily_city_metrics.CITY_WEATHER_DAILY_TABLE).collect()}
+
+def revise_weather(session, date, temperature):
+    # A late correction from the weather provider for every postal code on one day
+    history = session.table(HISTORY_DAY).to_pandas()
+    history.loc[history['DATE_VALID_STD'] == date, 'AVG_TEMPERATURE_AIR_2M_F'] = temperature
+    session.create_dataframe(history).write.mode('overwrite').save_as_table(HISTORY_DAY)
+
+
+def test_full_and_pruned_weather_plans_match(raw_session, daily_city_metrics):
+    session, _ = raw_session
+    dates = session.create_dataframe([[d] for d in weather_dates(session)[:2]], schema=daily_city_metrics.DATES_SCHEMA)
+    full_rows = daily_city_metrics.full_weather_agg(session, dates).collect()
+    pruned_rows = daily_city_metrics.pruned_weather_agg(session, dates).collect()
+    # One row per city and date
+    assert len(full_rows) == 2 * session.table('RAW_POS.COUNTRY').count()
+    assert sorted(full_rows, key=str) == sorted(pruned_rows, key=str)
+
+def test_refresh_city_weather_daily_rereads_recent_dates(raw_session, daily_city_metrics):
+    session, _ = raw_session
+    daily_city_metrics.create_city_weather_daily_table(session)
+    # The first and the last day are more than WEATHER_REFRESH_DAYS apart
+    dates = weather_dates(session)[::13]
+    daily_city_metrics.refresh_city_weather_daily(session, dates)
+    before = cached_weather(session, daily_city_metrics)
+    assert len(before) == len(dates) * session.table('RAW_POS.COUNTRY').count()
+
+    old_date, recent_date = dates
+    assert recent_date - old_date > datetime.timedelta(days=daily_city_metrics.WEATHER_REFRESH_DAYS)
+    revise_weather(session, old_date, 10.0)
+    revise_weather(session, recent_date, 20.0)
+    daily_city_metrics.refresh_city_weather_daily(session, dates)
+    after = cached_weather(session, daily_city_metrics)
+    # Refreshing again doesn't add rows, and only the recent date picked up the revision
+    assert after.keys() == before.keys()
+    assert {k: v for k, v in after.items() if k[0] == recent_date} == {k: 20.0 for k in before if k[0] == recent_date}
+    assert {k: v for k, v in after.items() if k[0] == old_date} == {k: v for k, v in before.items() if k[0] == old_date}
+
+    # Without a window every date is read again
+    daily_city_metrics.refresh_city_weather_daily(session, dates, refresh_days=None)
+    after = cached_weather(session, daily_city_metrics)
+    assert {k: v for k, v in after.items() if k[0] == old_date} == {k: 10.0 for k in before if k[0] == old_date}
+    assert len(after) == len(before)
+
+def test_main_query_budget(raw_session, daily_city_metrics, monkeypatch):
+    session, _ = raw_session
+    # Other tests leave the warehouse size known, start without it like a new process
+    monkeypatch.setattr(warehouse, '_current_sizes', {})
+    # The columns of ORDERS_STREAM that main() reads, with one order on a day there's weather for
+    city = session.table('RAW_POS.COUNTRY').limit(1).collect()[0]
+    session.create_dataframe([[weather_dates(session)[0], city['CITY'], city['COUNTRY'], 10.0]], schema=ORDERS_STREAM_SCHEMA) \
+                .write.mode('overwrite').save_as_table('HARMONIZED.ORDERS_STREAM')
+    # The first run creates the tables, and sizes the warehouse
+    assert count_queries(session, lambda: daily_city_metrics.main(session)) == 17
+    # After that: the stream dates, BEGIN, the weather cache MERGE, the DAILY_CITY_METRICS MERGE,
+    # COMMIT and a MERGE for each rollup, plus one metadata lookup because the first run changed
+    # the tables
+    assert count_queries(session, lambda: daily_city_metrics.main(session)) == 8
+    assert count_queries(session, lambda: daily_city_metrics.main(session)) == 7
+    assert session.table('ANALYTICS.DAILY_CITY_METRICS').count() == 1
+
+def test_backfill_rereads_weather_and_merges_every_chunk(raw_session, daily_city_metrics, monkeypatch):
+    session, _ = raw_session
+    city = session.table('RAW_POS.COUNTRY').limit(1).collect()[0]
+    dates = weather_dates(session)
+    dates = [dates[0], dates[1], dates[-1]]
+    session.create_dataframe([[d, city['CITY'], city['COUNTRY'], 10.0] for d in dates], schema=ORDERS_STREAM_SCHEMA) \
+                .write.mode('overwrite').save_as_table('HARMONIZED.ORDERS')
+    daily_city_metrics.create_missing_tables(session)
+    daily_city_metrics.refresh_city_weather_daily(session, dates)
+    # The revision is older than any refresh window a task run would use
+    revise_weather(session, dates[0], 10.0)
+
+    chunks = daily_city_metrics.date_chunks(dates[0], dates[-1], 4)
+    assert len(chunks) >= 3
+    refreshed = []
+    refresh = daily_city_metrics.refresh_city_weather_daily
+    monkeypatch.setattr(daily_city_metrics, 'refresh_city_weather_daily', \
+                        lambda session, dates, refresh_days: refreshed.append(dates) or refresh(session, dates, refresh_days))
+    daily_city_metrics.backfill_daily_city_metrics(session, dates[0], dates[-1], chunk_days=4, max_parallel=2)
+    # The weather is refreshed chunk by chunk, for the dates with orders
+    assert refreshed == [dates[:2], dates[2:]]
+    metrics = {r['DATE']: r for r in session.table('ANALYTICS.DAILY_CITY_METRICS').collect()}
+    assert sorted(metrics) == dates
+    assert metrics[dates[0]]['AVG_TEMPERATURE_FAHRENHEIT'] == 10
+    assert all(r['DAILY_SALES'] == 10 for r in metrics.values())
+    checkpoints = session.table(daily_city_metrics.BACKFILL_CHECKPOINT_TABLE).collect()
+    # Chunks without orders are checkpointed too
+    assert sorted(r['RECORDS'] for r in checkpoints) == [0] * (len(chunks) - 2) + [1, 2]
+    # The per-chunk staging tables are dropped once they are merged
+    staging = [t for t in session._conn.entity_registry.table_registry if 'BACKFILL_STG' in t]
+    assert staging == []
+
+def test_rollups_match_a_full_recompute_after_incremental_runs(raw_session, daily_city_metrics):
+    session, _ = raw_session
+    cities = session.table('RAW_POS.COUNTRY').limit(2).collect()
+    dates = weather_dates(session)
+    # Batches that revisit a day, add a city to it, and start a new week and month
+    batches = [[[dates[0], cities[0]['CITY'], cities[0]['COUNTRY'], 10.0], [dates[1], cities[0]['CITY'], cities[0]['COUNTRY'], 5.0]],
+               [[dates[1], cities[0]['CITY'], cities[0]['COUNTRY'], 7.5], [dates[-1], cities[0]['CITY'], cities[0]['COUNTRY'], 2.0]],
+               [[dates[0], cities[1]['CITY'], cities[1]['COUNTRY'], 3.0]]]
+    for batch in batches:
+        session.create_dataframe(batch, schema=ORDERS_STREAM_SCHEMA).write.mode('overwrite').save_as_table('HARMONIZED.ORDERS_STREAM')
+        daily_city_metrics.main(session)
+    for grain, table in daily_city_metrics.ROLLUP_TABLES.items():
+        maintained = session.table(table).select(*daily_city_metrics.ROLLUP_COLUMNS).collect()
+        assert sorted(maintained, key=str) == sorted(daily_city_metrics.city_metrics_rollup(session, grain).collect(), key=str)
+        assert len(maintained) >= 2
+
+def test_migrate_daily_city_metrics_keeps_rows(raw_session, daily_city_metrics):
+    session, _ = raw_session
+    # The old table: DAILY_SALES a string and the weather metrics NUMBER(38,0)
+    old_types = {**{c: T.LongType() for c in daily_city_metrics.DAILY_CITY_METRICS_TYPES}, "DAILY_SALES": T.StringType()}
+    schema = T.StructType([T.StructField("DATE", T.DateType()), T.StructField("CITY_NAME", T.StringType()), T.StructField("COUNTRY_DESC", T.StringType()), \
+                           *[T.StructField(c, old_types[c]) for c in daily_city_metrics.DAILY_CITY_METRICS_STG_COLUMNS[3:]], \
+                           T.StructField("META_UPDATED_AT", T.TimestampType())])
+    now = datetime.datetime(2023, 1, 9)
+    dates = weather_dates(session)
+    session.create_dataframe([[dates[0], 'Hamburg', 'Germany', '12.3456', 50, 10, 1, 25, 20, now],
+                              [dates[1], 'Hamburg', 'Germany', '7', 48, 9, 0, 0, 15, now]], schema=schema) \
+                .write.mode('overwrite').save_as_table('ANALYTICS.DAILY_CITY_METRICS')
+
+    daily_city_metrics.migrate_daily_city_metrics(session)
+    dcm = session.table('ANALYTICS.DAILY_CITY_METRICS')
+    types = {f.name: f.datatype for f in dcm.schema.fields}
+    assert all(types[c] == t for c, t in daily_city_metrics.DAILY_CITY_METRICS_TYPES.items())
+    rows = sorted(dcm.collect(), key=lambda r: r['DATE'])
+    assert [(r['DATE'], float(r['DAILY_SALES']), r['AVG_TEMPERATURE_FAHRENHEIT'], r['META_UPDATED_AT']) for r in rows] \
+                == [(dates[0], 12.3456, 50, now), (dates[1], 7.0, 48, now)]
+    assert daily_city_metrics.migrate_daily_city_metrics(session) == "DAILY_CITY_METRICS already has the current column types"
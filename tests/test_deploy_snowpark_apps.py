@@ -0,0 +1,120 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_deploy_snowpark_apps.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+import json
+import os
+import stat
+import subprocess
+import sys
+import pytest
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIRECTORY)
+import deploy_snowpark_apps
+
+# Stands in for the Snow CLI: records each call, and fails `deploy` for the project
+# folder named in SNOW_FAIL_PROJECT
+SNOW_STUB = """#!{python}
+import os, sys
+with open(os.environ['SNOW_CALLS'], 'a') as f:
+    f.write("{{}} {{}}\\n".format(os.path.basename(os.getcwd()), sys.argv[2]))
+sys.exit(1 if sys.argv[2] == 'deploy' and os.path.basename(os.getcwd()) == os.environ.get('SNOW_FAIL_PROJECT') else 0)
+"""
+
+
+@pytest.fixture
+def snow(tmp_path, monkeypatch):
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    snow_path = bin_directory / 'snow'
+    snow_path.write_text(SNOW_STUB.format(python=sys.executable))
+    snow_path.chmod(snow_path.stat().st_mode | stat.S_IEXEC)
+    calls_path = tmp_path / 'snow_calls.txt'
+    monkeypatch.setenv('PATH', "{}{}{}".format(bin_directory, os.pathsep, os.environ['PATH']))
+    monkeypatch.setenv('SNOW_CALLS', str(calls_path))
+    monkeypatch.setenv('SNOWFLAKE_ACCOUNT', 'myaccount')
+    monkeypatch.setenv('SNOWFLAKE_DATABASE', 'HOL_DB')
+    def calls():
+        if not calls_path.exists():
+            return []
+        lines = calls_path.read_text().splitlines()
+        calls_path.unlink()
+        return sorted(lines)
+    return calls
+
+@pytest.fixture
+def projects(tmp_path):
+    root = tmp_path / 'repo'
+    for name in ['app_a', 'app_b']:
+        src = root / 'apps' / name / 'src'
+        src.mkdir(parents=True)
+        (root / 'apps' / name / 'snowflake.yml').write_text( \
+            "snowpark:\n  project_name: {}\n  stage_name: deployment\n  src: src/\n".format(name))
+        (src / 'app.py').write_text("def main():\n    return 1\n")
+    return root
+
+def deploy(root, **kwargs):
+    return deploy_snowpark_apps.deploy_changed_projects(str(root), max_workers=2, **kwargs)
+
+
+def test_only_changed_projects_are_deployed(snow, projects):
+    assert deploy(projects) == 0
+    assert snow() == ['app_a build', 'app_a deploy', 'app_b build', 'app_b deploy']
+    assert deploy(projects) == 0
+    assert snow() == []
+    (projects / 'apps' / 'app_b' / 'src' / 'app.py').write_text("def main():\n    return 2\n")
+    assert deploy(projects) == 0
+    assert snow() == ['app_b build', 'app_b deploy']
+
+def test_another_database_gets_everything(snow, projects, monkeypatch):
+    deploy(projects)
+    snow()
+    monkeypatch.setenv('SNOWFLAKE_DATABASE', 'OTHER_DB')
+    deploy(projects)
+    assert snow() == ['app_a build', 'app_a deploy', 'app_b build', 'app_b deploy']
+    # Both targets are remembered
+    monkeypatch.setenv('SNOWFLAKE_DATABASE', 'HOL_DB')
+    deploy(projects)
+    assert snow() == []
+
+def test_force_deploys_unchanged_projects(snow, projects):
+    deploy(projects)
+    snow()
+    deploy(projects, force=True)
+    assert snow() == ['app_a build', 'app_a deploy', 'app_b build', 'app_b deploy']
+
+def test_failed_deploys_are_retried(snow, projects, monkeypatch):
+    monkeypatch.setenv('SNOW_FAIL_PROJECT', 'app_a')
+    assert deploy(projects) == 1
+    snow()
+    monkeypatch.delenv('SNOW_FAIL_PROJECT')
+    assert deploy(projects) == 0
+    assert snow() == ['app_a build', 'app_a deploy']
+
+def test_old_state_files_are_ignored(snow, projects):
+    with open(projects / deploy_snowpark_apps.deploy_state_filename, 'w') as f:
+        json.dump({'apps/app_a': 'stale', 'apps/app_b': 'stale'}, f)
+    deploy(projects)
+    assert snow() == ['app_a build', 'app_a deploy', 'app_b build', 'app_b deploy']
+
+def test_command_line_force(snow, projects):
+    script = os.path.join(REPO_DIRECTORY, 'deploy_snowpark_apps.py')
+    assert subprocess.run([sys.executable, script, str(projects)], capture_output=True).returncode == 0
+    snow()
+    assert subprocess.run([sys.executable, script, str(projects)], capture_output=True).returncode == 0
+    assert snow() == []
+    assert subprocess.run([sys.executable, script, str(projects), '--force'], capture_output=True).returncode == 0
+    assert snow() == ['app_a build', 'app_a deploy', 'app_b build', 'app_b deploy']
+
+def test_discovery_prunes_ignored_folders(projects):
+    for ignored in ['node_modules/pkg', 'apps/app_a/.venv/lib', 'vendor/lib', 'apps/build/out']:
+        (projects / ignored).mkdir(parents=True)
+        (projects / ignored / 'snowflake.yml').write_text("snowpark:\n  project_name: x\n  stage_name: x\n  src: src/\n")
+    (projects / '.gitignore').write_text("vendor/\n")
+    (projects / 'apps' / '.gitignore').write_text("# build output\nbuild\n")
+    assert deploy_snowpark_apps.discover_project_folders(str(projects)) == \
+        [str(projects / 'apps' / 'app_a'), str(projects / 'apps' / 'app_b')]
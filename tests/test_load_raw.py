@@ -0,0 +1,239 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_load_raw.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+import re
+import pytest
+from snowflake.snowpark import Row
+
+STAGE = '@external.frostbyte_raw_stage'
+COUNTRY_COLUMNS = [{"name": "COUNTRY_ID", "type": "NUMBER(38, 0)", "expression": "$1:COUNTRY_ID::NUMBER(38, 0)"},
+                   {"name": "COUNTRY", "type": "TEXT", "expression": "$1:COUNTRY::TEXT"}]
+ORDER_COLUMNS = [{"name": "ORDER_ID", "type": "NUMBER(38, 0)", "expression": "$1:ORDER_ID::NUMBER(38, 0)"},
+                 {"name": "ORDER_TS", "type": "TIMESTAMP_NTZ", "expression": "$1:ORDER_TS::TIMESTAMP_NTZ"}]
+
+
+class StageSession:
+    # Fake session for 02_load_raw.py over an in-memory stage ({folder: {"columns": [...], "files":
+    # {name: rows}}}); records the statements it answers, and fail_copies makes a folder's COPYs fail
+    def __init__(self, stage, database='HOL_DB'):
+        self.stage = stage
+        self.database = database
+        self.tables = set()
+        self.statements = []
+        self.fail_copies = {}
+
+    def get_current_account(self):
+        return '"TEST_ACCOUNT"'
+
+    def get_current_database(self):
+        return '"{}"'.format(self.database)
+
+    def sql(self, query):
+        statement = " ".join(query.split())
+        self.statements.append(statement)
+        return StatementResult(lambda: self.run(statement))
+
+    def folders(self, location):
+        path = location[len(STAGE) + 1:].rstrip('/')
+        return [f for f in self.stage if f == path or f.startswith(path + '/')]
+
+    def run(self, statement):
+        if statement.startswith('LIST '):
+            return [Row(name="s3://frostbyte/{}/{}".format(folder, name), size=rows * 100, md5="{}-{}".format(name, rows)) \
+                    for folder in self.folders(statement[5:]) for name, rows in sorted(self.stage[folder]['files'].items())]
+        match = re.search(r"INFER_SCHEMA\(LOCATION => '([^']+)'", statement)
+        if match:
+            columns = self.stage[self.folders(match.group(1))[0]]['columns']
+            return [Row(COLUMN_NAME=c['name'], TYPE=c['type'], EXPRESSION=c['expression']) for c in columns]
+        match = re.match(r"CREATE TABLE IF NOT EXISTS (\w+)\.(\w+)", statement)
+        if match:
+            self.tables.add((match.group(1).upper(), match.group(2).upper()))
+            return []
+        match = re.search(r"FROM \(SELECT .* FROM (\S+)\)", statement)
+        if statement.startswith('COPY INTO') and match:
+            folder = self.folders(match.group(1))[0]
+            if self.fail_copies.get(folder, 0) > 0:
+                self.fail_copies[folder] -= 1
+                raise Exception("COPY failed")
+            return [Row(file=name, rows_loaded=rows) for name, rows in self.stage[folder]['files'].items()]
+        match = re.search(r"FROM (\S+) FILES = \((.*?)\)", statement)
+        if statement.startswith('COPY INTO') and match:
+            path = match.group(1)[len(STAGE) + 1:]
+            files = [f.strip("' ") for f in match.group(2).split(",")]
+            return [Row(file=f, rows_loaded=self.stage[path + f.rsplit('/', 1)[0]]['files'][f.rsplit('/', 1)[1]]) for f in files]
+        if 'INFORMATION_SCHEMA.TABLES' in statement:
+            return [Row(TABLE_SCHEMA=schema, TABLE_NAME=name) for schema, name in sorted(self.tables)]
+        if statement.startswith('COMMENT ON TABLE'):
+            return []
+        raise NotImplementedError(statement)
+
+    def copies(self):
+        return [s for s in self.statements if s.startswith('COPY INTO')]
+
+class StatementResult:
+    def __init__(self, run):
+        self.run = run
+
+    def collect(self):
+        return self.run()
+
+def pos_stage():
+    return {'pos/country': {"columns": COUNTRY_COLUMNS, "files": {"part-0.parquet": 30}},
+            'pos/order_header/year=2019': {"columns": ORDER_COLUMNS, "files": {"part-0.parquet": 100}},
+            'pos/order_header/year=2020': {"columns": ORDER_COLUMNS, "files": {"part-0.parquet": 200, "part-1.parquet": 50}}}
+
+def pos_partitions():
+    return [{"s3dir": "pos", "schema": "RAW_POS", "tname": "country", "year": None},
+            {"s3dir": "pos", "schema": "RAW_POS", "tname": "order_header", "year": "2019"},
+            {"s3dir": "pos", "schema": "RAW_POS", "tname": "order_header", "year": "2020"}]
+
+def load(load_raw, session, tmp_path, **kwargs):
+    return load_raw.load_partitions(session, pos_partitions(), max_workers=2, manifest_path=str(tmp_path / 'manifest.json'), \
+                                    registry_path=str(tmp_path / 'registry.json'), backoff_seconds=0, **kwargs)
+
+
+def test_load_partitions_records_rows_and_skips_loaded_partitions(load_raw, tmp_path):
+    session = StageSession(pos_stage())
+    manifest = load(load_raw, session, tmp_path)
+    assert {k: r['rows_loaded'] for k, r in manifest.items()} == \
+        {'pos/country': 30, 'pos/order_header/year=2019': 100, 'pos/order_header/year=2020': 250}
+    assert len(session.copies()) == 3
+
+    session.statements.clear()
+    load(load_raw, session, tmp_path)
+    assert session.copies() == []
+
+def test_load_partitions_loads_again_into_another_database(load_raw, tmp_path):
+    load(load_raw, StageSession(pos_stage()), tmp_path)
+    other = StageSession(pos_stage(), database='OTHER_DB')
+    load(load_raw, other, tmp_path)
+    assert len(other.copies()) == 3
+
+def test_load_partitions_loads_again_after_teardown(load_raw, tmp_path):
+    session = StageSession(pos_stage())
+    load(load_raw, session, tmp_path)
+    session.tables.discard(('RAW_POS', 'ORDER_HEADER'))
+    session.statements.clear()
+    manifest = load(load_raw, session, tmp_path)
+    assert [s.split()[2] for s in session.copies()] == ['RAW_POS.order_header', 'RAW_POS.order_header']
+    assert manifest['pos/order_header/year=2020']['status'] == 'loaded'
+
+def test_load_partitions_retries_failed_partitions(load_raw, tmp_path):
+    session = StageSession(pos_stage())
+    session.fail_copies['pos/country'] = 1
+    manifest = load(load_raw, session, tmp_path)
+    assert manifest['pos/country']['status'] == 'loaded'
+    assert manifest['pos/country']['attempts'] == 2
+
+def test_new_partition_is_checked_for_schema_drift(load_raw, tmp_path):
+    session = StageSession(pos_stage())
+    load(load_raw, session, tmp_path)
+    session.stage['pos/order_header/year=2021'] = {"columns": ORDER_COLUMNS + [{"name": "DISCOUNT", "type": "REAL", "expression": "$1:DISCOUNT::REAL"}],
+                                                   "files": {"part-0.parquet": 10}}
+    partition = {"s3dir": "pos", "schema": "RAW_POS", "tname": "order_header", "year": "2021"}
+    with pytest.raises(Exception, match="pos/order_header/year=2021"):
+        load_raw.load_partitions(session, [partition], manifest_path=str(tmp_path / 'manifest.json'), \
+                                 registry_path=str(tmp_path / 'registry.json'), backoff_seconds=0)
+    assert not any('year=2021' in s for s in session.copies())
+
+def test_registered_columns_are_only_inferred_again_when_files_change(load_raw, tmp_path):
+    session = StageSession(pos_stage())
+    registry = load_raw.read_schema_registry(str(tmp_path / 'registry.json'))
+    location = STAGE + '/pos/order_header/year=2019'
+    assert load_raw.get_registered_columns(session, registry, tname='order_header', schema='RAW_POS', location=location)[1]
+    assert not load_raw.get_registered_columns(session, registry, tname='order_header', schema='RAW_POS', location=location)[1]
+    # A new partition with the same schema is inferred once, then reused
+    location = STAGE + '/pos/order_header/year=2020'
+    assert load_raw.get_registered_columns(session, registry, tname='order_header', schema='RAW_POS', location=location)[1]
+    session.stage['pos/order_header/year=2020']['files']['part-2.parquet'] = 5
+    assert load_raw.get_registered_columns(session, registry, tname='order_header', schema='RAW_POS', location=location)[1]
+
+def test_new_files_are_checked_for_schema_drift(load_raw, tmp_path):
+    session = StageSession(pos_stage())
+    load(load_raw, session, tmp_path)
+    session.stage['pos/order_header/year=2022'] = {"columns": ORDER_COLUMNS[:1], "files": {"part-0.parquet": 10}}
+    session.statements.clear()
+    with pytest.raises(load_raw.SchemaDriftError, match="ORDER_TS missing"):
+        load_raw.load_new_raw_files(session, tnames=['order_header'], ledger_path=str(tmp_path / 'ledger.json'), \
+                                    manifest_path=str(tmp_path / 'manifest.json'), registry_path=str(tmp_path / 'registry.json'))
+    assert session.copies() == []
+
+    session.stage['pos/order_header/year=2022']['columns'] = ORDER_COLUMNS
+    load_raw.load_new_raw_files(session, tnames=['order_header'], ledger_path=str(tmp_path / 'ledger.json'), \
+                                manifest_path=str(tmp_path / 'manifest.json'), registry_path=str(tmp_path / 'registry.json'))
+    assert session.copies() == ["COPY INTO RAW_POS.order_header FROM @external.frostbyte_raw_stage/pos/order_header/ "
+                                "FILES = ('year=2022/part-0.parquet') FILE_FORMAT = (FORMAT_NAME = EXTERNAL.PARQUET_FORMAT) "
+                                "MATCH_BY_COLUMN_NAME = CASE_SENSITIVE"]
+
+def write_order_files(directory, year, names, first_order_id):
+    import pandas as pd
+    year_dir = directory / 'pos' / 'order_header' / 'year={}'.format(year)
+    year_dir.mkdir(parents=True, exist_ok=True)
+    for i, name in enumerate(names):
+        order_ids = range(first_order_id + i * 10, first_order_id + i * 10 + 10)
+        pd.DataFrame({"ORDER_ID": list(order_ids), "ORDER_AMOUNT": [1.5] * 10}).to_parquet(year_dir / name)
+
+def test_load_new_raw_files_only_loads_the_delta(load_raw, local_session, tmp_path):
+    session, _ = local_session
+    data = tmp_path / 'stage'
+    write_order_files(data, 2021, ['part-0.parquet', 'part-1.parquet'], 0)
+    ledger_path = str(tmp_path / 'ledger.json')
+    def load_new_files(**kwargs):
+        load_raw.load_new_raw_files(session, tnames=['order_header'], ledger_path=ledger_path, list_files=load_raw.local_file_lister(str(data)), \
+                                    copy_files=load_raw.local_file_copier(str(data)), manifest_path=str(tmp_path / 'manifest.json'), \
+                                    registry_path=None, **kwargs)
+
+    load_new_files()
+    assert load_raw.read_ledger(ledger_path) == {'RAW_POS.order_header': ['year=2021/part-0.parquet', 'year=2021/part-1.parquet']}
+    assert session.table('RAW_POS.ORDER_HEADER').count() == 20
+
+    # Nothing new, nothing loaded
+    load_new_files()
+    assert session.table('RAW_POS.ORDER_HEADER').count() == 20
+
+    # Only the new files are loaded, in batches that are each recorded in the ledger
+    write_order_files(data, 2021, ['part-2.parquet'], 20)
+    write_order_files(data, 2022, ['part-0.parquet', 'part-1.parquet'], 30)
+    load_new_files(batch_size=2)
+    assert load_raw.read_ledger(ledger_path)['RAW_POS.order_header'] == \
+        ['year=2021/part-0.parquet', 'year=2021/part-1.parquet', 'year=2021/part-2.parquet', 'year=2022/part-0.parquet', 'year=2022/part-1.parquet']
+    order_ids = [r['ORDER_ID'] for r in session.table('RAW_POS.ORDER_HEADER').collect()]
+    assert sorted(order_ids) == list(range(50))
+
+def test_load_new_raw_files_resumes_after_a_failed_batch(load_raw, local_session, tmp_path):
+    session, _ = local_session
+    data = tmp_path / 'stage'
+    write_order_files(data, 2022, ['part-0.parquet', 'part-1.parquet', 'part-2.parquet'], 0)
+    ledger_path = str(tmp_path / 'ledger.json')
+    copier = load_raw.local_file_copier(str(data))
+    batches = []
+    def failing_copier(session, files=None, **kwargs):
+        batches.append(files)
+        if len(batches) == 2:
+            raise Exception("COPY failed")
+        return copier(session, files=files, **kwargs)
+    def load_new_files(copy_files):
+        load_raw.load_new_raw_files(session, tnames=['order_header'], ledger_path=ledger_path, list_files=load_raw.local_file_lister(str(data)), \
+                                    copy_files=copy_files, manifest_path=str(tmp_path / 'manifest.json'), registry_path=None, batch_size=1)
+
+    with pytest.raises(Exception, match="COPY failed"):
+        load_new_files(failing_copier)
+    assert load_raw.read_ledger(ledger_path) == {'RAW_POS.order_header': ['year=2022/part-0.parquet']}
+    load_new_files(copier)
+    assert session.table('RAW_POS.ORDER_HEADER').count() == 30
+
+def test_load_new_raw_files_skips_years_in_the_load_manifest(load_raw, local_session, tmp_path):
+    session, _ = local_session
+    data = tmp_path / 'stage'
+    write_order_files(data, 2021, ['part-0.parquet'], 0)
+    write_order_files(data, 2022, ['part-0.parquet'], 10)
+    manifest_path = str(tmp_path / 'manifest.json')
+    load_raw.write_manifest({load_raw.load_target(session): {'pos/order_header/year=2021': {'status': 'loaded'}}}, manifest_path)
+    load_raw.load_new_raw_files(session, tnames=['order_header'], ledger_path=str(tmp_path / 'ledger.json'), \
+                                list_files=load_raw.local_file_lister(str(data)), copy_files=load_raw.local_file_copier(str(data)), \
+                                manifest_path=manifest_path, registry_path=None)
+    assert sorted(r['ORDER_ID'] for r in session.table('RAW_POS.ORDER_HEADER').collect()) == list(range(10, 20))
@@ -0,0 +1,16 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_local_session.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+import snowflake.snowpark.functions as F
+
+
+def test_hash_stays_aligned_after_a_filter(local_session):
+    session, _ = local_session
+    df = session.create_dataframe([[i, "row {}".format(i)] for i in range(10)], schema=["ID", "NAME"])
+    hashes = {r['ID']: r['H'] for r in df.with_column("H", F.hash(F.col("ID"), F.col("NAME"))).collect()}
+    filtered = df.filter(F.col("ID") >= 5).with_column("H", F.hash(F.col("ID"), F.col("NAME"))).collect()
+    assert {r['ID']: r['H'] for r in filtered} == {i: hashes[i] for i in range(5, 10)}
@@ -0,0 +1,73 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_orchestrate_jobs.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+
+def node(run, after=(), once=False):
+    return {"run": run, "after": list(after), "when": None, "rows_from": None, "once": once}
+
+def fail(session):
+    raise Exception("node failed")
+
+
+def test_nodes_after_a_failed_node_dont_run(orchestrate_jobs):
+    ran = []
+    pipeline = {"A": node(lambda s: ran.append("A")), "B": node(fail, after=["A"]), "C": node(lambda s: ran.append("C"), after=["B"]), \
+                "D": node(lambda s: ran.append("D"), after=["A"])}
+    batches = orchestrate_jobs.run_micro_batches(None, pipeline=pipeline, interval_seconds=0, max_batches=1)
+    assert {n: r['status'] for n, r in batches[0]['results'].items()} == \
+        {"A": "succeeded", "B": "failed", "C": "not run", "D": "succeeded"}
+    assert sorted(ran) == ["A", "D"]
+    assert orchestrate_jobs.failed_nodes(batches) == ["B"]
+
+def test_once_nodes_only_run_in_the_first_batch(orchestrate_jobs):
+    ran = []
+    pipeline = {"SETUP": node(lambda s: ran.append("SETUP"), once=True), "WORK": node(lambda s: ran.append("WORK"), after=["SETUP"])}
+    batches = orchestrate_jobs.run_micro_batches(None, pipeline=pipeline, interval_seconds=0, max_batches=2)
+    assert ran == ["SETUP", "WORK", "WORK"]
+    assert orchestrate_jobs.failed_nodes(batches) == []
+
+def test_rows_are_only_counted_when_asked_for(orchestrate_jobs):
+    class CountingSession:
+        counted = []
+        def table(self, name):
+            if name == 'MISSING':
+                raise Exception("table does not exist")
+            return self
+        def count(self):
+            self.counted.append(True)
+            return 3
+    session = CountingSession()
+    pipeline = {"A": {**node(lambda s: None), "rows_from": "SOURCE"}}
+    batches = orchestrate_jobs.run_micro_batches(session, pipeline=pipeline, interval_seconds=0, max_batches=1)
+    assert batches[0]['results']['A']['rows'] is None and session.counted == []
+    batches = orchestrate_jobs.run_micro_batches(session, pipeline=pipeline, interval_seconds=0, max_batches=1, count_rows=True)
+    assert batches[0]['results']['A']['rows'] == 3
+    # A count that fails fails its node
+    pipeline = {"A": {**node(lambda s: None), "rows_from": "MISSING"}, "B": node(lambda s: None, after=["A"])}
+    batches = orchestrate_jobs.run_micro_batches(session, pipeline=pipeline, interval_seconds=0, max_batches=1, count_rows=True)
+    assert {n: r['status'] for n, r in batches[0]['results'].items()} == {"A": "failed", "B": "not run"}
+
+def test_local_pipeline_processes_new_files_once(orchestrate_jobs, tmp_path):
+    session, streams, data_directory = orchestrate_jobs.create_local_pipeline_session(data_directory=str(tmp_path), scale='100')
+    with session:
+        assert not orchestrate_jobs.pos_view_and_stream_exist(session)
+        pipeline = orchestrate_jobs.build_local_pipeline(streams, data_directory)
+        batches = orchestrate_jobs.run_micro_batches(session, pipeline=pipeline, interval_seconds=0, max_batches=2, max_workers=1, \
+                                                     count_rows=True)
+        assert orchestrate_jobs.failed_nodes(batches) == []
+        first, second = [{n: (r['status'], r['rows']) for n, r in b['results'].items()} for b in batches]
+        assert first['ORDERS_UPDATE'] == ('succeeded', 100)
+        assert first['DAILY_CITY_METRICS_UPDATE'] == ('succeeded', 100)
+        # Nothing new in the second batch, and the view and stream are kept
+        assert second['CREATE_POS_VIEW'][0] == second['ORDERS_UPDATE'][0] == second['DAILY_CITY_METRICS_UPDATE'][0] == 'skipped'
+        assert orchestrate_jobs.pos_view_and_stream_exist(session)
+        assert session.table('HARMONIZED.ORDERS').count() == 100
+
+        # A new pipeline (like a restarted script) doesn't replace the existing view and stream
+        create_pos_view = orchestrate_jobs.build_local_pipeline(streams, data_directory)['CREATE_POS_VIEW']['run']
+        create_pos_view(session)
+        assert streams.rows('HARMONIZED.POS_FLATTENED_V_STREAM') == 0
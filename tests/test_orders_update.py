@@ -0,0 +1,103 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_orders_update.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+import snowflake.snowpark.types as T
+import snowflake.snowpark.functions as F
+import warehouse
+from local_session import count_queries
+
+POS_FLATTENED_V = 'HARMONIZED.POS_FLATTENED_V'
+POS_FLATTENED_V_STREAM = 'HARMONIZED.POS_FLATTENED_V_STREAM'
+VIEW_SCHEMA = T.StructType([T.StructField("ORDER_DETAIL_ID", T.LongType()), T.StructField("QUANTITY", T.LongType()), \
+                            T.StructField("PRICE", T.DoubleType())])
+STREAM_SCHEMA = T.StructType([*VIEW_SCHEMA.fields, T.StructField("METADATA$ACTION", T.StringType()), \
+                              T.StructField("METADATA$ISUPDATE", T.BooleanType()), T.StructField("METADATA$ROW_ID", T.StringType())])
+
+
+def create_view_table(session):
+    # A table with the view's name is enough for CREATE TABLE ... LIKE and the column lookups
+    session.create_dataframe([[None] * 3], schema=VIEW_SCHEMA).filter(F.lit(False)).write.mode('overwrite').save_as_table(POS_FLATTENED_V)
+
+def write_stream(session, changes):
+    # changes are (action, is_update, ORDER_DETAIL_ID, QUANTITY, PRICE), like the rows of a stream on the view
+    rows = [[i, q, p, action, is_update, str(i)] for action, is_update, i, q, p in changes]
+    session.create_dataframe(rows, schema=STREAM_SCHEMA).write.mode('overwrite').save_as_table(POS_FLATTENED_V_STREAM)
+
+def update(old, new):
+    return [('DELETE', True, *old), ('INSERT', True, *new)]
+
+def orders(session):
+    return {r['ORDER_DETAIL_ID']: r for r in session.table('HARMONIZED.ORDERS').collect()}
+
+
+def test_change_aware_merge_applies_stream_changes(local_session, orders_update):
+    session, _ = local_session
+    create_view_table(session)
+    write_stream(session, [('INSERT', False, 1, 1, 10.0), ('INSERT', False, 2, 2, 20.0), ('INSERT', False, 3, 3, 30.0)])
+    orders_update.main(session)
+    before = orders(session)
+    assert {i: (r['QUANTITY'], r['PRICE']) for i, r in before.items()} == {1: (1, 10.0), 2: (2, 20.0), 3: (3, 30.0)}
+    assert all(r['META_ROW_HASH'] is not None for r in before.values())
+
+    # An update, an update that doesn't change anything, a delete and an insert
+    write_stream(session, [*update((1, 1, 10.0), (1, 5, 50.0)), *update((2, 2, 20.0), (2, 2, 20.0)), \
+                           ('DELETE', False, 3, 3, 30.0), ('INSERT', False, 4, 4, 40.0)])
+    orders_update.main(session)
+    after = orders(session)
+    assert {i: (r['QUANTITY'], r['PRICE']) for i, r in after.items()} == {1: (5, 50.0), 2: (2, 20.0), 4: (4, 40.0)}
+    assert after[1]['META_ROW_HASH'] != before[1]['META_ROW_HASH']
+    # The unchanged row isn't rewritten
+    assert after[2]['META_UPDATED_AT'] == before[2]['META_UPDATED_AT']
+
+def test_legacy_merge_keeps_the_row_hash_current(local_session, orders_update):
+    session, _ = local_session
+    create_view_table(session)
+    write_stream(session, [('INSERT', False, 1, 1, 10.0)])
+    orders_update.main(session)
+    hash_a = orders(session)[1]['META_ROW_HASH']
+
+    # A -> B with the legacy merge, then back to A with the change-aware one
+    write_stream(session, [('INSERT', False, 1, 2, 20.0)])
+    orders_update.merge_order_updates(session, change_aware=False)
+    row = orders(session)[1]
+    assert row['QUANTITY'] == 2 and row['META_ROW_HASH'] != hash_a
+    write_stream(session, update((1, 2, 20.0), (1, 1, 10.0)))
+    orders_update.main(session)
+    row = orders(session)[1]
+    assert (row['QUANTITY'], row['PRICE'], row['META_ROW_HASH']) == (1, 10.0, hash_a)
+
+def test_main_query_budget(local_session, orders_update, monkeypatch):
+    session, _ = local_session
+    # Other tests leave the warehouse size known, start without it like a new process
+    monkeypatch.setattr(warehouse, '_current_sizes', {})
+    create_view_table(session)
+    write_stream(session, [('INSERT', False, 1, 1, 10.0)])
+    # The first run creates ORDERS and its stream, and sizes the warehouse
+    assert count_queries(session, lambda: orders_update.main(session)) == 9
+    # After that: the stream and table metadata and the MERGE, the column metadata comes from the cache
+    assert count_queries(session, lambda: orders_update.main(session)) == 2
+    # A new session looks the metadata up once
+    orders_update.clear_metadata_cache(session)
+    assert count_queries(session, lambda: orders_update.main(session)) == 3
+
+def test_warehouse_is_sized_from_table_metadata(local_session, orders_update, monkeypatch):
+    session, _ = local_session
+    monkeypatch.setattr(warehouse, '_current_sizes', {})
+    monkeypatch.setattr(warehouse, 'ROWS_PER_SIZE', [(3, 'SMALL')])
+    create_view_table(session)
+    write_stream(session, [('INSERT', False, 1, 1, 10.0)])
+    orders_update.main(session)
+    # Four order lines, one of them already in ORDERS
+    session.create_dataframe([[i] for i in range(4)], schema=["ORDER_DETAIL_ID"]).write.mode('overwrite').save_as_table('RAW_POS.ORDER_DETAIL')
+    write_stream(session, [('INSERT', False, i, 1, 10.0) for i in range(2, 5)])
+    orders_update.main(session)
+    assert any(s.startswith("ALTER WAREHOUSE HOL_WH SET WAREHOUSE_SIZE = SMALL") for s in session.sql.statements)
+    assert len(orders(session)) == 4
+
+    # An empty stream is neither counted nor merged
+    write_stream(session, [])
+    assert count_queries(session, lambda: orders_update.main(session)) == 1
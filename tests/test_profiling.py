@@ -0,0 +1,115 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_profiling.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+import io
+import json
+import threading
+import time
+import pytest
+from collections import namedtuple
+from run_benchmark import load_step
+
+QueryRecord = namedtuple('QueryRecord', ['query_id', 'sql_text', 'is_describe', 'thread_id'])
+SERVER_MS = 20
+
+
+class ProfiledSession:
+    # Tells query listeners about each query like Snowpark does, and answers the QUERY_HISTORY lookup
+    def __init__(self):
+        self.query_tag = 'original'
+        self.listeners = []
+        self.queries = {}
+        self._conn = self
+
+    def add_query_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_query_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def run(self, sql_text, seconds=0):
+        # A query issued from the calling thread, remembering the tag it ran with and when it started
+        query_id = 'q{}'.format(len(self.queries))
+        self.queries[query_id] = {'tag': self.query_tag, 'start_ms': time.time() * 1000}
+        time.sleep(seconds)
+        for listener in list(self.listeners):
+            listener._notify(QueryRecord(query_id, sql_text, False, threading.get_ident()))
+        return query_id
+
+    def sql(self, query):
+        return StatsResult(self, query)
+
+class StatsResult:
+    def __init__(self, session, query):
+        self.session = session
+        self.query = query
+
+    def collect(self):
+        return [{'QUERY_ID': q, 'ROWS_PRODUCED': 1, 'TOTAL_ELAPSED_TIME': SERVER_MS, 'START_MS': query['start_ms']} \
+                for q, query in self.session.queries.items() if "'{}'".format(q) in self.query]
+
+@pytest.fixture
+def profiling():
+    module = load_step('profiling', 'profiling.py')
+    module.enable_profiling(io.StringIO())
+    return module
+
+def records(profiling):
+    return [json.loads(line) for line in profiling.profile_output.getvalue().splitlines()]
+
+
+def test_steps_share_the_query_tag_and_restore_it_when_the_last_one_ends(profiling):
+    session = ProfiledSession()
+    second_started, first_done = threading.Event(), threading.Event()
+
+    def second_step():
+        with profiling.profile_step(session, 'second'):
+            session.run('SELECT 2')
+            second_started.set()
+            first_done.wait()
+            session.run('SELECT 3')
+
+    with profiling.profile_step(session, 'first'):
+        session.run('SELECT 1')
+        thread = threading.Thread(target=second_step)
+        thread.start()
+        second_started.wait()
+    first_done.set()
+    thread.join()
+
+    tags = [json.loads(session.queries[q]['tag'])['steps'] for q in ['q0', 'q1', 'q2']]
+    assert tags == [['first'], ['first', 'second'], ['second']]
+    assert session.query_tag == 'original'
+    assert profiling._running_steps.get(session) is None
+
+def test_each_step_records_only_its_own_queries_with_their_times(profiling):
+    session = ProfiledSession()
+    with profiling.profile_step(session, 'first'):
+        session.run('SELECT 1', seconds=0.2)
+        session.run('SELECT 2')
+        other = threading.Thread(target=session.run, args=('SELECT 3',))
+        other.start()
+        other.join()
+
+    queries = [r for r in records(profiling) if 'query_id' in r]
+    assert [(r['step'], r['query_id'], r['server_ms']) for r in queries] == [('first', 'q0', SERVER_MS), ('first', 'q1', SERVER_MS)]
+    # The step waited 200ms for the first query; the second came back faster than Snowflake's own time
+    assert 200 <= queries[0]['client_ms'] < 1000
+    assert queries[1]['client_ms'] == SERVER_MS
+    assert records(profiling)[-1]['queries'] == 2
+    histogram = profiling.latency_histogram('first')
+    assert histogram[50] == 1 and histogram[500] == 1
+    assert session.listeners == []
+
+def test_queries_are_recorded_when_the_step_fails(profiling):
+    session = ProfiledSession()
+    with pytest.raises(ValueError):
+        with profiling.profile_step(session, 'failing'):
+            session.run('SELECT 1')
+            raise ValueError("step failed")
+    assert [r['query_id'] for r in records(profiling) if 'query_id' in r] == ['q0']
+    assert session.query_tag == 'original'
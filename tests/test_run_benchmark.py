@@ -0,0 +1,56 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_run_benchmark.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+import pytest
+import run_benchmark
+
+
+class DatabaseSession:
+    # Answers SHOW DATABASES from databases ({name: comment}) and records everything else
+    def __init__(self, databases):
+        self.databases = databases
+        self.statements = []
+        self.database = None
+
+    def sql(self, query):
+        return DatabaseResult(self, " ".join(query.split()))
+
+    def use_database(self, database):
+        self.database = database
+
+class DatabaseResult:
+    def __init__(self, session, statement):
+        self.session = session
+        self.statement = statement
+
+    def collect(self):
+        if self.statement.startswith('SHOW DATABASES'):
+            name = self.statement.split("'")[1]
+            return [{'name': name, 'comment': self.session.databases[name]}] if name in self.session.databases else []
+        self.session.statements.append(self.statement)
+        return []
+
+
+def test_benchmark_creates_its_databases():
+    session = DatabaseSession({})
+    run_benchmark.reset_benchmark_databases(session, 'BENCH_DB')
+    assert "CREATE OR REPLACE DATABASE BENCH_DB COMMENT = '{}'".format(run_benchmark.BENCHMARK_COMMENT) in session.statements
+    assert "CREATE SCHEMA FROSTBYTE_WEATHERSOURCE.ONPOINT_ID" in session.statements
+    assert session.database == 'BENCH_DB'
+
+def test_benchmark_replaces_only_databases_it_created():
+    session = DatabaseSession({'BENCH_DB': run_benchmark.BENCHMARK_COMMENT, 'FROSTBYTE_WEATHERSOURCE': run_benchmark.BENCHMARK_COMMENT})
+    run_benchmark.reset_benchmark_databases(session, 'BENCH_DB')
+    assert len([s for s in session.statements if s.startswith('CREATE OR REPLACE DATABASE')]) == 2
+
+@pytest.mark.parametrize('database', ['BENCH_DB', 'FROSTBYTE_WEATHERSOURCE'])
+def test_benchmark_refuses_databases_it_did_not_create(database):
+    # Like the lab's own database, or the Weather Source share
+    session = DatabaseSession({database: ''})
+    with pytest.raises(Exception, match="wasn't created by the benchmark"):
+        run_benchmark.reset_benchmark_databases(session, 'BENCH_DB')
+    assert session.statements == []
@@ -0,0 +1,25 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_shared_modules.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+# Each Snowpark project is deployed on its own, so the modules they share are copied
+# into every project. The copies in steps/ are the ones to edit.
+
+import filecmp
+import os
+import pytest
+
+STEPS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'steps')
+SHARED_MODULES = ['warehouse.py', 'profiling.py']
+PROJECT_DIRECTORIES = ['06_orders_update_sp/orders_update_sp', '07_daily_city_metrics_update_sp/daily_city_metrics_update_sp']
+
+
+@pytest.mark.parametrize('module', SHARED_MODULES)
+@pytest.mark.parametrize('project', PROJECT_DIRECTORIES)
+def test_project_copy_matches_steps(project, module):
+    copy = os.path.join(STEPS_DIRECTORY, project, module)
+    assert filecmp.cmp(os.path.join(STEPS_DIRECTORY, module), copy, shallow=False), \
+        "{} is out of date, copy it from steps/{}".format(copy, module)
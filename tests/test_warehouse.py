@@ -0,0 +1,72 @@
+#------------------------------------------------------------------------------
+# Hands-On Lab: Data Engineering with Snowpark
+# Script:       tests/test_warehouse.py
+# Author:       Jeremiah Hansen, Caleb Baechtold
+# Last Updated: 1/9/2023
+#------------------------------------------------------------------------------
+
+import pytest
+from run_benchmark import load_step
+
+
+class RecordingSession:
+    # Records the ALTER WAREHOUSE statements, and fails the ones for the sizes in fail_sizes
+    def __init__(self, fail_sizes=()):
+        self.statements = []
+        self.fail_sizes = set(fail_sizes)
+
+    def sql(self, query):
+        return RecordingResult(self, query)
+
+class RecordingResult:
+    def __init__(self, session, query):
+        self.session = session
+        self.query = query
+
+    def collect(self):
+        size = self.query.split("WAREHOUSE_SIZE = ")[1].split()[0]
+        if size in self.session.fail_sizes:
+            raise Exception("Insufficient privileges to resize the warehouse")
+        self.session.statements.append(self.query)
+        return []
+
+@pytest.fixture
+def warehouse():
+    # A fresh copy of the module, so every test starts without holders or known sizes
+    return load_step('warehouse', 'warehouse.py')
+
+def sizes(session):
+    return [s.split("WAREHOUSE_SIZE = ")[1].split()[0] for s in session.statements]
+
+
+def test_warehouse_stays_at_the_largest_size_until_the_last_job_is_done(warehouse):
+    session = RecordingSession()
+    with warehouse.warehouse_size(session, 'MEDIUM', job='big') as used_size:
+        assert used_size == 'MEDIUM'
+        with warehouse.warehouse_size(session, 'SMALL', job='small') as used_size:
+            assert used_size == 'MEDIUM'
+        assert sizes(session) == ['MEDIUM']
+    assert sizes(session) == ['MEDIUM', 'XSMALL']
+    assert 'WAIT_FOR_COMPLETION = TRUE' in session.statements[0]
+    assert 'WAIT_FOR_COMPLETION' not in session.statements[1]
+
+def test_warehouse_is_put_back_when_the_job_fails(warehouse):
+    session = RecordingSession()
+    with pytest.raises(ValueError):
+        with warehouse.warehouse_size(session, 'LARGE'):
+            raise ValueError("job failed")
+    assert sizes(session) == ['LARGE', 'XSMALL']
+    assert warehouse._holders[warehouse.WAREHOUSE_NAME] == []
+
+def test_failed_resize_doesnt_leave_a_holder_behind(warehouse):
+    session = RecordingSession(fail_sizes=['LARGE'])
+    with pytest.raises(Exception, match="Insufficient privileges"):
+        with warehouse.warehouse_size(session, 'LARGE'):
+            pass
+    assert warehouse._holders[warehouse.WAREHOUSE_NAME] == []
+
+    # The next job sizes the warehouse for itself, not for the job that never started
+    session.fail_sizes.clear()
+    with warehouse.warehouse_size(session, 'SMALL') as used_size:
+        assert used_size == 'SMALL'
+    assert sizes(session) == ['SMALL', 'XSMALL']